@@ -0,0 +1,139 @@
+# Keeps each snapshot inside one datagram and each client under a byte rate.
+# Every object that changed since the client's baseline builds up priority
+# each snapshot it isn't sent, faster the closer it is to the player and the
+# more it matters (people over grenades over bullets). The most urgent go
+# first until the packet is full. Anything left over keeps its priority for
+# next time, and the client is told the baseline's record for it so the
+# snapshot stays consistent with what it actually has.
+
+import math
+from snapshot import Snapshot, changes
+from objects import PERSON, GRENADE
+import protocol, reliable
+
+# Under the smallest MTU anyone's likely to have once IP and UDP headers are
+# taken off
+MTU = 1200
+# What's left for the snapshot after the reliable channel's share
+SNAPSHOT_MTU = MTU - reliable.HEADER.size - reliable.ReliableChannel.maxBytes
+
+TYPE_PRIORITY = {PERSON: 4.0, GRENADE: 2.0}
+
+class Bandwidth(object):
+    def __init__(self, metrics, name, mtu = SNAPSHOT_MTU, maxBytesPerSecond = 24000):
+        self.metrics = metrics
+        self.mtu = mtu
+        self.maxBytesPerSecond = maxBytesPerSecond
+        # Allowance left under the rate cap, can't save up more than a
+        # couple of packets
+        self.allowance = mtu
+        self.lastTime = None
+        self.priority = {}
+        self.waiting = {}
+        self._bytes = []
+        self._rate = metrics.gauge('net.%s.bytesPerSecond' % name)
+        self._starved = metrics.gauge('net.%s.starved' % name)
+        self._deferred = metrics.counter('net.budget.deferred')
+
+    def removeMetrics(self):
+        """Forgets this client's gauges once it's gone."""
+        self.metrics.remove(self._rate.name)
+        self.metrics.remove(self._starved.name)
+
+    def budget(self, now):
+        """Bytes that can go in this snapshot."""
+        if self.lastTime is not None:
+            self.allowance = min(self.allowance + (now - self.lastTime) * self.maxBytesPerSecond,
+                                 2 * self.mtu)
+        self.lastTime = now
+        return max(0, min(self.mtu, int(self.allowance)))
+
+    def schedule(self, view, events, baseline, playerName, now):
+        """The snapshot and events to send, view cut down to fit the budget.
+        baseline is the Snapshot the client acknowledged or None."""
+        budget = self.budget(now) - protocol.SNAPSHOT_SIZE
+        if baseline:
+            for name in baseline.names:
+                if name not in view.objects:
+                    budget -= protocol.ID.size
+
+        own = view.objects.get(playerName)
+        x = y = 0.0
+        if own is not None:
+            x, y = own[0][0][0], own[0][0][1]
+
+        # Work out what each changed object would cost and how badly it
+        # wants to go
+        candidates = []
+        priority = {}
+        for name in view.names:
+            attributes, type = view.objects[name]
+            old = baseline and baseline.objects.get(name)
+            if old is not None and old[1] == type:
+                delta = changes(old[0], attributes)
+                if delta is not None:
+                    if not delta and name not in events:
+                        continue
+                    record = [name, delta, events.get(name, [])]
+                else:
+                    record = [name, attributes, 0, type, events.get(name, [])]
+            else:
+                record = [name, attributes, 0, type, events.get(name, [])]
+            position = attributes[0]
+            distance = math.sqrt((position[0] - x)**2 + (position[1] - y)**2)
+            p = self.priority.get(name, 0.0) + TYPE_PRIORITY.get(type, 1.0) / (1.0 + distance/10.0)
+            if name == playerName:
+                # Always fits, the client can't do anything without it
+                p = 1e300
+            priority[name] = p
+            candidates.append((p, name, protocol.recordSize(record)))
+        candidates.sort(reverse = True)
+
+        sent = {}
+        for p, name, size in candidates:
+            if size <= budget or name == playerName:
+                budget -= size
+                sent[name] = True
+
+        snapshot = view
+        if len(sent) < len(candidates):
+            # Whatever didn't fit is left as the client last saw it, or not
+            # there at all if it's never seen it
+            names = []
+            objects = {}
+            for name in view.names:
+                if name in sent or name not in priority:
+                    record = view.objects[name]
+                else:
+                    record = baseline and baseline.objects.get(name)
+                    if record is None:
+                        continue
+                names.append(name)
+                objects[name] = record
+            snapshot = Snapshot(names, objects)
+            events = dict([(name, e) for name, e in events.items() if name in sent])
+
+        # Carry priority over for what didn't fit, and forget anything that
+        # isn't there any more
+        waiting = {}
+        starved = 0
+        for name in priority:
+            if name in sent:
+                if name in self.waiting:
+                    self.metrics.record('net.budget.starvation', self.waiting[name])
+            else:
+                waiting[name] = self.waiting.get(name, 0) + 1
+                starved = max(starved, waiting[name])
+                self._deferred.value += 1
+        self.priority = dict([(name, priority[name]) for name in waiting])
+        self.waiting = waiting
+        self._starved.set(starved)
+        return snapshot, events
+
+    def sent(self, size, now):
+        self.allowance -= size
+        # Bytes per second over the last second
+        self._bytes.append((now, size))
+        while self._bytes and self._bytes[0][0] <= now - 1.0:
+            del self._bytes[0]
+        self._rate.set(sum([s for t, s in self._bytes]))
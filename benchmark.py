@@ -0,0 +1,254 @@
+# Headless simulation benchmark. Builds an Engine with no networking or
+# rendering, fills dm_arena with scripted Person bots and drives it for a
+# fixed number of ticks from a fixed seed so runs can be compared.
+#
+# Usage: python benchmark.py [--ticks 1500] [--players 2,8,16,32]
+#                            [--weapons mixed,Shotgun,SMG,GrenadeLauncher]
+#                            [--broadphase quadtree|hash|simple|sap|auto]
+#                            [--projectiles analytic|ode] [--ai]
+#                            [--shrapnel physical|rays] [--check]
+#
+# --check only checks the ObjectPool, that everything released to it comes
+# back out as the type it went in as, and runs no benchmarks.
+# --ai has the bots played by bots.py, as on a server, instead of scripted
+# input, and reports what their thinking costs.
+# --broadphase auto runs every broadphase for each load and reports the
+# fastest one.
+
+import os, sys, random, math
+from optparse import OptionParser
+from engine import Engine
+from metrics import clock
+from bots import Bots
+from objects import *
+
+WEAPON_KEYS = {
+    "Pistol": WEAPON1,
+    "SMPistol": WEAPON2,
+    "SMG": WEAPON3,
+    "Shotgun": WEAPON4,
+    "Assault": WEAPON5,
+    "GrenadeLauncher": WEAPON6,
+    "Support": WEAPON7,
+    "Sniper": WEAPON8,
+    "Laser": WEAPON9,
+    }
+
+# Weapons handed out round robin for the "mixed" load
+MIXED = ["Shotgun", "SMG", "GrenadeLauncher", "Assault", "Laser"]
+
+PHASES = Engine.PHASES + ["frameEnded"]
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = int(round((len(ordered) - 1) * p / 100.0))
+    return ordered[index]
+
+class ScriptedInput(object):
+    """Replays a deterministic stream of inputPresses for one bot."""
+    def __init__(self, seed, gunName):
+        self.random = random.Random(seed)
+        self.weaponKey = WEAPON_KEYS[gunName]
+        self.tick = 0
+        self.moveKeys = 0
+        self.ticksUntilChange = 0
+        self.angle = self.random.uniform(0, 2*math.pi)
+
+    def next(self):
+        if self.ticksUntilChange <= 0:
+            self.ticksUntilChange = self.random.randint(30, 150)
+            self.moveKeys = self.random.choice([
+                0,
+                LEFT | ROTATE_LEFT,
+                RIGHT | ROTATE_RIGHT,
+                LEFT | ROTATE_LEFT | UP,
+                RIGHT | ROTATE_RIGHT | UP,
+                DOWN])
+        self.ticksUntilChange -= 1
+        self.angle += self.random.uniform(-0.05, 0.05)
+
+        keys = self.moveKeys
+        if self.tick == 0:
+            keys |= self.weaponKey
+        # Hold the trigger for a while then let go, letting go is what
+        # reloads an empty gun and re-arms the non automatic ones
+        if (self.tick // 40) % 4 != 3:
+            keys |= SHOOT
+        self.tick += 1
+        return [(math.cos(self.angle), math.sin(self.angle), 0), keys]
+
+class BenchmarkEngine(Engine):
+    def __init__(self, seed, broadphase = Engine.broadphase, analyticProjectiles = True, ai = False):
+        Engine.__init__(self)
+        self.broadphase = broadphase
+        self.analyticProjectiles = analyticProjectiles
+        random.seed(seed)
+        self.seed = seed
+        self.stepTimes = []
+        self.inputs = []
+        self.bots = None
+        if ai:
+            self.bots = Bots(self, 10.0, seed)
+
+    def spawnBots(self, numPlayers, weapons):
+        for i in range(numPlayers):
+            bot = self.createPerson("b%i" % i)
+            bot.setPosition(self.spawnLocation())
+            self.objects.add(bot)
+            gunName = weapons[i % len(weapons)]
+            if self.bots is not None:
+                bot.setGun(gunName)
+                self.bots.add(bot)
+            else:
+                self.inputs.append((bot, ScriptedInput(self.seed * 1000 + i, gunName)))
+
+    def tick(self):
+        for bot, script in self.inputs:
+            bot.inputPresses(script.next())
+        if self.bots is not None:
+            self.bots.step(self.stepSize)
+        # Exactly one physics step per tick, no wall clock involved
+        start = clock()
+        self.stepOnce()
+        frameStart = clock()
+        for o in self.objects:
+            o.frameEnded(self.stepSize)
+        end = clock()
+        self.metrics.record("engine.frameEnded", end - frameStart)
+        self.stepTimes.append(end - start)
+
+    def run(self, ticks):
+        for i in range(ticks):
+            self.tick()
+
+def checkPool(seed):
+    """Releases a few of every pooled type to the ObjectPool, all mixed
+    together, and checks asking for each type gets back just those."""
+    engine = BenchmarkEngine(seed, analyticProjectiles = False)
+    engine._createWorld()
+    types = (BULLET, SHRAPNEL, GRENADE, LASER)
+    released = {}
+    for i in range(3):
+        for type in types:
+            b = engine.addBullet(type, "pool%i.%i" % (type, i), [0, 10, 0], [1, 0, 0], [10, 10], 1, "")
+            engine.objects.remove(b)
+            engine.pool.release(b)
+            released.setdefault(type, []).append(b)
+    good = True
+    for type in types:
+        again = []
+        for i in range(len(released[type])):
+            b = engine.addBullet(type, "again%i.%i" % (type, i), [0, 10, 0], [1, 0, 0], [10, 10], 1, "")
+            engine.objects.remove(b)
+            again.append(b)
+        same = sorted(map(id, again)) == sorted(map(id, released[type]))
+        print "pool type %i: %s" % (type, ["!! got back something else", "ok"][same])
+        good = good and same
+    return good
+
+def runOne(numPlayers, weaponMix, ticks, seed, broadphase = Engine.broadphase, analyticProjectiles = True, ai = False):
+    if weaponMix == "mixed":
+        weapons = MIXED
+    else:
+        weapons = [weaponMix]
+
+    engine = BenchmarkEngine(seed, broadphase, analyticProjectiles, ai)
+    engine._createWorld()
+    engine.spawnBots(numPlayers, weapons)
+
+    start = clock()
+    engine.run(ticks)
+    total = clock() - start
+
+    result = {
+        'players': numPlayers,
+        'weapons': weaponMix,
+        'broadphase': broadphase,
+        'ticks': ticks,
+        'ticksPerSecond': ticks / total if total > 0 else 0.0,
+        'p50': percentile(engine.stepTimes, 50),
+        'p99': percentile(engine.stepTimes, 99),
+        'objects': len(engine.objects),
+        'phases': dict([(phase, engine.metrics.histogram("engine." + phase).total) for phase in PHASES]),
+        'collisionPairs': engine.metrics.get("engine.collisionPairs"),
+        'spawned': engine.metrics.get("engine.spawned"),
+        'poolHitRate': engine.pool.hitRate(),
+        'total': total,
+        'ai': ai,
+        'seconds': ticks * engine.stepSize,
+        'think': engine.metrics.histogram("bots.think"),
+        'sightChecks': engine.metrics.get("bots.sightChecks"),
+        'paths': engine.metrics.get("bots.paths"),
+        }
+    return result
+
+def report(result):
+    print "%3i players %-16s %-8s %8.1f ticks/s  p50 %6.3fms  p99 %6.3fms  objects %5i  spawned %6i  pairs %8i  pool %3i%%" % \
+          (result['players'],
+           result['weapons'],
+           result['broadphase'],
+           result['ticksPerSecond'],
+           result['p50'] * 1000,
+           result['p99'] * 1000,
+           result['objects'],
+           result['spawned'],
+           result['collisionPairs'],
+           result['poolHitRate'] * 100)
+    total = sum(result['phases'].values()) or 1.0
+    print "    " + "  ".join(["%s %.3fms (%2i%%)" % (phase,
+                                                    result['phases'][phase] * 1000 / result['ticks'],
+                                                    result['phases'][phase] * 100 / total)
+                              for phase in PHASES])
+    if result['ai']:
+        think = result['think']
+        seconds = result['seconds']
+        # Of one core, per second of game time
+        print "    bots think %i times  p50 %.3fms  max %.3fms  %.2f%% of a core  sight checks %i  paths %i" % \
+              (think.count, think.percentile(50) * 1000, think.max * 1000,
+               think.total * 100 / seconds, result['sightChecks'], result['paths'])
+
+def pickBroadphase(numPlayers, weaponMix, ticks, seed, analyticProjectiles = True, candidates = Engine.BROADPHASES, ai = False):
+    results = []
+    for kind in candidates:
+        result = runOne(numPlayers, weaponMix, ticks, seed, kind, analyticProjectiles, ai)
+        report(result)
+        results.append(result)
+    best = max(results, key = lambda r: r['ticksPerSecond'])
+    print "Fastest broadphase for %i players, %s: %s" % (numPlayers, weaponMix, best['broadphase'])
+    return best['broadphase']
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--ticks", type="int", default=1500)
+    parser.add_option("--seed", type="int", default=1)
+    parser.add_option("--players", default="2,8,16,32")
+    parser.add_option("--weapons", default="mixed,Shotgun,SMG,GrenadeLauncher")
+    parser.add_option("--broadphase", default=Engine.broadphase)
+    parser.add_option("--projectiles", default="analytic")
+    parser.add_option("--ai", action="store_true", default=False)
+    parser.add_option("--shrapnel", default="physical")
+    parser.add_option("--check", action="store_true", default=False)
+    options, args = parser.parse_args()
+    BenchmarkEngine.physicalShrapnel = options.shrapnel == "physical"
+
+    # The level is loaded relative to the working directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    if options.check:
+        if not checkPool(options.seed):
+            sys.exit(1)
+        return
+
+    for numPlayers in [int(x) for x in options.players.split(",")]:
+        for weaponMix in options.weapons.split(","):
+            analytic = options.projectiles == "analytic"
+            if options.broadphase == "auto":
+                pickBroadphase(numPlayers, weaponMix, options.ticks, options.seed, analytic,
+                               ai = options.ai)
+            else:
+                report(runOne(numPlayers, weaponMix, options.ticks, options.seed, options.broadphase,
+                              analytic, options.ai))
+
+if __name__ == "__main__":
+    main()
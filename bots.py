@@ -0,0 +1,211 @@
+# People played by the server. A Brain drives a Person through
+# inputPresses exactly like a client's input would, but it only thinks a
+# few times a second, and the presses it picks carry on being applied every
+# physics tick in between. The brains are split into as many batches as
+# there are steps between thinks. Who's where and who can see who comes
+# from the engine's WorldQuery, which all the brains share.
+#
+# A brain shoots at the nearest person it can see, and otherwise wanders
+# between waypoints (see navigation.py), heading for whoever it last saw.
+
+import math, random
+from navigation import WaypointGraph, JUMP
+from metrics import clock
+from objects import PERSON, LEFT, RIGHT, ROTATE_LEFT, ROTATE_RIGHT, UP, SHOOT
+
+class Brain(object):
+    # How far it can see, and how many people it tries to look at each think
+    sightRange = 25.0
+    maxSightChecks = 3
+    # Radians either side it aims off by
+    inaccuracy = 0.05
+    # Close enough to a waypoint to move on to the next one
+    arrived = 0.75
+    # Seconds without getting any closer to the next waypoint before giving
+    # up on where it was going
+    patience = 2.0
+
+    def __init__(self, bots, person, random):
+        self.bots = bots
+        self.person = person
+        self.random = random
+        self.path = []
+        # The waypoint it last got to, the edge from it says how to get to
+        # the next one
+        self.previous = None
+        self.target = None
+        # Where the target was last seen, where it's heading if it can't see
+        # anyone
+        self.lastSeen = None
+        self.aim = (1.0, 0.0, 0.0)
+        self.closest = None
+        self.waited = 0.0
+        self.trigger = False
+
+    def think(self, interval):
+        person = self.person
+        if person.isDead():
+            self.path = []
+            self.target = None
+            person.inputPresses([self.aim, 0])
+            return
+        x, y = person.getBody().getPosition()[0:2]
+        keys = self.steer(x, y, interval)
+        self.target = self.look(x, y)
+        if self.target is not None:
+            tx, ty = self.target.getBody().getPosition()[0:2]
+            self.lastSeen = (tx, ty)
+            angle = math.atan2(ty - y, tx - x) + self.random.uniform(-self.inaccuracy, self.inaccuracy)
+            self.aim = (math.cos(angle), math.sin(angle), 0)
+            keys |= self.fire()
+        elif keys & LEFT:
+            self.aim = (-1.0, 0.0, 0.0)
+        elif keys & RIGHT:
+            self.aim = (1.0, 0.0, 0.0)
+        person.inputPresses([self.aim, keys])
+
+    def fire(self):
+        gun = self.person.gun
+        if gun['ammo'] <= 0:
+            # Letting go is what reloads an empty gun
+            self.trigger = False
+        elif gun['auto']:
+            self.trigger = True
+        else:
+            # Has to be let go between shots
+            self.trigger = not self.trigger
+        if self.trigger:
+            return SHOOT
+        return 0
+
+    def look(self, x, y):
+        """The nearest person in sight, or None."""
+        query = self.bots.engine.query
+        nearest = query.nearest(x, y, self.maxSightChecks, PERSON, self.sightRange, self.person)
+        for d, other in nearest:
+            ox, oy = other.getBody().getPosition()[0:2]
+            self.bots._sightChecks.value += 1
+            # Head height to head height
+            if query.lineOfSight(x, y + 1.0, ox, oy + 1.0):
+                return other
+        return None
+
+    def steer(self, x, y, interval):
+        """Movement keys towards the next waypoint."""
+        graph = self.bots.graph
+        if not self.path:
+            self.plan(x, y)
+        while self.path:
+            px, py = graph.positions[self.path[0]]
+            if abs(px - x) < self.arrived and abs(py - y) < 2*self.arrived:
+                self.previous = self.path.pop(0)
+                self.closest = None
+                continue
+            break
+        if not self.path:
+            return 0
+        node = self.path[0]
+        px, py = graph.positions[node]
+        distance = abs(px - x) + abs(py - y)
+        if self.closest is None or distance < self.closest - 0.1:
+            self.closest = distance
+            self.waited = 0.0
+        else:
+            self.waited += interval
+            if self.waited > self.patience:
+                self.path = []
+                self.lastSeen = None
+                self.closest = None
+                return 0
+        keys = 0
+        if px > x + 0.25:
+            keys |= RIGHT | ROTATE_RIGHT
+        elif px < x - 0.25:
+            keys |= LEFT | ROTATE_LEFT
+        if self.previous is not None and py > y + self.arrived and \
+           graph.kind(self.previous, node) == JUMP:
+            keys |= UP
+        return keys
+
+    def plan(self, x, y):
+        graph = self.bots.graph
+        start = graph.nearest(x, y)
+        if start is None or not self.bots.goals:
+            return
+        goal = None
+        if self.lastSeen is not None:
+            goal = graph.nearest(self.lastSeen[0], self.lastSeen[1])
+            self.lastSeen = None
+        path = []
+        if goal is not None and goal != start:
+            path = graph.path(start, goal)
+        # Not everywhere can be got to from everywhere else
+        tries = 3
+        while not path and tries:
+            tries -= 1
+            path = graph.path(start, self.random.choice(self.bots.goals))
+        self.path = [start] + path
+        self.previous = None
+        self.bots._paths.value += 1
+        self.closest = None
+        self.waited = 0.0
+
+class Bots(object):
+    """Every brain on a server, each thinking thinkRate times a second of
+    game time."""
+    def __init__(self, engine, thinkRate = 10.0, seed = None):
+        self.engine = engine
+        self.thinkInterval = 1.0 / thinkRate
+        self.tick = 0
+        # Seconds update hasn't stepped for yet
+        self.owed = 0.0
+        self.random = random.Random(seed)
+        self.brains = []
+        # Built the first time a brain is added, the level has to be loaded
+        self.graph = None
+        self.goals = []
+        metrics = engine.metrics
+        self._think = metrics.histogram('bots.think')
+        self._sightChecks = metrics.counter('bots.sightChecks')
+        self._paths = metrics.counter('bots.paths')
+
+    def add(self, person):
+        if self.graph is None:
+            start = clock()
+            self.graph = WaypointGraph.fromLevel(self.engine.level, self.engine.staticIndex)
+            # Anywhere that can be left is worth going to
+            self.goals = [i for i in range(len(self.graph)) if self.graph.edges[i]]
+            print "Waypoint graph, %i waypoints in %.2fs" % (len(self.graph), clock() - start)
+        brain = Brain(self, person, self.random)
+        self.brains.append(brain)
+        return brain
+
+    def remove(self, person):
+        self.brains = [b for b in self.brains if b.person is not person]
+
+    def update(self, elapsed, stepSize):
+        """Steps once for every stepSize in elapsed, for when it isn't called
+        exactly every stepSize, so brains still think thinkRate times a
+        second."""
+        self.owed += elapsed
+        steps = int(self.owed / stepSize)
+        self.owed -= steps * stepSize
+        for i in range(steps):
+            self.step(stepSize)
+
+    def step(self, stepSize):
+        """Called every stepSize seconds, see update otherwise."""
+        if not self.brains:
+            return
+        # Each brain thinks once every thinkInterval, but they're spread over
+        # the calls in between so no one call takes all of it
+        ticks = max(1, int(round(self.thinkInterval / stepSize)))
+        turn = self.tick % ticks
+        self.tick += 1
+        brains = self.brains[turn::ticks]
+        if not brains:
+            return
+        start = clock()
+        for brain in brains:
+            brain.think(self.thinkInterval)
+        self._think.add(clock() - start)
@@ -1,4 +1,4 @@
-import math, os, time
+import math, os, sys, time
 import ogre.renderer.OGRE as ogre
 import ogre.gui.CEGUI as CEGUI
 
@@ -15,8 +15,11 @@ from engine import Engine
 from guiobjects import *
 import objects
 import networkclient
+from snapshot import SnapshotReceiver
+from inputs import InputHistory, InputRecorder
+from interpolation import SnapshotBuffer
+from prediction import Prediction, predictable
 import gamenet
-from encode import timer
 import console
 
 def cegui_reldim ( x ) :
@@ -399,6 +402,21 @@ class FrameListener(ogre.FrameListener, ogre.WindowEventListener):
             
 
 class Client(Application, Engine):
+    # Projectiles need bodies to draw their trails, this also keeps them as
+    # bodies in a ListenClient
+    analyticProjectiles = False
+    # Shrapnel is drawn so it stays physical, and grenades go off where the
+    # server says they did, see explosion
+    physicalShrapnel = True
+    remoteExplosions = True
+    # One input per physics tick, the same ticks the server applies them on
+    PHASES = ['input'] + Engine.PHASES + ['prediction']
+    # Draw other people between snapshots instead of simulating them
+    interpolateRemote = True
+    # Move our own player as soon as a key's pressed instead of waiting for
+    # the server
+    predictLocal = True
+
     def __init__(self, autoConnect = False):
         Application.__init__(self)
         Engine.__init__(self)
@@ -419,12 +437,20 @@ class Client(Application, Engine):
         self.timeBetweenChatUpdates = 0.5
         self.timeUntilNextChatUpdate = 0.0            
             
-        self.network = networkclient.NetworkClient(ip, int(port))
+        self.network = networkclient.NetworkClient(ip, int(port), self.metrics)
         self.timeBetweenNetworkUpdates = 0.02
         self.timeUntilNextNetworkUpdate = 0.0
         self.serverRoundTripTime = 0.0
         self.lastServerUpdate = time.time()
+        self.snapshots = SnapshotReceiver()
+        self.inputs = InputHistory()
+        self.presses = None
+        self.interpolation = SnapshotBuffer()
+        self.prediction = Prediction(self.metrics)
+        self._tickPresses = None
         self.player = None
+        # Every tick's input goes here too if it's set, see loadgen.py
+        self.recorder = None
     
     def sendText(self):
         e = CEGUI.WindowManager.getSingleton().getWindow("TextWindow/Editbox1")
@@ -635,7 +661,7 @@ class Client(Application, Engine):
 
     def displayScores(self):
         text = ""
-        players = [object for object in self.objects if object.type == objects.PERSON]
+        players = self.objects.ofType(objects.PERSON)
         for player in players:
             text += " %s, %2i, %4i\n" % \
                     (player._name, player.score, player.ping)
@@ -662,34 +688,117 @@ class Client(Application, Engine):
         self.displayScores()
         self.displayVitals()
     
+    def createFromServer(self, serverObject):
+        """Creates what a full snapshot record describes."""
+        newObject = None
+        if serverObject[2] == True:
+            newObject = Player(self, serverObject[Engine.NET_OBJECTS_NAME], self.camera)
+            self.chat.setNickName(serverObject[Engine.NET_OBJECTS_NAME])
+            newObject.enable()
+            self.player = newObject
+        else:
+            if serverObject[Engine.NET_OBJECTS_TYPE] == objects.PERSON:
+                newObject = Person(self, serverObject[Engine.NET_OBJECTS_NAME])
+            else:
+                newObject = self.pool.acquire(serverObject[Engine.NET_OBJECTS_TYPE])
+                if newObject is not None:
+                    newObject.reinit(serverObject[Engine.NET_OBJECTS_NAME])
+                elif serverObject[Engine.NET_OBJECTS_TYPE] == objects.BULLET:
+                    newObject = BulletObject(self, serverObject[Engine.NET_OBJECTS_NAME])
+                elif serverObject[Engine.NET_OBJECTS_TYPE] == objects.GRENADE:
+                    newObject = GrenadeObject(self, serverObject[Engine.NET_OBJECTS_NAME])
+                elif serverObject[Engine.NET_OBJECTS_TYPE] == objects.SHRAPNEL:
+                    newObject = ShrapnelObject(self, serverObject[Engine.NET_OBJECTS_NAME])
+                elif serverObject[Engine.NET_OBJECTS_TYPE] == objects.LASER:
+                    newObject = LaserObject(self, serverObject[Engine.NET_OBJECTS_NAME])
+                else:
+                    print "Unknown object to create", serverObject[Engine.NET_OBJECTS_TYPE], objects.PERSON
+
+        if newObject:
+            newObject.existsOnServer = True        
+            newObject.setAttributes(serverObject[Engine.NET_OBJECTS_ATTRIBUTES])
+            newObject.setEvents(serverObject[Engine.NET_OBJECTS_EVENTS])
+            self.objects.add(newObject)
+        return newObject
+
+    def explosion(self, name, position, seed):
+        """A grenade went off on the server. The shrapnel's fired here from
+        the same place and seed, so it's the same as the server's."""
+        origin = (position[0], position[1], 0.0)
+        grenade = self.objects.get(name)
+        ownerName = ""
+        if grenade is not None and grenade.type == objects.GRENADE:
+            ownerName = grenade.ownerName
+            if not grenade.exploded:
+                # Wherever it got to here
+                grenade.exploded = True
+                grenade.setDead()
+                self.sfx.play("GrenadeLauncherExplode.wav", origin)
+        self.shrapnel.fire(name, ownerName, origin, seed)
+
+    def isRemote(self, object):
+        return self.interpolateRemote and object.type == objects.PERSON and object is not self.player
+
+    def interpolate(self):
+        renderTime = self.interpolation.renderTime(time.time(), self.network.serverOffset)
+        for name in self.interpolation.names():
+            object = self.objects.get(name)
+            attributes = self.interpolation.sample(name, renderTime)
+            if object and attributes:
+                object.setAttributes(attributes)
+                # Only the snapshots move them, whatever the step did is
+                # overwritten here before anything's drawn
+                object.getBody().disable()
+
+    def inputPhase(self):
+        self._tickPresses = None
+        if self.player != None and self.presses != None:
+            self.inputs.add(self.presses)
+            if self.recorder:
+                self.recorder.add(self.presses)
+            if self.predictLocal:
+                self._tickPresses = predictable(self.presses)
+                self.player.inputPresses(self._tickPresses)
+
+    def predictionPhase(self):
+        if self._tickPresses != None:
+            self.prediction.record(self.inputs.sequence, self._tickPresses, self.player.getAttributes())
+
+    def reconcile(self, attributes, sequence):
+        self.prediction.reconcile(self.player, self.world, self.staticSpace, self,
+                                  attributes, sequence, self.inputs.sequence)
+
     def frameEnded(self, frameTime, keyboard,  mouse, joystick):
-        t = timer()
+        chatTimer = self.metrics.timer('client.chat')
+        networkTimer = self.metrics.timer('client.network')
 
         self.updateGUI(frameTime)
         
         Engine.frameEnded(self, frameTime)
 
-        t.start()
+        chatTimer.start()
         self.updateChat(frameTime)
-        t.stop()
-        t.debugChatTime = t.time()
+        self.debugChatTime = chatTimer.stop()
         
         keyboard = keyboard
         self.mouse = mouse
         self.joystick = joystick
         self.timeUntilNextNetworkUpdate -= frameTime
-        t.start()
+        networkTimer.start()
 
         if self.timeUntilNextNetworkUpdate <= 0.0:
             self.timeUntilNextNetworkUpdate = self.timeBetweenNetworkUpdates
 
-            u = timer()
-            u.start()
             self.network.update(frameTime)
-            u.stop()
 
             for message in self.network._messages:
                 if message[1] > self.lastServerUpdate:
+                    records = self.snapshots.apply(message[Engine.NET_OBJECTS],
+                                                   message[Engine.NET_SEQUENCE],
+                                                   message[Engine.NET_BASELINE],
+                                                   message[Engine.NET_REMOVED])
+                    if records is None:
+                        continue
                     self.timeUntilNextEngineUpdate = message[Engine.NET_TIME_UNTIL_UPDATE]
                     #print message[Engine.NET_TIME_UNTIL_UPDATE]
                     self.lastServerUpdate = message[Engine.NET_TIME]
@@ -697,54 +806,60 @@ class Client(Application, Engine):
                     for object in self.objects:
                         object.existsOnServer = False
 
-                    for serverObject in message[Engine.NET_OBJECTS]:
-                        hasObject = False
-                        for object in self.objects:
-                            if serverObject[Engine.NET_OBJECTS_NAME] == object._name:
-                                hasObject = True
-                                object.existsOnServer = True
-                                object.setAttributes(serverObject[Engine.NET_OBJECTS_ATTRIBUTES])
-                                object.setEvents(serverObject[Engine.NET_OBJECTS_EVENTS])
-                        if not hasObject:
-                            newObject = None
-                            if serverObject[2] == True:
-                                newObject = Player(self, serverObject[Engine.NET_OBJECTS_NAME], self.camera)
-                                self.chat.setNickName(serverObject[Engine.NET_OBJECTS_NAME])
-                                newObject.enable()
-                                self.player = newObject
+                    for serverObject in records:
+                        object = self.objects.get(serverObject[Engine.NET_OBJECTS_NAME])
+                        if object:
+                            object.existsOnServer = True
+                            if object is self.player and self.predictLocal:
+                                self.reconcile(serverObject[Engine.NET_OBJECTS_ATTRIBUTES],
+                                               message[Engine.NET_LAST_INPUT])
+                            elif self.isRemote(object):
+                                self.interpolation.add(message[Engine.NET_TIME], object._name,
+                                                       serverObject[Engine.NET_OBJECTS_ATTRIBUTES])
                             else:
-                                if serverObject[Engine.NET_OBJECTS_TYPE] == objects.PERSON:
-                                    newObject = Person(self, serverObject[Engine.NET_OBJECTS_NAME])
-                                elif serverObject[Engine.NET_OBJECTS_TYPE] == objects.BULLET:
-                                    newObject = BulletObject(self, serverObject[Engine.NET_OBJECTS_NAME])
-                                elif serverObject[Engine.NET_OBJECTS_TYPE] == objects.GRENADE:
-                                    newObject = GrenadeObject(self, serverObject[Engine.NET_OBJECTS_NAME])
-                                elif serverObject[Engine.NET_OBJECTS_TYPE] == objects.SHRAPNEL:
-                                    newObject = ShrapnelObject(self, serverObject[Engine.NET_OBJECTS_NAME])
-                                elif serverObject[Engine.NET_OBJECTS_TYPE] == objects.LASER:
-                                    newObject = LaserObject(self, serverObject[Engine.NET_OBJECTS_NAME])
-                                else:
-                                    print "Unknown object to create", serverObject[Engine.NET_OBJECTS_TYPE], objects.PERSON
-
-                            if newObject:
-                                newObject.existsOnServer = True        
-                                newObject.setAttributes(serverObject[Engine.NET_OBJECTS_ATTRIBUTES])
-                                newObject.setEvents(serverObject[Engine.NET_OBJECTS_EVENTS])
-                                self.objects += [newObject]
+                                object.setAttributes(serverObject[Engine.NET_OBJECTS_ATTRIBUTES])
+                            object.setEvents(serverObject[Engine.NET_OBJECTS_EVENTS])
+                        else:
+                            object = self.createFromServer(serverObject)
+                            if object and self.isRemote(object):
+                                self.interpolation.add(message[Engine.NET_TIME], object._name,
+                                                       serverObject[Engine.NET_OBJECTS_ATTRIBUTES])
 
                     for object in self.objects:
                         if not object.existsOnServer and object.type == objects.PERSON:
+                            self.interpolation.forget(object._name)
                             self.objects.remove(object)
                             object.close()
                             del object
                         
+            # Reliable messages are only ever delivered once
+            for message in self.network.reliableMessages:
+                if message[0] == "s":
+                    if not self.objects.get(message[1][Engine.NET_OBJECTS_NAME]):
+                        self.createFromServer(message[1])
+                elif message[0] == "e":
+                    object = self.objects.get(message[1])
+                    if object:
+                        object.setEvents(message[2])
+                elif message[0] == "x":
+                    self.explosion(message[1], message[2], message[3])
+
             self.network.clearMessages()
+            self.interpolation.adapt(self.network.jitter)
+
+        if self.interpolateRemote:
+            self.interpolate()
+        if self.player != None:
+            self.prediction.frameEnded(frameTime)
+            self.player.displayOffset = self.prediction.correction
             
         if self.player != None:
-            self.network.send(self.player.input(keyboard,  self.mouse, self.joystick))
+            # Used for every physics tick until the next frame
+            self.presses = self.player.input(keyboard,  self.mouse, self.joystick)
+            if self.inputs.sequence >= 0:
+                self.network.send(self.inputs.message(self.snapshots.sequence))
 
-        t.stop()
-        self.debugNetworkTime = t.time()
+        self.debugNetworkTime = networkTimer.stop()
         return True # Keep running
     
 if __name__ == "__main__":
@@ -756,6 +871,12 @@ if __name__ == "__main__":
         print "No Psyco Support"
         
     world = Client()
+    if len(sys.argv) > 1:
+        # python client.py inputs.txt, records the input played for
+        # loadgen.py --replay inputs.txt
+        world.recorder = InputRecorder(sys.argv[1])
     import cProfile
     cProfile.run('world.go()', 'client-profile.txt')
+    if world.recorder:
+        world.recorder.close()
     os._exit(0)
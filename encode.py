@@ -2,7 +2,7 @@ from twisted.spread import jelly
 from twisted.spread import banana
 from zlib import compress, decompress
 import random
-import time
+from metrics import clock
 #import cerealizer as cerealizer
 #import Flatten
 
@@ -12,10 +12,10 @@ class timer:
         self.t = 0
 
     def start(self):
-        self.s = time.clock()
+        self.s = clock()
 
     def stop(self):
-        self.t = time.clock() - self.s
+        self.t = clock() - self.s
 
     def time(self):
         return self.t
@@ -1,7 +1,18 @@
 import ode
 from objects import *
-import time
-import encode
+from registry import ObjectRegistry
+from projectiles import ProjectileSystem
+import level
+from metrics import Metrics, clock
+from pool import ObjectPool
+from worldquery import WorldQuery
+from shrapnel import Shrapnel
+from scheduler import Scheduler
+import time, math
+
+# What happens to the time a frame couldn't step, see Engine.step
+DROP = 'drop'
+DILATE = 'dilate'
 
 class Engine:
     NET_OBJECTS = 0
@@ -12,6 +23,61 @@ class Engine:
     NET_OBJECTS_EVENTS = 4
     NET_TIME = 1
     NET_TIME_UNTIL_UPDATE = 2
+    NET_SEQUENCE = 3
+    NET_BASELINE = 4
+    NET_REMOVED = 5
+    NET_LAST_INPUT = 6
+
+    PHASES = ['preCollide', 'collide', 'preStep', 'quickStep', 'projectiles', 'postStep', 'reap']
+
+    # Bullets, shrapnel and lasers as swept segments in a ProjectileSystem
+    # instead of ODE bodies. Front ends that draw projectiles keep them as
+    # bodies.
+    analyticProjectiles = False
+
+    # Grenades fire their shrapnel as projectiles. Without physicalShrapnel
+    # the damage is worked out in one go with rays instead, see shrapnel.py.
+    # Front ends draw the shrapnel so they keep it physical.
+    physicalShrapnel = True
+    # Grenades here don't go off until the server says where, see Client
+    remoteExplosions = False
+
+    # Broadphase used for everything that moves, see createBroadphase
+    broadphase = 'quadtree'
+    BROADPHASES = ['hash', 'quadtree', 'simple', 'sap']
+    # Extra room around the level for things that fly or fall out of it
+    boundsMargin = 10.0
+    # Roughly the size of a player, the smallest cell worth splitting down to
+    broadphaseCellSize = 2.0
+    # Where people come back, weighted by repeats. Anywhere with nobody
+    # within spawnClearance of it is picked first.
+    SPAWN_LOCATIONS = [
+        (0.0,20.0,0.0),
+        (30.0,55.0,0.0),
+        (-19.0,45.0,0.0),
+        (-23.0,22.0,0.0),
+        (0.0,20.0,0.0),
+        (0.0,20.0,0.0)
+        ]
+    spawnClearance = 4.0
+    # Guns, jumps and respawns count down in each object's frameEnded. Some
+    # guns fire every 0.02s, so this can't go much lower than the physics.
+    gameplayRate = 150.0
+    # After a stall no more than this many physics steps run in one frame,
+    # running dozens back to back only makes the next frame later still.
+    # What's left over is dropped, the game jumps ahead, or dilated, carried
+    # over to be caught up on later so the game runs slow for a while
+    # instead. No more than maxBacklog seconds are ever carried over.
+    maxStepsPerFrame = 8
+    catchUp = DILATE
+    maxBacklog = 0.1
+    # The solver's iterations, and with adaptiveIterations one fewer each
+    # frame that falls behind, down to minIterations, and one more back
+    # after each recoveryTime seconds that don't
+    iterations = 5
+    minIterations = 2
+    adaptiveIterations = False
+    recoveryTime = 1.0
     
     def __init__(self):
         self.stepSize = 1.0/150.0
@@ -20,6 +86,31 @@ class Engine:
         self.debugStepTime = 1.0
         self.debugFrameTime = 1.0
         self.debugNumSteps = 0
+        # ListenClient runs this twice, keep the first so the network layers
+        # created in between stay attached to the same metrics
+        if not hasattr(self, 'metrics'):
+            self.metrics = Metrics()
+        self._phases = [(self.metrics.histogram('engine.' + name), getattr(self, name + 'Phase'))
+                        for name in self.PHASES]
+        self._collisionPairs = self.metrics.counter('engine.collisionPairs')
+        self._contacts = self.metrics.counter('engine.contacts')
+        self._spawned = self.metrics.counter('engine.spawned')
+        self._reaped = self.metrics.counter('engine.reaped')
+        self._frameTime = self.metrics.histogram('engine.frame')
+        self._stepTime = self.metrics.histogram('engine.step')
+        self._fellBehind = self.metrics.counter('engine.fellBehind')
+        self._droppedTime = self.metrics.counter('engine.droppedTime')
+        self._dilatedTime = self.metrics.counter('engine.dilatedTime')
+        self._backlog = self.metrics.gauge('engine.backlog')
+        self._iterations = self.metrics.gauge('engine.iterations')
+        self.backlog = 0.0
+        self.timeUntilRecovery = 0.0
+        # Everything frameEnded does, each at its own rate, see scheduler.py.
+        # Front ends and the server add their own.
+        self.scheduler = Scheduler(self.metrics)
+        self.scheduler.add('physics', self.physicsTask, priority = 10)
+        self.scheduler.add('gameplay', self.gameplayTask, self.gameplayRate, priority = 20)
+        self.scheduler.add('metrics', self.metrics.update, 1.0, priority = 90, deferrable = True)
 
     def go(self):
         self._createWorld()
@@ -32,25 +123,65 @@ class Engine:
     
     def _createWorld(self):
         self.world = ode.World()
-        self.world.setQuickStepNumIterations(5)
+        self.setIterations(self.iterations)
         self.world.setGravity((0,-9.81,0))
-        self.space = ode.QuadTreeSpace((0,0,0),(1,1,0.1),8)
-        #self.space = ode.HashSpace()
-        #self.space.setLevels(1,20)
+        # Walls never move, so they get a space of their own that is only
+        # ever collided against the dynamic one. Static-static pairs are
+        # never even considered.
+        self.staticSpace = ode.HashSpace()
         self.contactgroup = ode.JointGroup()
-        self.objects = []
+        self.objects = ObjectRegistry()
         self.limboObjects = []
         self.statics = []
 
-        f = open('dm_arena.lvl', 'r')
-        for line in f:
-            line = line.strip()
-            if not line.startswith('#') and len(line) != 0:
-                size, loc, rot = [[float(y) for y in x.strip('()').split(',')] for x in line.split(":")]
-                static = self.createStaticObject(size)
-                static.setPosition(loc)
-                static.setRotation(rot)
-                self.statics += [static]
+        self.loadLevel('dm_arena.lvl')
+        self.bounds = self.levelBounds()
+        self.space = self.createBroadphase(self.broadphase, self.bounds)
+        self.staticIndex = self.level.staticIndex(self.statics)
+        self.query = WorldQuery(self.staticIndex, self.objects, self.metrics)
+        self.projectiles = ProjectileSystem(self)
+        self.shrapnel = Shrapnel(self)
+        self.pool = ObjectPool(self.metrics)
+
+    def loadLevel(self, path):
+        # Loads the compiled copy, see level.py
+        self.level = level.load(path)
+        for size, loc, rot in self.level.boxes:
+            static = self.createStaticObject(size)
+            static.setPosition(loc)
+            static.setRotation(rot)
+            self.statics += [static]
+
+    def levelBounds(self):
+        # (minX, maxX, minY, maxY) around every static, plus a margin
+        if not self.level.bounds:
+            return (-50.0, 50.0, -50.0, 50.0)
+        minX, maxX, minY, maxY = self.level.bounds
+        m = self.boundsMargin
+        return (minX - m, maxX + m, minY - m, maxY + m)
+
+    def createBroadphase(self, kind, bounds):
+        minX, maxX, minY, maxY = bounds
+        if kind == 'quadtree':
+            # ODE wants the centre and the half extents of the root block
+            center = ((minX + maxX)/2, (minY + maxY)/2, 0)
+            extents = ((maxX - minX)/2, (maxY - minY)/2, 1.0)
+            largest = max(maxX - minX, maxY - minY)
+            depth = int(math.ceil(math.log(largest / self.broadphaseCellSize, 2)))
+            return ode.QuadTreeSpace(center, extents, max(1, min(depth, 8)))
+        elif kind == 'hash':
+            space = ode.HashSpace()
+            # Cells from bullet sized to a few players wide
+            space.setLevels(-2, int(math.ceil(math.log(self.broadphaseCellSize, 2))) + 1)
+            return space
+        elif kind == 'simple':
+            return ode.SimpleSpace()
+        elif kind == 'sap':
+            if hasattr(ode, 'SweepAndPruneSpace'):
+                return ode.SweepAndPruneSpace()
+            print "Sweep and prune broadphase not available in this ODE, using a hash space"
+            return self.createBroadphase('hash', bounds)
+        raise ValueError("Unknown broadphase %s" % kind)
 
     def createStaticObject(self, size):
         return StaticObject(self, "s%s" % len(self.statics), size=size)
@@ -74,79 +205,171 @@ class Engine:
         print "%s: %s" % (source, message)
 
     def addBullet(self, t, name, position, direction, velocity, damage, owner):
-        match = [object for object in self.objects if object._name == name]
-        if len(match) == 0:
+        match = self.objects.get(name)
+        if match is None:
             b = None
-            if t == SHRAPNEL:
-                b = self.createShrapnelObject(name, direction, velocity, damage)
-            elif t == BULLET:
-                b = self.createBulletObject(name, direction, velocity, damage)
-            elif t == GRENADE:
-                b = self.createGrenadeObject(name, direction, velocity, damage)
-            elif t == LASER:
-                b = self.createLaserObject(name, direction, velocity, damage)
+            if self.analyticProjectiles and (t == BULLET or t == SHRAPNEL or t == LASER):
+                b = self.projectiles.spawn(t, name, direction, velocity, damage)
             else:
-                print "BUG: Unknown object type", t
+                b = self.pool.acquire(t)
+                if b is not None:
+                    b.reinit(name, direction, velocity, damage)
+                elif t == SHRAPNEL:
+                    b = self.createShrapnelObject(name, direction, velocity, damage)
+                elif t == BULLET:
+                    b = self.createBulletObject(name, direction, velocity, damage)
+                elif t == GRENADE:
+                    b = self.createGrenadeObject(name, direction, velocity, damage)
+                elif t == LASER:
+                    b = self.createLaserObject(name, direction, velocity, damage)
+                else:
+                    print "BUG: Unknown object type", t
             b.setPosition(position)
             b.setOwnerName(owner)
-            self.objects += [b]
+            self.objects.add(b)
+            self._spawned.value += 1
             return b
         else:
-            return match[0]
+            return match
+
+    def grenadeExploded(self, grenade):
+        if self.remoteExplosions:
+            return
+        if self.physicalShrapnel:
+            self.shrapnel.fire(grenade._name, grenade.ownerName, grenade.explodePos, grenade.seed)
+        else:
+            self.shrapnel.resolve(grenade.ownerName, grenade.explodePos, grenade.seed)
         
     def frameEnded(self, frameTime):
-        timer = encode.timer()
-        timer.start()
-        self.timeUntilNextEngineUpdate -= frameTime
-        self.step()     
+        start = clock()
         self.debugFrameTime = frameTime
-
-        for object in self.objects:
-            object.frameEnded(frameTime)
-        timer.stop()
-        self.debugStepTime = timer.time()
+        self._frameTime.add(frameTime)
+        self.scheduler.update(frameTime)
+        self.debugStepTime = clock() - start
+        self._stepTime.add(self.debugStepTime)
 
         return True # Keep going
 
+    def physicsTask(self, elapsed):
+        self.timeUntilNextEngineUpdate -= elapsed
+        self.step()
+
+    def gameplayTask(self, elapsed):
+        for object in self.objects:
+            object.frameEnded(elapsed)
+
     def spawnLocation(self):
-        return random.choice([
-            (0.0,20.0,0.0),
-            (30.0,55.0,0.0),
-            (-19.0,45.0,0.0),
-            (-23.0,22.0,0.0),
-            (0.0,20.0,0.0),
-            (0.0,20.0,0.0)
-            ])
+        locations = list(self.SPAWN_LOCATIONS)
+        random.shuffle(locations)
+        # Whoever spawned since the last step counts too
+        self.query.invalidate()
+        # Failing anywhere clear, wherever the nearest person is furthest
+        best = None
+        for location in locations:
+            nearest = self.query.nearest(location[0], location[1], 1, PERSON)
+            if not nearest or nearest[0][0] > self.spawnClearance:
+                return location
+            if best is None or nearest[0][0] > best[0]:
+                best = (nearest[0][0], location)
+        return best[1]
 
     def step(self):
         self.debugNumSteps = 0
         while self.timeUntilNextEngineUpdate <= 0.0:
+            if self.debugNumSteps == self.maxStepsPerFrame:
+                self.catchUpLater()
+                return
             self.debugNumSteps += 1
-            for o in self.objects:
-                o.preCollide()
-            self.space.collide(0, self.collision_callback)            
-            for o in self.objects:
-                o.preStep()
-            self.world.quickStep(self.stepSize)
-            
-            for o in self.objects[:]:
-                o.postStep()
+            self.stepOnce()
+            self.timeUntilNextEngineUpdate += self.stepSize
+        if self.backlog:
+            self.backlog = 0.0
+            self._backlog.set(0.0)
+        if self.adaptiveIterations and self.currentIterations < self.iterations:
+            self.timeUntilRecovery -= self.debugNumSteps * self.stepSize
+            if self.timeUntilRecovery <= 0.0:
+                self.setIterations(self.currentIterations + 1)
 
-            for o in self.objects[:]:
-                if o.isDead():
-                    if o.type != PERSON:
-                        self.objects.remove(o)
-                        o.close()
-                        del o
+    def catchUpLater(self):
+        """Called by step once it's run maxStepsPerFrame steps and is still
+        behind."""
+        behind = -self.timeUntilNextEngineUpdate
+        kept = 0.0
+        if self.catchUp == DILATE:
+            kept = min(behind, self.maxBacklog)
+        dropped = behind - kept
+        # Only what the backlog grew by is new, the rest was already counted
+        dilated = max(0.0, kept - self.backlog)
+        self.timeUntilNextEngineUpdate = -kept
+        self.backlog = kept
+        self._backlog.set(kept)
+        # Frames that are just working off the backlog haven't fallen any
+        # further behind
+        if dropped <= 0.0 and dilated <= 0.0:
+            return
+        self._fellBehind.inc()
+        self._droppedTime.inc(dropped)
+        self._dilatedTime.inc(dilated)
+        self.timeUntilRecovery = self.recoveryTime
+        if self.adaptiveIterations and self.currentIterations > self.minIterations:
+            self.setIterations(self.currentIterations - 1)
+        self.fellBehind(dropped, dilated)
 
-            self.contactgroup.empty()
-            self.timeUntilNextEngineUpdate += self.stepSize
+    def fellBehind(self, dropped, dilated):
+        """Seconds of game time just dropped, and just put off till later."""
+        pass
+
+    def setIterations(self, iterations):
+        self.currentIterations = iterations
+        self.world.setQuickStepNumIterations(iterations)
+        self._iterations.set(iterations)
+        self.timeUntilRecovery = self.recoveryTime
+
+    def stepOnce(self):
+        for histogram, phase in self._phases:
+            start = clock()
+            phase()
+            histogram.add(clock() - start)
+        self.contactgroup.empty()
+        self.query.invalidate()
+
+    def preCollidePhase(self):
+        for o in self.objects:
+            o.preCollide()
+
+    def collidePhase(self):
+        ode.collide2(self.staticSpace, self.space, 0, self.collision_callback)
+        self.space.collide(0, self.collision_callback)
+
+    def preStepPhase(self):
+        for o in self.objects:
+            o.preStep()
+
+    def quickStepPhase(self):
+        self.world.quickStep(self.stepSize)
+
+    def projectilesPhase(self):
+        self.projectiles.step(self.stepSize)
+
+    def postStepPhase(self):
+        for o in self.objects:
+            o.postStep()
+
+    def reapPhase(self):
+        for o in self.objects:
+            if o.isDead():
+                if o.type != PERSON:
+                    self.objects.remove(o)
+                    self._reaped.value += 1
+                    if not self.pool.release(o):
+                        o.close()
+                    del o
 
     def addScore(self, name, amount):
         # TODO: Add to Player object
-        for object in self.objects:
-            if object._name == name:
-                object.score += amount
+        object = self.objects.get(name)
+        if object:
+            object.score += amount
 
     def collision_callback(self, args, geom1, geom2):
         o1 = geom1.object
@@ -156,6 +379,7 @@ class Engine:
             print "BUG! Probably not deleting some object properly", type(o1), type(o2)
             return
 
+        self._collisionPairs.value += 1
         if o1 == o2:
             contacts = []
         else:
@@ -169,21 +393,10 @@ class Engine:
             
             for a,b,geom in [[o1,o2,geom2],[o2,o1,geom1]]:
                 a.hitObject(b, contact.getContactGeomParams()[0])
-                if a.type == GRENADE or a.type == BULLET or a.type == LASER:
+                if a.type == GRENADE or a.type == BULLET or a.type == SHRAPNEL or a.type == LASER:
                     contact.setBounce(1.0)
                     contact.setMu(0.0)
-                    if a.isDead() and b.type == PERSON:
-                        print "Hit",b._name, "on the", geom.location
-                        if not b.isDead():
-                            b.doDamage(a.damage)
-                            if b.isDead():
-                                b.setSpawnPosition(self.spawnLocation())
-                                if a.ownerName == b._name:
-                                    self.engineMessageListener(a.ownerName + " committed suicide")
-                                    self.addScore(a.ownerName, -1)
-                                else:
-                                    self.engineMessageListener(a.ownerName + " killed " + b.ownerName)
-                                    self.addScore(a.ownerName, 1)
+                    self.resolveHit(a, b, geom.location)
                     
             # Assume that if collision normal is facing up we are 'on ground'
             normal = contact.getContactGeomParams()[1]
@@ -193,7 +406,36 @@ class Engine:
                 o1.isOnGround = True
 
             joint = ode.ContactJoint(self.world, self.contactgroup, contact)
+            self._contacts.value += 1
             joint.attach(geom1.getBody(), geom2.getBody())
 
+    def hitboxesSeenBy(self, name):
+        """Every Person's hitboxes as (person, hitboxes), where the player
+        called name saw them. Without lag compensation that's where they are."""
+        return [(person, person.getHitboxes()) for person in self.objects.ofType(PERSON)]
+
+    def resolveHit(self, projectile, victim, location):
+        # Damage and scoring once a projectile has hit something, for both the
+        # ODE collision callback and the ProjectileSystem
+        if projectile.type != GRENADE and projectile.type != BULLET and \
+           projectile.type != SHRAPNEL and projectile.type != LASER:
+            return
+        if projectile.isDead() and victim.type == PERSON:
+            print "Hit",victim._name, "on the", location
+            self.damage(victim, projectile.damage, projectile.ownerName)
+
+    def damage(self, victim, amount, ownerName):
+        # Scores the kill if it was one
+        if not victim.isDead():
+            victim.doDamage(amount)
+            if victim.isDead():
+                victim.setSpawnPosition(self.spawnLocation())
+                if ownerName == victim._name:
+                    self.engineMessageListener(ownerName + " committed suicide")
+                    self.addScore(ownerName, -1)
+                else:
+                    self.engineMessageListener(ownerName + " killed " + victim.ownerName)
+                    self.addScore(ownerName, 1)
+
     def engineMessageListener(self, message):
         pass
@@ -188,6 +188,9 @@ class BulletObject(objects.BulletObject, SphereObject):
         self.reset()
 
     def reset(self):        
+        # A pooled bullet gets a new name each time it's fired, the scene
+        # nodes keep the one they were created with
+        self._resourceName = self._name
         self.trail = self._gameworld.sceneManager.createRibbonTrail("bb" + self._name)
         self.trailNode = self._gameworld.sceneManager.getRootSceneNode().createChildSceneNode('t' + self._name)
         self.trailNode.attachObject(self.trail)
@@ -227,6 +230,24 @@ class BulletObject(objects.BulletObject, SphereObject):
             self.trail.addNode(self._node)
             self.trail.addNode(self._node2)
 
+    def reinit(self, name, direction = None, velocity = None, damage = 1):
+        objects.BulletObject.reinit(self, name, direction, velocity, damage)
+        self._resetTrail()
+
+    def _resetTrail(self):
+        # Called from objects.BulletObject.__init__ before there's a trail
+        if hasattr(self, 'trail'):
+            if self.hasTrail:
+                self.trail.removeNode(self._node)
+                self.trail.removeNode(self._node2)
+            self.trail.clearAllChains()
+            self.trailNode.setVisible(True)
+            self.hasTrail = False
+
+    def deactivate(self):
+        objects.BulletObject.deactivate(self)
+        self.trailNode.setVisible(False)
+
     def close(self):
         SphereObject.close(self)
         objects.BulletObject.close(self)
@@ -252,8 +273,9 @@ class BulletObject(objects.BulletObject, SphereObject):
         self.numSteps += 1
         
     def __del__(self):
-        self._gameworld.sceneManager.destroyRibbonTrail("bb" + self._name)
-        self._gameworld.sceneManager.getRootSceneNode().removeAndDestroyChild('t' + self._name)
+        self._name = self._resourceName
+        self._gameworld.sceneManager.destroyRibbonTrail("bb" + self._resourceName)
+        self._gameworld.sceneManager.getRootSceneNode().removeAndDestroyChild('t' + self._resourceName)
         SphereObject.__del__(self)
         objects.BulletObject.__del__(self)
 
@@ -271,6 +293,10 @@ class ShrapnelObject(objects.ShrapnelObject, BulletObject):
         objects.ShrapnelObject.__init__(self, gameworld, name, direction, velocity, damage)
         BulletObject.reset(self)
 
+    def reinit(self, name, direction = None, velocity = None, damage = 1):
+        objects.ShrapnelObject.reinit(self, name, direction, velocity, damage)
+        self._resetTrail()
+
     def hitObject(self, other, position):
         objects.ShrapnelObject.hitObject(self, other, position)
         if other.type != objects.STATIC or self.ricochetTime <= 0:
@@ -335,6 +361,16 @@ class GrenadeObject(objects.GrenadeObject, BulletObject):
         objects.GrenadeObject.frameEnded(self, time)
         BulletObject.frameEnded(self, time)
 
+    def reinit(self, name, direction = None, velocity = None, damage = 1):
+        objects.GrenadeObject.reinit(self, name, direction, velocity, damage)
+        self._resetTrail()
+        if hasattr(self, 'light'):
+            self.light.setVisible(True)
+
+    def deactivate(self):
+        BulletObject.deactivate(self)
+        self.light.setVisible(False)
+
     def close(self):
         self._geometry.object = None
         self.light.setVisible(False)
@@ -608,6 +644,10 @@ class Person(objects.Person, SphereObject):
         self._node.setPosition(p[0]+o[0], p[1]+o[1], p[2]+o[2])
 
 class Player(Person):
+    # Drawn this far from the body while a prediction correction is smoothed
+    # out, see prediction.py
+    displayOffset = (0.0, 0.0, 0.0)
+
     def __init__(self, gameworld, name, camera):
         super(Player, self).__init__(gameworld, name, camera)
         
@@ -670,8 +710,8 @@ class Player(Person):
             camPosY = CEGUI.MouseCursor.getSingleton().getPosition().d_y
             camPosZ = 20
         else:
-            camPosX = self._body.getPosition()[0]
-            camPosY = self._body.getPosition()[1]
+            camPosX = self._body.getPosition()[0] + self.displayOffset[0]
+            camPosY = self._body.getPosition()[1] + self.displayOffset[1]
             camPosZ = (self._camera.getPosition()[2] + self.guns[self.gunName]['zoom'])/2
             
         self._camera.setPosition((camPosX,camPosY,camPosZ))
@@ -716,6 +756,12 @@ class Player(Person):
 
         Person.frameEnded(self, frameTime)
 
+    def _updateDisplay(self):
+        p = self._geometry.getPosition()
+        o = self._nodeOffset
+        d = self.displayOffset
+        self._node.setPosition(p[0]+o[0]+d[0], p[1]+o[1]+d[1], p[2]+o[2]+d[2])
+
     def getDirection(self):
         if self._camera:
             direction = self._camera.getDirection()
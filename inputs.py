@@ -0,0 +1,106 @@
+# Player input as a stream of commands, one per physics tick. The client
+# numbers each tick's input and every packet carries the last few, so a
+# lost packet is made up for by the next one. The server keeps them in a
+# ring by number and takes exactly one off per physics tick.
+#
+# An input message is ["i", sequence of the newest input, inputs oldest
+# first, last snapshot received], each input being [direction, presses].
+
+class InputHistory(object):
+    """The client's end, the inputs it has made so far."""
+    def __init__(self, redundancy = 24):
+        self.redundancy = redundancy
+        self.sequence = -1
+        self.inputs = []
+
+    def add(self, presses):
+        self.sequence += 1
+        self.inputs.append(presses)
+        if len(self.inputs) > self.redundancy:
+            del self.inputs[0]
+
+    def message(self, acknowledged):
+        return ["i", self.sequence, list(self.inputs), acknowledged]
+
+class InputBuffer(object):
+    """The server's end for one client."""
+    def __init__(self, metrics, size = 64, maxLag = 32, targetLag = 2):
+        self.size = size
+        self.ring = [None] * size
+        # If the client gets more than maxLag ticks ahead of what's been
+        # applied skip forward to targetLag behind it
+        self.maxLag = maxLag
+        self.targetLag = targetLag
+        self.newest = None
+        self.applied = None
+        self.last = None
+        self._late = metrics.counter('net.input.late')
+        self._missing = metrics.counter('net.input.missing')
+        self._starved = metrics.counter('net.input.starved')
+        self._skipped = metrics.counter('net.input.skipped')
+
+    def receive(self, sequence, inputs):
+        if self.applied is None:
+            self.applied = sequence - 1
+            self.newest = sequence - 1
+        elif sequence <= self.applied:
+            # Everything in it has been applied or given up on
+            self._late.value += 1
+            return
+        first = sequence - len(inputs) + 1
+        ring = self.ring
+        size = self.size
+        for s in range(max(first, self.applied + 1, sequence - size + 1), sequence + 1):
+            entry = ring[s % size]
+            if entry is None or entry[0] != s:
+                ring[s % size] = (s, inputs[s - first])
+        if sequence > self.newest:
+            self.newest = sequence
+
+    def next(self):
+        """The input for this physics tick, None if there hasn't been one."""
+        if self.applied is None:
+            return None
+        s = self.applied + 1
+        if s > self.newest:
+            # Nothing for this tick yet, carry on doing what they were doing
+            self._starved.value += 1
+            return self.last
+        if self.newest - s > self.maxLag:
+            skip = self.newest - self.targetLag - s
+            self._skipped.value += skip
+            s += skip
+        self.applied = s
+        entry = self.ring[s % self.size]
+        if entry is not None and entry[0] == s:
+            self.last = entry[1]
+        else:
+            # Lost even with the redundancy
+            self._missing.value += 1
+        return self.last
+
+class InputRecorder(object):
+    """Writes every tick's input to a file, one line each, for loadgen.py to
+    play back."""
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def add(self, presses):
+        direction, keys = presses[0], presses[1]
+        self.file.write("%.4f %.4f %i\n" % (direction[0], direction[1], keys))
+
+    def close(self):
+        self.file.close()
+
+def loadRecording(path):
+    """What an InputRecorder wrote, [[direction, presses], ...]."""
+    inputs = []
+    f = open(path)
+    try:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3:
+                inputs.append([(float(fields[0]), float(fields[1]), 0), int(fields[2])])
+    finally:
+        f.close()
+    return inputs
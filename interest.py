@@ -0,0 +1,107 @@
+# Area of interest. Each client is only sent what its player's camera can
+# see, plus a margin. Other people are still sent because they're on the
+# scoreboard, but their records only move on every few updates, so in
+# between the delta against the baseline is empty. Projectiles are only
+# sent if they're in view, but bullets, grenades and lasers are only ever
+# sent once, when they're fired, so those are sent if where they'll fly
+# over the next few seconds crosses the view, even if they start out of it.
+
+from spatial import SpatialHash, segmentBox
+from snapshot import Snapshot
+from objects import PERSON
+from projectiles import PROPERTIES
+
+class InterestIndex(object):
+    """Where everything in a snapshot is, built once per network update and
+    shared by every client."""
+    # How far ahead things only sent once are followed, a grenade's whole
+    # fuse, and how many straight pieces that's cut into
+    flightTime = 3.0
+    flightSteps = 6
+    gravity = -9.81
+
+    def __init__(self, snapshot, cellSize = 16.0):
+        self.snapshot = snapshot
+        self.hash = SpatialHash(cellSize)
+        self.order = {}
+        self.people = []
+        # (name, points along where it'll fly) for each thing sent once
+        self.once = []
+        for i, name in enumerate(snapshot.names):
+            attributes, type = snapshot.objects[name]
+            position = attributes[0]
+            self.hash.insert(name, position[0], position[1])
+            self.order[name] = i
+            if type == PERSON:
+                self.people.append(name)
+            elif name in snapshot.once:
+                self.once.append((name, self.path(attributes, type)))
+
+    def path(self, attributes, type):
+        """Where something fired with attributes [position, velocity, ...]
+        will be over flightTime, if nothing stops it. Air resistance only
+        makes it fall short, so this goes at least as far."""
+        (x, y), (vx, vy) = attributes[0], attributes[1]
+        g = self.gravity
+        if type in PROPERTIES and not PROPERTIES[type][2]:
+            g = 0.0
+        step = self.flightTime / self.flightSteps
+        points = []
+        for i in range(self.flightSteps + 1):
+            t = i * step
+            points.append((x + vx*t, y + vy*t + 0.5*g*t*t))
+        return points
+
+def crosses(points, x, y, halfWidth, halfHeight):
+    """Whether the path through points passes through the box."""
+    for i in range(len(points) - 1):
+        x0, y0 = points[i]
+        x1, y1 = points[i + 1]
+        if segmentBox(x0, y0, x1 - x0, y1 - y0, x, y, halfWidth, halfHeight) is not None:
+            return True
+    return False
+
+class Interest(object):
+    """What one client has been told about the people it can't see."""
+    def __init__(self, farInterval = 5):
+        self.farInterval = farInterval
+        self.far = {}
+        self.updates = 0
+
+    def filter(self, index, player, margin):
+        snapshot = index.snapshot
+        own = snapshot.objects.get(player._name)
+        if own is None:
+            return snapshot
+        x, y = own[0][0][0], own[0][0][1]
+        halfWidth, halfHeight = player.viewExtents()
+        halfWidth += margin
+        halfHeight += margin
+        visible = {}
+        for name in index.hash.query(x - halfWidth, x + halfWidth, y - halfHeight, y + halfHeight):
+            visible[name] = True
+        visible[player._name] = True
+        for name, points in index.once:
+            if name not in visible and crosses(points, x, y, halfWidth, halfHeight):
+                visible[name] = True
+
+        self.updates += 1
+        refresh = self.updates % self.farInterval == 0
+        far = {}
+        for name in index.people:
+            if name not in visible:
+                record = self.far.get(name)
+                if record is None or refresh:
+                    record = snapshot.objects[name]
+                far[name] = record
+        self.far = far
+
+        # Same order as the full snapshot, it's the order clients create
+        # things in
+        names = visible.keys() + far.keys()
+        order = index.order
+        names.sort(key = order.__getitem__)
+        objects = {}
+        for name in names:
+            objects[name] = far.get(name) or snapshot.objects[name]
+        return Snapshot(names, objects)
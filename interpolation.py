@@ -0,0 +1,111 @@
+# Draws other people where they were a little while ago on the server
+# rather than where the last snapshot said they were. Each snapshot's
+# attributes are kept by the server time it was sent at, and every frame
+# the client asks for the state at server time minus a delay, which falls
+# between two snapshots if the delay is at least the time between them plus
+# however late packets turn up. When snapshots stop coming the last one is
+# carried forward along its velocity, but not for long.
+
+import math
+
+# DynamicObject.getAttributes
+POSITION = 0
+QUATERNION = 1
+ANGULAR_VELOCITY = 2
+LINEAR_VELOCITY = 3
+DIRECTION = 4
+
+def lerp(a, b, t):
+    return [x + (y - x)*t for x, y in zip(a, b)]
+
+def nlerp(a, b, t):
+    """Blends two rotations, quaternions or unit vectors, the short way round."""
+    if sum([x*y for x, y in zip(a, b)]) < 0:
+        b = [-y for y in b]
+    result = lerp(a, b, t)
+    length = math.sqrt(sum([x*x for x in result]))
+    if length == 0:
+        return list(b)
+    return [x/length for x in result]
+
+def interpolate(a, b, t):
+    """Attributes t of the way from a to b. Anything that isn't a position,
+    rotation or velocity comes from a."""
+    result = list(a)
+    result[POSITION] = lerp(a[POSITION], b[POSITION], t)
+    result[QUATERNION] = nlerp(a[QUATERNION], b[QUATERNION], t)
+    result[ANGULAR_VELOCITY] = lerp(a[ANGULAR_VELOCITY], b[ANGULAR_VELOCITY], t)
+    result[LINEAR_VELOCITY] = lerp(a[LINEAR_VELOCITY], b[LINEAR_VELOCITY], t)
+    result[DIRECTION] = nlerp(a[DIRECTION], b[DIRECTION], t)
+    return result
+
+def extrapolate(a, elapsed):
+    result = list(a)
+    velocity = a[LINEAR_VELOCITY]
+    result[POSITION] = [x + v*elapsed for x, v in zip(a[POSITION], velocity)]
+    return result
+
+class SnapshotBuffer(object):
+    def __init__(self, delay = 0.1, minDelay = 0.05, maxDelay = 0.35, maxExtrapolation = 0.1, size = 32):
+        self.delay = delay
+        self.minDelay = minDelay
+        self.maxDelay = maxDelay
+        self.maxExtrapolation = maxExtrapolation
+        self.size = size
+        # name -> [(server time, attributes), ...] oldest first
+        self.states = {}
+        self.lastTime = None
+        # Time between snapshots, and our idea of local time minus server
+        # time, both smoothed
+        self.interval = 1/15.0
+        self.offset = None
+
+    def add(self, serverTime, name, attributes):
+        states = self.states.setdefault(name, [])
+        if states and serverTime <= states[-1][0]:
+            return
+        states.append((serverTime, attributes))
+        if len(states) > self.size:
+            del states[0]
+        if self.lastTime is not None and serverTime > self.lastTime:
+            self.interval += (serverTime - self.lastTime - self.interval) * 0.1
+        if self.lastTime is None or serverTime > self.lastTime:
+            self.lastTime = serverTime
+
+    def forget(self, name):
+        self.states.pop(name, None)
+
+    def names(self):
+        return self.states.keys()
+
+    def adapt(self, jitter):
+        """Moves the delay towards a snapshot interval plus enough for the
+        jitter measured by the pings."""
+        target = min(self.maxDelay, max(self.minDelay, self.interval + 2*jitter + 0.01))
+        self.delay += (target - self.delay) * 0.05
+
+    def renderTime(self, now, serverOffset):
+        """The server time to draw at. The offset from the pings jumps about
+        by the jitter, so it's smoothed to stop everything stuttering."""
+        if self.offset is None or abs(serverOffset - self.offset) > 1.0:
+            self.offset = serverOffset
+        else:
+            self.offset += (serverOffset - self.offset) * 0.05
+        return now - self.offset - self.delay
+
+    def sample(self, name, time):
+        """name's attributes at server time time, None if we know nothing
+        about it."""
+        states = self.states.get(name)
+        if not states:
+            return None
+        if time <= states[0][0]:
+            return states[0][1]
+        for i in range(len(states) - 1, 0, -1):
+            if states[i - 1][0] <= time:
+                a, b = states[i - 1], states[i]
+                if time > b[0]:
+                    break
+                return interpolate(a[1], b[1], (time - a[0]) / (b[0] - a[0]))
+        newest = states[-1]
+        return extrapolate(newest[1], min(time - newest[0], self.maxExtrapolation))
@@ -0,0 +1,254 @@
+# Levels are written by hand as text (see dm_arena.lvl) but loaded from a
+# compiled binary copy that sits next to them (dm_arena.lvlc). The compiled
+# copy has touching and overlapping axis aligned boxes merged together, the
+# bounds of the level and a grid of which boxes are in which cell, laid out so
+# the grid can be read out of a memory map in a couple of unpacks. It is
+# rebuilt whenever the text file changes.
+
+import os, struct, mmap
+from spatial import StaticBox, StaticIndex, quaternionToAngle
+
+MAGIC = 'AVLV'
+VERSION = 1
+
+# magic, version, source size, source mtime, number of boxes, bounds
+HEADER = struct.Struct('<4sIqdI4d')
+# size, position, rotation (w, x, y, z)
+BOX = struct.Struct('<10d')
+# cell size, first cell x, first cell y, cells across, cells down, indices
+GRID = struct.Struct('<diiIII')
+UINT = struct.calcsize('<I')
+
+# Grid cell size for the static index, a few players across
+cellSize = 4.0
+
+# How close two faces have to be to count as touching
+epsilon = 1e-6
+
+def parse(path):
+    """Boxes from a text level as (size, position, rotation) lists."""
+    boxes = []
+    f = open(path, 'r')
+    try:
+        for line in f:
+            line = line.strip()
+            if not line.startswith('#') and len(line) != 0:
+                boxes.append([[float(y) for y in x.strip('()').split(',')] for x in line.split(":")])
+    finally:
+        f.close()
+    return boxes
+
+def isAxisAligned(box):
+    rotation = box[2]
+    return rotation[1] == 0 and rotation[2] == 0 and rotation[3] == 0
+
+def _extents(box):
+    size, position = box[0], box[1]
+    return [(position[i] - size[i]/2.0, position[i] + size[i]/2.0) for i in range(3)]
+
+def _fromExtents(extents, rotation):
+    return [[high - low for low, high in extents],
+            [(low + high)/2.0 for low, high in extents],
+            list(rotation)]
+
+def _contains(outer, inner):
+    for (outerLow, outerHigh), (innerLow, innerHigh) in zip(outer, inner):
+        if innerLow < outerLow - epsilon or innerHigh > outerHigh + epsilon:
+            return False
+    return True
+
+def mergePair(a, b):
+    """The single box covering exactly a and b, or None if there isn't one."""
+    if not isAxisAligned(a) or not isAxisAligned(b):
+        return None
+    ea = _extents(a)
+    eb = _extents(b)
+    if _contains(ea, eb):
+        return a
+    if _contains(eb, ea):
+        return b
+    # Boxes only merge cleanly if they line up on every axis but one and
+    # touch or overlap along that one
+    differing = [i for i in range(3)
+                 if abs(ea[i][0] - eb[i][0]) > epsilon or abs(ea[i][1] - eb[i][1]) > epsilon]
+    if len(differing) != 1:
+        return None
+    i = differing[0]
+    if ea[i][0] > eb[i][1] + epsilon or eb[i][0] > ea[i][1] + epsilon:
+        return None
+    extents = list(ea)
+    extents[i] = (min(ea[i][0], eb[i][0]), max(ea[i][1], eb[i][1]))
+    return _fromExtents(extents, a[2])
+
+def mergeBoxes(boxes):
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        i = 0
+        while i < len(boxes):
+            j = i + 1
+            while j < len(boxes):
+                box = mergePair(boxes[i], boxes[j])
+                if box is not None:
+                    boxes[i] = box
+                    del boxes[j]
+                    merged = True
+                else:
+                    j += 1
+            i += 1
+    return boxes
+
+def _staticBoxes(boxes, statics = None):
+    result = []
+    for i, (size, position, rotation) in enumerate(boxes):
+        static = None
+        if statics is not None:
+            static = statics[i]
+        result.append(StaticBox(position[0], position[1], size[0]/2.0, size[1]/2.0,
+                                quaternionToAngle(rotation), static))
+    return result
+
+def readCells(data, offset, firstX, firstY, width, height):
+    """The cells of a StaticIndex from a compiled level, as the dictionary
+    StaticIndex would have built. Cell (x, y) owns the indices between
+    offsets[k] and offsets[k+1]. They're unpacked in one go rather than
+    cell by cell on lookup, cells are looked up for every ray."""
+    numCells = width*height
+    offsets = struct.unpack_from('<%iI' % (numCells + 1), data, offset)
+    offset += (numCells + 1)*UINT
+    indices = struct.unpack_from('<%iI' % offsets[-1], data, offset)
+    cells = {}
+    k = 0
+    for y in range(firstY, firstY + height):
+        for x in range(firstX, firstX + width):
+            start, end = offsets[k], offsets[k + 1]
+            if start != end:
+                cells[(x, y)] = indices[start:end]
+            k += 1
+    return cells
+
+class Level(object):
+    def __init__(self, boxes, bounds, cells, cellSize = cellSize):
+        self.boxes = boxes
+        self.bounds = bounds
+        self.cells = cells
+        self.cellSize = cellSize
+
+    def staticIndex(self, statics):
+        """A StaticIndex over the statics created from self.boxes, in order."""
+        return StaticIndex(_staticBoxes(self.boxes, statics), self.cellSize, self.cells)
+
+def compileLevel(path):
+    """Parses and merges a text level, the grid is left as a dictionary."""
+    boxes = mergeBoxes(parse(path))
+    index = StaticIndex(_staticBoxes(boxes), cellSize)
+    if boxes:
+        aabbs = [box.aabb() for box in index.boxes]
+        bounds = (min([a[0] for a in aabbs]),
+                  max([a[1] for a in aabbs]),
+                  min([a[2] for a in aabbs]),
+                  max([a[3] for a in aabbs]))
+    else:
+        bounds = None
+    return Level(boxes, bounds, index.cells)
+
+def write(level, path, sourceSize, sourceTime):
+    bounds = level.bounds or (0.0, 0.0, 0.0, 0.0)
+    parts = [HEADER.pack(MAGIC, VERSION, sourceSize, sourceTime, len(level.boxes),
+                         bounds[0], bounds[1], bounds[2], bounds[3])]
+    for size, position, rotation in level.boxes:
+        parts.append(BOX.pack(*(list(size) + list(position) + list(rotation))))
+
+    # Flatten the grid into one row after another of offsets into one list
+    # of indices
+    cells = level.cells
+    if cells:
+        xs = [x for x, y in cells.keys()]
+        ys = [y for x, y in cells.keys()]
+        firstX, firstY = min(xs), min(ys)
+        width, height = max(xs) - firstX + 1, max(ys) - firstY + 1
+    else:
+        firstX = firstY = width = height = 0
+    offsets = [0]
+    indices = []
+    for y in range(firstY, firstY + height):
+        for x in range(firstX, firstX + width):
+            indices.extend(cells.get((x, y), ()))
+            offsets.append(len(indices))
+    parts.append(GRID.pack(level.cellSize, firstX, firstY, width, height, len(indices)))
+    parts.append(struct.pack('<%iI' % len(offsets), *offsets))
+    parts.append(struct.pack('<%iI' % len(indices), *indices))
+
+    # Write somewhere else first so a half written file is never picked up
+    temp = "%s.%i" % (path, os.getpid())
+    f = open(temp, 'wb')
+    try:
+        f.write(''.join(parts))
+    finally:
+        f.close()
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp, path)
+    except OSError:
+        # Someone else got there first
+        if os.path.exists(temp):
+            os.remove(temp)
+
+def read(path, sourceSize = None, sourceTime = None):
+    """Maps a compiled level, returns None if it's stale or not one."""
+    f = open(path, 'rb')
+    try:
+        fileSize = os.fstat(f.fileno()).st_size
+        if fileSize < HEADER.size + GRID.size:
+            return None
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    finally:
+        # The map stays valid after the file is closed
+        f.close()
+
+    magic, version, size, time, numBoxes, minX, maxX, minY, maxY = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        return None
+    if sourceSize is not None and (size != sourceSize or time != sourceTime):
+        return None
+
+    offset = HEADER.size
+    boxes = []
+    for i in range(numBoxes):
+        values = BOX.unpack_from(data, offset)
+        boxes.append([list(values[0:3]), list(values[3:6]), list(values[6:10])])
+        offset += BOX.size
+    cellSize, firstX, firstY, width, height, numIndices = GRID.unpack_from(data, offset)
+    offset += GRID.size
+    if offset + (width*height + 1 + numIndices)*UINT > fileSize:
+        return None
+
+    bounds = None
+    if numBoxes:
+        bounds = (minX, maxX, minY, maxY)
+    return Level(boxes, bounds, readCells(data, offset, firstX, firstY, width, height), cellSize)
+
+def compiledPath(path):
+    return path + 'c'
+
+def load(path):
+    """The compiled version of a text level, compiling it first if needed."""
+    stat = os.stat(path)
+    compiled = compiledPath(path)
+    if os.path.exists(compiled):
+        try:
+            level = read(compiled, stat.st_size, stat.st_mtime)
+        except (IOError, OSError, struct.error, mmap.error):
+            level = None
+        if level is not None:
+            return level
+
+    level = compileLevel(path)
+    try:
+        write(level, compiled, stat.st_size, stat.st_mtime)
+    except (IOError, OSError):
+        print "Couldn't write compiled level %s" % compiled
+        return level
+    return read(compiled) or level
@@ -4,6 +4,10 @@ import guiobjects, time
 import console
 
 class ListenClient(Client, Server):
+    PHASES = Server.PHASES
+    # It's the server, its grenades go off by themselves
+    remoteExplosions = False
+
     def __init__(self):
         Client.__init__(self, True)
         Server.__init__(self)
@@ -14,20 +18,22 @@ class ListenClient(Client, Server):
         self.player = guiobjects.Player(self, "p%i" % self.clientNumber, self.camera)
         self.chat.setNickName(self.player._name)
         self.player.setPosition(self.spawnLocation())
-        self.objects += [self.player]
+        self.objects.add(self.player)
         print "Self", self.player._name, "connected"
         self._stepNumber = 0
         self._startTime = time.time()
 
         bot = guiobjects.Person(self, "b1")
         bot.setPosition(self.spawnLocation())
-        self.objects += [bot]
+        self.objects.add(bot)
+        self.bots.add(bot)
 
         console.Console().addLocals({
             'player':self.player,
             'bot':bot,
             'objects':self.objects,
-            'chat':self.chat
+            'chat':self.chat,
+            'metrics':self.metrics
             })
         
     def frameEnded(self, frameTime, keyboard, mouse, joystick):
@@ -37,6 +43,10 @@ class ListenClient(Client, Server):
         self.player.inputPresses(self.player.input(keyboard, mouse, joystick))
         return True # Keep going
         
+    def inputPhase(self):
+        # Our own player's input goes straight in, this is for everyone else
+        Server.inputPhase(self)
+
     def networkUpdate(self):
         for o in self.objects:
             o.setEvents(o.getEvents())
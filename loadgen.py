@@ -0,0 +1,340 @@
+# Load generator. Runs hundreds of synthetic clients in one process that
+# speak the protocol but do nothing else, no physics, no chat, and no more
+# decoding than it takes to acknowledge snapshots, and adds them to a server
+# a batch at a time, reporting after each batch how long the server's ticks
+# take and how many bytes it's sending.
+#
+# Every client has its own socket, the server tells clients apart by
+# address, but they're all on the one reactor and serviced from one loop
+# that only visits the ones due to send. Input is benchmark.py's scripted
+# bots, or a recording played back at a different point for each client,
+# recorded with python client.py inputs.txt.
+#
+# By default the server runs in this process so its metrics can be read
+# directly. With --connect the clients go to a server somewhere else and
+# only what the clients see is reported. --processes splits the clients
+# over that many processes, the others only run clients.
+#
+# Usage: python loadgen.py [--clients 200] [--step 25] [--ramp 10]
+#                          [--rate 30] [--replay inputs.txt] [--seed 1]
+#                          [--port 10001] [--connect host:port]
+#                          [--processes 1]
+
+import sys, os, time, random, heapq, subprocess
+from optparse import OptionParser
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet import reactor
+from benchmark import ScriptedInput, MIXED
+from inputs import InputHistory, loadRecording
+from reliable import ReliableChannel
+from snapshot import FULL
+from metrics import Metrics
+import protocol
+
+# Same as the engine's
+STEP = 1.0/150.0
+
+class Undecoded(object):
+    """Stands in for a codec on the clients' reliable channels. They don't
+    send anything reliably and only count what they're sent."""
+    def encode(self, data):
+        return data
+
+    def decode(self, data):
+        return data
+
+class RecordedInput(object):
+    """Plays a recording back from offset, round and round."""
+    def __init__(self, recording, offset):
+        self.recording = recording
+        self.index = offset % len(recording)
+
+    def next(self):
+        presses = self.recording[self.index]
+        self.index = (self.index + 1) % len(self.recording)
+        return presses
+
+class SwarmClient(DatagramProtocol):
+    def __init__(self, swarm, script, now):
+        self.swarm = swarm
+        self.script = script
+        self.session = 0
+        self.reliable = ReliableChannel(swarm.undecoded, swarm.metrics)
+        self.inputs = InputHistory()
+        self.sequence = FULL
+        self.started = None
+        self.pings = {}
+        self.pingNumber = 0
+        self.roundTripTime = 0.0
+        self.nextPing = now
+
+    def startProtocol(self):
+        self.transport.connect(*self.swarm.server)
+
+    def connectionRefused(self):
+        pass
+
+    def datagramReceived(self, data, address):
+        swarm = self.swarm
+        swarm._receivedPackets.value += 1
+        swarm._receivedBytes.value += len(data)
+        messages, data = self.reliable.unwrap(data)
+        swarm._reliable.value += len(messages)
+        if not data:
+            return
+        header = protocol.snapshotHeader(data)
+        if header is not None:
+            self.snapshot(header[2])
+            return
+        # Nothing from here on uses the codec's table, all the clients can
+        # share one
+        message = swarm.codec.decode(data)
+        if message[0] == "c":
+            if message[1] != self.session:
+                self.reliable = ReliableChannel(swarm.undecoded, swarm.metrics)
+                self.sequence = FULL
+            self.session = message[1]
+        elif message[0] == "p":
+            sent = self.pings.pop(message[1], None)
+            if sent is not None:
+                self.roundTripTime = time.time() - sent
+                swarm._roundTrip.add(self.roundTripTime)
+        elif len(message) == 7:
+            # A snapshot that fell back to banana
+            self.snapshot(message[3])
+
+    def snapshot(self, sequence):
+        self.swarm._snapshots.value += 1
+        if sequence > self.sequence:
+            self.sequence = sequence
+        if self.started is None:
+            self.started = time.time()
+
+    def send(self, message, now):
+        data = protocol.SESSION.pack(self.session) + \
+               self.reliable.wrap(self.swarm.codec.encode(message), now)
+        self.transport.write(data)
+        self.swarm._sentPackets.value += 1
+        self.swarm._sentBytes.value += len(data)
+
+    def update(self, now):
+        if now >= self.nextPing:
+            self.nextPing = now + self.swarm.timeBetweenPings
+            if not self.session:
+                self.send(["c", 0], now)
+            self.pingNumber += 1
+            self.pings = {self.pingNumber: now}
+            self.send(["p", self.pingNumber, int(self.roundTripTime*100)], now)
+        if self.started is None or not self.session:
+            return
+        # An input for every physics tick since the last time, as if this
+        # were a client running the engine
+        ticks = int((now - self.started) / STEP) - self.inputs.sequence - 1
+        if ticks > self.inputs.redundancy:
+            # Fell behind, carry on from now rather than send more than
+            # one packet can hold
+            self.started += (ticks - self.inputs.redundancy) * STEP
+            ticks = self.inputs.redundancy
+        for i in range(ticks):
+            self.inputs.add(self.script.next())
+        if self.inputs.sequence >= 0:
+            self.send(self.inputs.message(self.sequence), now)
+
+class Swarm(object):
+    def __init__(self, server, rate = 30.0, seed = 1, recording = None):
+        self.server = server
+        self.timeBetweenSends = 1.0 / rate
+        self.timeBetweenPings = 0.5
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.recording = recording
+        self.codec = protocol.Codec()
+        self.undecoded = Undecoded()
+        self.metrics = Metrics()
+        self.clients = []
+        # (next send time, client number)
+        self.due = []
+        self.reactor = reactor
+        self._sentPackets = self.metrics.counter('swarm.sent.packets')
+        self._sentBytes = self.metrics.counter('swarm.sent.bytes')
+        self._receivedPackets = self.metrics.counter('swarm.received.packets')
+        self._receivedBytes = self.metrics.counter('swarm.received.bytes')
+        self._snapshots = self.metrics.counter('swarm.snapshots')
+        self._reliable = self.metrics.counter('swarm.reliable')
+        self._roundTrip = self.metrics.histogram('swarm.roundTrip')
+        self._update = self.metrics.histogram('swarm.update')
+
+    def add(self, count):
+        now = time.time()
+        for i in range(count):
+            number = len(self.clients)
+            if self.recording:
+                script = RecordedInput(self.recording, self.random.randint(0, len(self.recording)))
+            else:
+                script = ScriptedInput(self.seed * 1000 + number, MIXED[number % len(MIXED)])
+            client = SwarmClient(self, script, now)
+            self.reactor.listenUDP(0, client)
+            self.clients.append(client)
+            # Spread out so they don't all send at once
+            heapq.heappush(self.due, (now + self.random.uniform(0, self.timeBetweenSends), number))
+
+    def update(self):
+        start = time.time()
+        now = start
+        due = self.due
+        while due and due[0][0] <= now:
+            when, number = heapq.heappop(due)
+            self.clients[number].update(now)
+            heapq.heappush(due, (max(when + self.timeBetweenSends, now), number))
+        self._update.add(time.time() - start)
+
+    def timeUntilNextSend(self):
+        if not self.due:
+            return self.timeBetweenSends
+        return max(0.0, self.due[0][0] - time.time())
+
+def total(metrics, name):
+    """A counter's value or the sum of a histogram's samples."""
+    if name in metrics.histograms:
+        return metrics.histograms[name].total
+    if name in metrics.counters:
+        return metrics.counters[name].value
+    return 0
+
+class Sample(object):
+    """Totals at the start of a ramp step, to take the differences from at
+    the end."""
+    def __init__(self, metrics, names):
+        self.time = time.time()
+        self.values = {}
+        for name in names:
+            self.values[name] = total(metrics, name)
+
+    def rate(self, metrics, name, now):
+        return (total(metrics, name) - self.values.get(name, 0)) / max(now - self.time, 1e-9)
+
+SERVER_TOTALS = ['engine.step', 'server.network', 'net.sent.bytes', 'net.received.bytes']
+SWARM_TOTALS = ['swarm.sent.bytes', 'swarm.received.bytes', 'swarm.snapshots', 'swarm.reliable']
+
+def report(numClients, server, swarm, serverSample, swarmSample):
+    now = time.time()
+    s = swarm.metrics
+    line = "%5i clients" % numClients
+    if server is not None:
+        m = server.metrics
+        tick = m.histogram('engine.step')
+        network = m.histogram('server.network')
+        # Seconds the server was busy per second, the scheduler's run covers
+        # sending snapshots too
+        load = serverSample.rate(m, 'engine.step', now)
+        line += "  tick p50 %6.2fms p99 %6.2fms  network p50 %6.2fms p99 %6.2fms  load %5.1f%%  down %8.0f B/s  up %7.0f B/s" % \
+                (tick.percentile(50)*1000, tick.percentile(99)*1000,
+                 network.percentile(50)*1000, network.percentile(99)*1000,
+                 load*100,
+                 serverSample.rate(m, 'net.sent.bytes', now),
+                 serverSample.rate(m, 'net.received.bytes', now))
+    connected = len([c for c in swarm.clients if c.started is not None])
+    received = swarmSample.rate(s, 'swarm.received.bytes', now)
+    line += "  | swarm %i in  %8.0f B/s (%5.0f per client)  %5.1f snapshots/s per client  rtt p50 %5.1fms  loop p99 %5.2fms" % \
+            (connected, received, received / max(connected, 1),
+             swarmSample.rate(s, 'swarm.snapshots', now) / max(connected, 1),
+             s.histogram('swarm.roundTrip').percentile(50)*1000,
+             s.histogram('swarm.update').percentile(99)*1000)
+    print line
+    sys.stdout.flush()
+
+def workers(options, count):
+    """Starts count more processes running clients only, each taking an
+    equal share of the ramp."""
+    host = "127.0.0.1"
+    port = options.port
+    if options.connect:
+        host, port = options.connect.split(":")
+    processes = []
+    for i in range(count):
+        args = [sys.executable, os.path.abspath(__file__),
+                "--connect", "%s:%s" % (host, port),
+                "--clients", str(options.clients // (count + 1)),
+                "--step", str(max(1, options.step // (count + 1))),
+                "--ramp", str(options.ramp),
+                "--rate", str(options.rate),
+                "--seed", str(options.seed * 100 + i + 1),
+                "--processes", "1",
+                "--quiet"]
+        if options.replay:
+            args += ["--replay", options.replay]
+        processes.append(subprocess.Popen(args))
+    return processes
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--clients", type="int", default=200)
+    parser.add_option("--step", type="int", default=25)
+    parser.add_option("--ramp", type="float", default=10.0)
+    parser.add_option("--rate", type="float", default=30.0)
+    parser.add_option("--replay", default=None)
+    parser.add_option("--seed", type="int", default=1)
+    parser.add_option("--port", type="int", default=10001)
+    parser.add_option("--connect", default=None)
+    parser.add_option("--processes", type="int", default=1)
+    parser.add_option("--quiet", action="store_true", default=False)
+    options, args = parser.parse_args()
+
+    server = None
+    if options.connect:
+        host, port = options.connect.split(":")
+        address = (host, int(port))
+    else:
+        from server import Server
+        server = Server(options.port)
+        server._createWorld()
+        address = ("127.0.0.1", options.port)
+
+    recording = None
+    if options.replay:
+        recording = loadRecording(options.replay)
+
+    processes = []
+    share = options.clients
+    step = options.step
+    if options.processes > 1:
+        processes = workers(options, options.processes - 1)
+        share = options.clients - (options.clients // options.processes) * (options.processes - 1)
+        step = max(1, options.step // options.processes)
+
+    swarm = Swarm(address, options.rate, options.seed, recording)
+    if server is None:
+        swarm.reactor.startRunning()
+    lastFrame = time.time()
+    try:
+        while len(swarm.clients) < share:
+            swarm.add(min(step, share - len(swarm.clients)))
+            serverSample = None
+            if server is not None:
+                serverSample = Sample(server.metrics, SERVER_TOTALS)
+            swarmSample = Sample(swarm.metrics, SWARM_TOTALS)
+            end = time.time() + options.ramp
+            while time.time() < end:
+                if server is not None:
+                    now = time.time()
+                    # Sleeps until its next tick
+                    server.frameEnded(now - lastFrame)
+                    lastFrame = now
+                    # The server only runs the reactor when it sends
+                    # snapshots, the clients shouldn't have to wait for that
+                    swarm.reactor.runUntilCurrent()
+                    swarm.reactor.doIteration(0)
+                else:
+                    swarm.reactor.runUntilCurrent()
+                    swarm.reactor.doIteration(swarm.timeUntilNextSend())
+                swarm.update()
+            if not options.quiet:
+                # Everyone's share of this step
+                report(len(swarm.clients) * options.clients // share, server, swarm,
+                       serverSample, swarmSample)
+    finally:
+        for process in processes:
+            process.wait()
+
+if __name__ == "__main__":
+    main()
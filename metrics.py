@@ -0,0 +1,226 @@
+# Lightweight instrumentation shared by the engine, the network layers and the
+# front ends. Everything is keyed by a dotted name ("engine.collide",
+# "net.127.0.0.1:4000.sent.bytes") and created on first use, so recording a
+# value is a dictionary lookup plus an append.
+
+import time, sys
+
+def _monotonic():
+    """clock_gettime(CLOCK_MONOTONIC) through ctypes, None if it can't be
+    had."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes, ctypes.util
+        # In librt before glibc 2.17, libc after
+        library = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'))
+        clock_gettime = library.clock_gettime
+    except (ImportError, OSError, AttributeError):
+        return None
+    CLOCK_MONOTONIC = 1
+    # A timespec, seconds and nanoseconds. Left as plain longs with no
+    # argtypes, it's half the cost of a Structure.
+    now = (ctypes.c_long * 2)()
+    pointer = ctypes.byref(now)
+    if clock_gettime(CLOCK_MONOTONIC, pointer) != 0:
+        return None
+    def monotonic():
+        clock_gettime(CLOCK_MONOTONIC, pointer)
+        return now[0] + now[1] * 1e-9
+    return monotonic
+
+# Seconds since some arbitrary point, for timing things. It never goes
+# backwards except in the last fallback, the wall clock, which NTP can step
+# either way.
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = _monotonic()
+    if clock is None:
+        # time.clock on Windows, which is monotonic, time.time elsewhere
+        from timeit import default_timer as clock
+
+class Counter(object):
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+    def inc(self, amount = 1):
+        self.value += amount
+
+    def summary(self):
+        return {'value': self.value}
+
+class Gauge(object):
+    """A level that goes up and down, remembering the highest it got."""
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self.max = 0
+
+    def set(self, value):
+        self.value = value
+        if value > self.max:
+            self.max = value
+
+    def summary(self):
+        return {'value': self.value, 'max': self.max}
+
+class Histogram(object):
+    """Keeps the last `window` samples for percentiles plus running totals."""
+    def __init__(self, name, window = 1024):
+        self.name = name
+        self.window = window
+        self._samples = []
+        self._next = 0
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        if len(self._samples) < self.window:
+            self._samples.append(value)
+        else:
+            self._samples[self._next] = value
+            self._next = (self._next + 1) % self.window
+        self.count += 1
+        self.total += value
+        self.last = value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, p):
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        return ordered[int(round((len(ordered) - 1) * p / 100.0))]
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.mean(),
+                'last': self.last,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99)}
+
+class Timer(object):
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.s = 0.0
+
+    def start(self):
+        self.s = clock()
+
+    def stop(self):
+        elapsed = clock() - self.s
+        self.histogram.add(elapsed)
+        return elapsed
+
+class Metrics(object):
+    def __init__(self, window = 1024):
+        self.window = window
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.dumpFile = None
+        self.dumpInterval = 10.0
+        self.timeUntilNextDump = 0.0
+
+    def counter(self, name):
+        c = self.counters.get(name)
+        if c is None:
+            c = self.counters[name] = Counter(name)
+        return c
+
+    def gauge(self, name):
+        g = self.gauges.get(name)
+        if g is None:
+            g = self.gauges[name] = Gauge(name)
+        return g
+
+    def histogram(self, name):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram(name, self.window)
+        return h
+
+    def timer(self, name):
+        return Timer(self.histogram(name))
+
+    def count(self, name, amount = 1):
+        self.counter(name).inc(amount)
+
+    def record(self, name, value):
+        self.histogram(name).add(value)
+
+    def get(self, name):
+        if name in self.counters:
+            return self.counters[name].value
+        if name in self.gauges:
+            return self.gauges[name].summary()
+        if name in self.histograms:
+            return self.histograms[name].summary()
+        return None
+
+    def remove(self, name):
+        """Forgets a metric, for ones named after something that's gone."""
+        self.counters.pop(name, None)
+        self.gauges.pop(name, None)
+        self.histograms.pop(name, None)
+
+    def query(self, prefix = ""):
+        """Summaries of every metric whose name starts with prefix."""
+        result = {}
+        for name, c in self.counters.items():
+            if name.startswith(prefix):
+                result[name] = c.summary()
+        for name, g in self.gauges.items():
+            if name.startswith(prefix):
+                result[name] = g.summary()
+        for name, h in self.histograms.items():
+            if name.startswith(prefix):
+                result[name] = h.summary()
+        return result
+
+    def report(self, prefix = ""):
+        lines = []
+        for name in sorted(self.counters.keys()):
+            if name.startswith(prefix):
+                lines.append("%-40s %12i" % (name, self.counters[name].value))
+        for name in sorted(self.gauges.keys()):
+            if name.startswith(prefix):
+                g = self.gauges[name]
+                lines.append("%-40s %12s max=%s" % (name, g.value, g.max))
+        for name in sorted(self.histograms.keys()):
+            if name.startswith(prefix):
+                s = self.histograms[name].summary()
+                lines.append("%-40s n=%-8i mean=%.6f p50=%.6f p99=%.6f max=%.6f" %
+                             (name, s['count'], s['mean'], s['p50'], s['p99'], s['max']))
+        return "\n".join(lines)
+
+    def dumpTo(self, path, interval = 10.0):
+        self.dumpFile = path
+        self.dumpInterval = interval
+        self.timeUntilNextDump = interval
+
+    def dump(self, path = None):
+        f = open(path or self.dumpFile, 'a')
+        try:
+            f.write("--- %s\n" % time.asctime())
+            f.write(self.report())
+            f.write("\n")
+        finally:
+            f.close()
+
+    def update(self, frameTime):
+        if self.dumpFile:
+            self.timeUntilNextDump -= frameTime
+            if self.timeUntilNextDump <= 0.0:
+                self.timeUntilNextDump = self.dumpInterval
+                self.dump()
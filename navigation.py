@@ -0,0 +1,172 @@
+# Where a Person can get to in a level, worked out once from the level's
+# boxes. The game is side on, so the places to stand are the tops of boxes
+# that aren't too steep. Waypoints go along each of those every few metres,
+# at the height the feet ball sits at, and are joined to the ones either
+# side of them on the same surface, to anything on another surface close
+# enough to jump up to, and to anything below that can be dropped down to.
+# Bots find their way around with A* over the result.
+
+import math, heapq
+from spatial import SpatialHash, quaternionToAngle
+
+WALK = 0
+JUMP = 1
+DROP = 2
+
+class WaypointGraph(object):
+    # Metres between waypoints along a surface
+    spacing = 2.0
+    # Steepest surface that can be stood on
+    maxSlope = math.radians(50)
+    # Person.feetSize, and from the feet's centre to the top of the head
+    feetSize = 0.5
+    headroom = 1.2
+    # Person jumps at 11m/s, 6.2m high with its feet needing to clear the
+    # edge, and is in the air for over two seconds at up to 3.5m/s across
+    jumpHeight = 5.6
+    jumpReach = 7.0
+    dropReach = 7.0
+    # Jumping and dropping are slower and riskier than walking
+    jumpCost = 2.0
+    dropCost = 1.5
+
+    def __init__(self, boxes, index):
+        """boxes as Level.boxes, index the engine's StaticIndex over them
+        for the line of sight tests."""
+        self.index = index
+        # [(x, y)], the surface each is on and its place along it
+        self.positions = []
+        self.surfaces = []
+        # [[(to, cost, kind), ...]] for each waypoint
+        self.edges = []
+        self.hash = SpatialHash(8.0)
+        self._place(boxes)
+        self._connect()
+
+    def fromLevel(level, index):
+        return WaypointGraph(level.boxes, index)
+
+    fromLevel = staticmethod(fromLevel)
+
+    def clear(self, x0, y0, x1, y1):
+        return not self.index.segmentBlocked(x0, y0, x1, y1)
+
+    def _place(self, boxes):
+        for number, (size, position, rotation) in enumerate(boxes):
+            # Decoration in front of or behind where people are
+            if abs(position[2]) > size[2]/2.0:
+                continue
+            angle = quaternionToAngle(rotation)
+            c, s = math.cos(angle), math.sin(angle)
+            hx, hy = size[0]/2.0, size[1]/2.0
+            # The face pointing most upwards, as its outward normal and the
+            # half extent along it and across it, in the box's frame
+            best = None
+            for nx, ny, along, across in ((0, 1, hy, hx), (0, -1, hy, hx),
+                                          (1, 0, hx, hy), (-1, 0, hx, hy)):
+                up = s*nx + c*ny
+                if best is None or up > best[0]:
+                    best = (up, nx, ny, along, across)
+            up, nx, ny, along, across = best
+            if up < math.cos(self.maxSlope):
+                continue
+            # Into the world, the normal and the direction along the face
+            wx, wy = c*nx - s*ny, s*nx + c*ny
+            tx, ty = -wy, wx
+            cx = position[0] + wx*along
+            cy = position[1] + wy*along
+            length = 2*across
+            count = max(1, int(length / self.spacing))
+            for i in range(count):
+                offset = (i + 0.5) / count * length - across
+                x = cx + tx*offset + wx*self.feetSize
+                y = cy + ty*offset + wy*self.feetSize
+                # Nothing there already and room to stand up
+                if not self.clear(x, y, x, y + self.headroom):
+                    continue
+                self.hash.insert(len(self.positions), x, y)
+                self.positions.append((x, y))
+                self.surfaces.append((number, i))
+                self.edges.append([])
+
+    def _connect(self):
+        positions = self.positions
+        for i, (x0, y0) in enumerate(positions):
+            reach = max(self.jumpReach, self.dropReach)
+            for j in self.hash.query(x0 - reach, x0 + reach, y0 - 2*reach, y0 + self.jumpHeight):
+                if j == i:
+                    continue
+                x1, y1 = positions[j]
+                dx, dy = x1 - x0, y1 - y0
+                distance = math.sqrt(dx*dx + dy*dy)
+                surface, place = self.surfaces[i]
+                if self.surfaces[j][0] == surface:
+                    if abs(self.surfaces[j][1] - place) == 1 and self.clear(x0, y0, x1, y1):
+                        self.edges[i].append((j, distance, WALK))
+                elif 0 < dy <= self.jumpHeight and abs(dx) <= self.jumpReach:
+                    # Straight up past the edge then across
+                    top = y1 + self.headroom
+                    if self.clear(x0, y0, x0, top) and self.clear(x0, top, x1, top) and \
+                       self.clear(x1, top, x1, y1):
+                        self.edges[i].append((j, distance * self.jumpCost, JUMP))
+                elif dy <= 0 and abs(dx) <= self.dropReach:
+                    # Off the edge then down
+                    if self.clear(x0, y0, x1, y0) and self.clear(x1, y0, x1, y1):
+                        self.edges[i].append((j, distance * self.dropCost, DROP))
+
+    def __len__(self):
+        return len(self.positions)
+
+    def nearest(self, x, y, radius = 8.0):
+        """The closest waypoint in sight of (x, y), None if there isn't
+        one within a few times radius."""
+        for r in (radius, radius*3):
+            best = None
+            for i in self.hash.query(x - r, x + r, y - r, y + r):
+                px, py = self.positions[i]
+                d = (px - x)**2 + (py - y)**2
+                if (best is None or d < best[0]) and self.clear(x, y, px, py):
+                    best = (d, i)
+            if best is not None:
+                return best[1]
+        return None
+
+    def path(self, start, goal):
+        """Waypoints from start to goal, not including start, [] if goal
+        can't be reached."""
+        if start == goal:
+            return []
+        positions = self.positions
+        gx, gy = positions[goal]
+        def estimate(i):
+            x, y = positions[i]
+            return math.sqrt((x - gx)**2 + (y - gy)**2)
+        cost = {start: 0.0}
+        came = {}
+        open = [(estimate(start), start)]
+        while open:
+            f, i = heapq.heappop(open)
+            if i == goal:
+                result = [i]
+                while result[-1] in came:
+                    result.append(came[result[-1]])
+                result.pop()
+                result.reverse()
+                return result
+            g = cost[i]
+            if f > g + estimate(i) + 1e-9:
+                # Already found a better way here
+                continue
+            for j, c, kind in self.edges[i]:
+                total = g + c
+                if total < cost.get(j, 1e30):
+                    cost[j] = total
+                    came[j] = i
+                    heapq.heappush(open, (total + estimate(j), j))
+        return []
+
+    def kind(self, i, j):
+        for to, cost, kind in self.edges[i]:
+            if to == j:
+                return kind
+        return WALK
@@ -4,6 +4,9 @@ from twisted.spread import banana
 from collections import deque
 import zlib
 import time
+import struct
+
+SESSION = struct.Struct('<I')
 
 class NetworkClient(DatagramProtocol):
     def __init__(self, host = "127.0.0.1", port = 10001):
@@ -23,6 +26,7 @@ class NetworkClient(DatagramProtocol):
         self.timeUntilNextPing = 0.0
         self.debugSendPacketLength = 0
         self.debugReceivePacketLength = 0
+        self.session = 0
 
     def gotIP(self, ip):
         print "Got IP", ip
@@ -35,7 +39,9 @@ class NetworkClient(DatagramProtocol):
     def datagramReceived(self, data, (host, port)):
         self.debugReceivePacketLength = len(data)
         message = banana.decode(zlib.decompress(data))
-        if type(message[0]) == str and message[0] == "p":
+        if type(message[0]) == str and message[0] == "c":
+            self.session = message[1]
+        elif type(message[0]) == str and message[0] == "p":
             for ping in self.pings:
                 if ping.number == message[1]:
                     self.roundTripTime = time.time() - ping.time;
@@ -51,7 +57,7 @@ class NetworkClient(DatagramProtocol):
         print "No Server"
 
     def send(self, obj):
-        data = zlib.compress(banana.encode(obj),1)
+        data = SESSION.pack(self.session) + zlib.compress(banana.encode(obj),1)
         self.transport.write(data)
         self.debugSendPacketLength = len(data)
 
@@ -59,6 +65,8 @@ class NetworkClient(DatagramProtocol):
         if self.serverIP != None:
             self.timeUntilNextPing -= elapsedTime
             if self.timeUntilNextPing <= 0.0:
+                if not self.session:
+                    self.send(["c", 0])
                 self.ping()
                 self.timeUntilNextPing = self.timeBetweenPings
                 
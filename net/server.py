@@ -1,9 +1,14 @@
 from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import reactor
 from twisted.spread import banana
-import time
+import time, heapq, random, os
+import struct
 import zlib
 
+# Every datagram from a client starts with its session ID, 0 until the
+# server has handed it one
+SESSION = struct.Struct('<I')
+
 class Ping(object):
     _numberOfPings = 0
 
@@ -26,8 +31,9 @@ class Ping(object):
             return "%s" % self._number
 
 class Client():
-    def __init__(self, address, transport):
+    def __init__(self, address, transport, session = 0):
         self.address = address
+        self.session = session
         self.messages = []
         self.transport = transport
         self.lastMessageTime = time.time()
@@ -54,6 +60,9 @@ class Client():
     def timedOut(self):
         return (time.time() - self.lastMessageTime) > self.timeout
 
+    def expiryTime(self):
+        return self.lastMessageTime + self.timeout
+
     def push(self, data):
         if type(data) == list and len(data) > 0 and data[0] == "p":
             self.send(["p", data[1], time.time()])
@@ -85,7 +94,13 @@ class NetworkServer(DatagramProtocol):
     debugSendPacketLength = 0
     
     def __init__(self, connectedCallback, port = 10001, debug = False):
+        # Swapped for a new list on connect and disconnect, never changed in
+        # place
         self.clients = []
+        self.sessions = {}
+        self.sessionsByID = {}
+        self.timeouts = []
+        self.random = random.Random(os.urandom(16))
         self.debug = debug
         self.reactor = reactor
         self.reactor.startRunning()
@@ -98,17 +113,68 @@ class NetworkServer(DatagramProtocol):
     def datagramReceived(self, data, address):
         if self.debug: print "RCV",
         self.debugReceivePacketLength = len(data)
-        # Allocate the received datagram to the correct client
-        client = Client(address, self.transport)
-        if client not in self.clients:
-            if self.debug: print "!New!",
-            self.clients.append(client)
-            self.connectedCallback(client)
-        else:
-            client = self.clients[self.clients.index(client)]
+        if len(data) <= SESSION.size:
+            return
+        (session,) = SESSION.unpack_from(data)
+        client = self.sessions.get(address)
+        if client is None and session:
+            client = self.sessionsByID.get(session)
+            if client is not None:
+                del self.sessions[client.address]
+                client.address = address
+                self.sessions[address] = client
+
+        message = banana.decode(zlib.decompress(data[SESSION.size:]))
+        if type(message) == list and len(message) > 0 and message[0] == "c":
+            if client is None:
+                if self.debug: print "!New!",
+                client = self.connect(address)
+            client.lastMessageTime = time.time()
+            client.send(["c", client.session])
+            return
+        if client is None:
+            if session:
+                self.transport.write(zlib.compress(banana.encode(["c", 0]), 4), address)
+            return
 
         if self.debug: print client.debug()
-        client.push(banana.decode(zlib.decompress(data)))
+        client.push(message)
+
+    def connect(self, address):
+        session = 0
+        while session == 0 or session in self.sessionsByID:
+            session = self.random.randint(1, 0xffffffff)
+        client = Client(address, self.transport, session)
+        self.sessions[address] = client
+        self.sessionsByID[session] = client
+        self.clients = self.clients + [client]
+        heapq.heappush(self.timeouts, (client.expiryTime(), session))
+        self.connectedCallback(client)
+        return client
+
+    def disconnect(self, client):
+        if self.sessionsByID.get(client.session) is not client:
+            return
+        del self.sessionsByID[client.session]
+        del self.sessions[client.address]
+        self.clients = [c for c in self.clients if c is not client]
+
+    def expired(self, now = None):
+        if now is None:
+            now = time.time()
+        expired = []
+        timeouts = self.timeouts
+        while timeouts and timeouts[0][0] <= now:
+            expiryTime, session = heapq.heappop(timeouts)
+            client = self.sessionsByID.get(session)
+            if client is None:
+                continue
+            if client.expiryTime() > now:
+                heapq.heappush(timeouts, (client.expiryTime(), session))
+                continue
+            self.disconnect(client)
+            expired.append(client)
+        return expired
 
     def update(self, time = 0):
         self.debugSendPacketLength = NetworkServer.debugSendPacketLength
@@ -122,4 +188,6 @@ if __name__ == "__main__":
     server = NetworkServer(testCallback, debug = True)
     while(reactor.running):
         server.update(0.1)
+        for client in server.expired():
+            print client, "timed out"
         time.sleep(0.1)
@@ -0,0 +1,219 @@
+# Measures the netcode end to end on loopback. Runs a headless Server, a
+# netem.Proxy in front of it and a fleet of headless clients that talk to
+# the server through the proxy, all in one process on one reactor, under
+# each of the scenarios in netem.py. For each scenario it reports
+#
+#   snapshot bytes/s   what the server sent each client and what got there
+#   input to effect    from a client changing its aim to the first snapshot
+#                      that shows it
+#   prediction error   how far each client's prediction of its own player
+#                      was from the server's, measured by prediction.py
+#   event loss         reliable messages the server sent that never arrived
+#
+# The clients run the same prediction as client.py against a world with only
+# the level and their own player in it, and drive benchmark.py's scripted
+# bots except that they aim in sudden flicks instead of drifting, so it's
+# plain which snapshot first shows each one.
+#
+# Usage: python netbench.py [--scenarios lan,wifi,dropout] [--clients 8]
+#                           [--seconds 20] [--seed 1] [--port 10101]
+
+import random, math, time
+from optparse import OptionParser
+from engine import Engine
+from server import Server
+from benchmark import ScriptedInput, MIXED
+from metrics import Metrics
+from snapshot import SnapshotReceiver
+from inputs import InputHistory
+from prediction import Prediction, predictable
+import networkclient
+import netem
+
+class FlickingInput(ScriptedInput):
+    def __init__(self, seed, gunName, ticksBetweenFlicks = 100):
+        ScriptedInput.__init__(self, seed, gunName)
+        self.ticksBetweenFlicks = ticksBetweenFlicks
+        self.ticksUntilFlick = self.random.randint(1, ticksBetweenFlicks)
+        self.aim = self.angle
+        self.flicked = False
+
+    def next(self):
+        presses = ScriptedInput.next(self)
+        self.ticksUntilFlick -= 1
+        self.flicked = self.ticksUntilFlick <= 0
+        if self.flicked:
+            self.ticksUntilFlick = self.ticksBetweenFlicks
+            # Far enough that the old aim can't be mistaken for the new one
+            self.aim += self.random.choice([-1, 1]) * self.random.uniform(math.pi/4, math.pi)
+        presses[0] = (math.cos(self.aim), math.sin(self.aim), 0)
+        return presses
+
+class BenchClient(Engine):
+    PHASES = ['input'] + Engine.PHASES + ['prediction']
+
+    def __init__(self, port, metrics, script):
+        # Every client records into the same metrics
+        self.metrics = metrics
+        Engine.__init__(self)
+        self.network = networkclient.NetworkClient("127.0.0.1", port, metrics)
+        self.snapshots = SnapshotReceiver()
+        self.inputs = InputHistory()
+        self.prediction = Prediction(metrics)
+        self.script = script
+        self.player = None
+        self._tickPresses = None
+        self.lastServerUpdate = 0
+        # (input sequence, time, direction) of the last flick, until a
+        # snapshot shows it
+        self.flick = None
+        self._effect = metrics.histogram('bench.inputToEffect')
+        self._unseen = metrics.counter('bench.flicks.unseen')
+        self._unusable = metrics.counter('bench.snapshots.unusable')
+        self._reliable = metrics.counter('bench.reliable.received')
+        self._createWorld()
+
+    def inputPhase(self):
+        self._tickPresses = None
+        if self.player != None:
+            presses = self.script.next()
+            self.inputs.add(presses)
+            if self.script.flicked:
+                if self.flick is not None:
+                    self._unseen.value += 1
+                self.flick = (self.inputs.sequence, time.time(), presses[0])
+            self._tickPresses = predictable(presses)
+            self.player.inputPresses(self._tickPresses)
+
+    def predictionPhase(self):
+        if self._tickPresses != None:
+            self.prediction.record(self.inputs.sequence, self._tickPresses, self.player.getAttributes())
+
+    def reconcile(self, attributes, sequence):
+        self.prediction.reconcile(self.player, self.world, self.staticSpace, self,
+                                  attributes, sequence, self.inputs.sequence)
+
+    def checkFlick(self, attributes, sequence):
+        if self.flick is None or sequence < self.flick[0]:
+            return
+        direction = attributes[4]
+        aim = self.flick[2]
+        if direction[0]*aim[0] + direction[1]*aim[1] > 0.99:
+            self._effect.add(time.time() - self.flick[1])
+            self.flick = None
+
+    def frameEnded(self, frameTime):
+        Engine.frameEnded(self, frameTime)
+        self.network.update(frameTime)
+        for message in self.network._messages:
+            if message[Engine.NET_TIME] <= self.lastServerUpdate:
+                continue
+            records = self.snapshots.apply(message[Engine.NET_OBJECTS],
+                                           message[Engine.NET_SEQUENCE],
+                                           message[Engine.NET_BASELINE],
+                                           message[Engine.NET_REMOVED])
+            if records is None:
+                self._unusable.value += 1
+                continue
+            self.lastServerUpdate = message[Engine.NET_TIME]
+            lastInput = message[Engine.NET_LAST_INPUT]
+            for record in records:
+                if not record[Engine.NET_OBJECTS_IS_CURRENT_PLAYER]:
+                    continue
+                attributes = record[Engine.NET_OBJECTS_ATTRIBUTES]
+                if self.player is None:
+                    self.player = self.createPerson(record[Engine.NET_OBJECTS_NAME])
+                    self.player.setAttributes(attributes)
+                    self.player.enable()
+                    self.objects.add(self.player)
+                else:
+                    self.reconcile(attributes, lastInput)
+                    self.checkFlick(attributes, lastInput)
+        self._reliable.value += len(self.network.reliableMessages)
+        self.network.clearMessages()
+        if self.player != None:
+            self.prediction.frameEnded(frameTime)
+        if self.inputs.sequence >= 0:
+            self.network.send(self.inputs.message(self.snapshots.sequence))
+        return True
+
+def percentiles(histogram, scale = 1.0):
+    return "p50 %7.3f  p99 %7.3f  max %7.3f" % (histogram.percentile(50) * scale,
+                                                 histogram.percentile(99) * scale,
+                                                 histogram.max * scale)
+
+def run(name, numClients, seconds, seed, port):
+    server = Server(port)
+    server._createWorld()
+    proxy = netem.Proxy(port + 1, ("127.0.0.1", port), seed = seed)
+    proxy.play(netem.SCENARIOS[name])
+    metrics = Metrics()
+    clients = [BenchClient(port + 1, metrics,
+                           FlickingInput(seed * 1000 + i, MIXED[i % len(MIXED)]))
+               for i in range(numClients)]
+
+    start = time.time()
+    lastFrame = start
+    while lastFrame - start < seconds:
+        now = time.time()
+        frameTime = now - lastFrame
+        lastFrame = now
+        server.frameEnded(frameTime)
+        for client in clients:
+            client.frameEnded(frameTime)
+    elapsed = time.time() - start
+
+    # Sent at least once and not acknowledged yet might still turn up
+    inFlight = 0
+    for client in server.network.clients:
+        inFlight += len([m for m in client.reliable.pending if m[2] is not None])
+    sent = server.metrics.counter('net.reliable.sent').value
+    received = metrics.counter('bench.reliable.received').value
+    lost = max(0, sent - inFlight - received)
+    perClient = 1.0 / (elapsed * max(numClients, 1))
+
+    print "%s, %i clients, %.0fs" % (name, numClients, elapsed)
+    print "    snapshots     sent %7.0f B/s  received %7.0f B/s  input %6.0f B/s per client  unusable %i" % \
+          (server.metrics.counter('net.sent.bytes').value * perClient,
+           metrics.counter('net.received.bytes').value * perClient,
+           metrics.counter('net.sent.bytes').value * perClient,
+           metrics.counter('bench.snapshots.unusable').value)
+    print "    input->effect %s ms  n=%i  unseen %i" % \
+          (percentiles(metrics.histogram('bench.inputToEffect'), 1000),
+           metrics.histogram('bench.inputToEffect').count,
+           metrics.counter('bench.flicks.unseen').value)
+    print "    prediction    %s     corrections %i  replayed %i" % \
+          (percentiles(metrics.histogram('prediction.error')),
+           metrics.counter('prediction.corrections').value,
+           metrics.counter('prediction.replayed').value)
+    print "    server input  missing %i  starved %i  skipped %i  late %i" % \
+          tuple([server.metrics.counter('net.input.' + k).value
+                 for k in ('missing', 'starved', 'skipped', 'late')])
+    print "    events        sent %i  received %i  in flight %i  lost %i (%.2f%%)  resent %i" % \
+          (sent, received, inFlight, lost, 100.0 * lost / max(sent, 1),
+           server.metrics.counter('net.reliable.resent').value)
+    print "    link          up lost %i  down lost %i  overflowed %i  reordered %i  duplicated %i" % \
+          (proxy.metrics.counter('netem.up.lost').value,
+           proxy.metrics.counter('netem.down.lost').value,
+           proxy.metrics.counter('netem.down.overflowed').value + proxy.metrics.counter('netem.up.overflowed').value,
+           proxy.metrics.counter('netem.down.reordered').value + proxy.metrics.counter('netem.up.reordered').value,
+           proxy.metrics.counter('netem.down.duplicated').value + proxy.metrics.counter('netem.up.duplicated').value)
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--scenarios", default="loopback,broadband,wifi,mobile,lossy,congested,dropout,bufferbloat")
+    parser.add_option("--clients", type="int", default=8)
+    parser.add_option("--seconds", type="float", default=20.0)
+    parser.add_option("--seed", type="int", default=1)
+    parser.add_option("--port", type="int", default=10101)
+    options, args = parser.parse_args()
+
+    # Every scenario gets a fresh server on ports of its own, NetworkServer
+    # doesn't keep hold of its port to close it
+    port = options.port
+    for name in options.scenarios.split(","):
+        run(name, options.clients, options.seconds, options.seed, port)
+        port += 2
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+# Makes a loopback connection behave like a real one. A UDP proxy that sits
+# between the clients and the server and holds back, drops, duplicates and
+# reorders datagrams, and squeezes them through a bandwidth cap, each
+# direction separately. Every client gets its own socket to the server, so
+# the server still sees one address per client, and its own link, so one
+# client's traffic doesn't queue behind another's.
+#
+# What the link does can be changed while it runs, a scenario is a script of
+# (seconds from the start, upstream Conditions, downstream Conditions).
+#
+# Usage: python netem.py [--listen 10002] [--server 127.0.0.1:10001]
+#                        [--scenario wifi] [--seed 1]
+
+import random, time
+from optparse import OptionParser
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet import reactor
+from metrics import Metrics
+
+class Conditions(object):
+    """How one direction of a link behaves. Times are in seconds, chances
+    out of 1, and the bandwidth in bytes a second with 0 for no cap."""
+    def __init__(self, latency = 0.0, jitter = 0.0, loss = 0.0, duplicate = 0.0,
+                 reorder = 0.0, reorderDelay = 0.03, bandwidth = 0, queue = 0.25):
+        # One way, jitter is the standard deviation on top of it
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+        # Reordered datagrams are held back by reorderDelay so the ones
+        # behind them overtake, everything else arrives in order
+        self.reorder = reorder
+        self.reorderDelay = reorderDelay
+        self.bandwidth = bandwidth
+        # Most seconds of datagrams waiting for the bandwidth before the
+        # newest are dropped
+        self.queue = queue
+
+    def __repr__(self):
+        return "Conditions(latency=%g, jitter=%g, loss=%g, duplicate=%g, reorder=%g, bandwidth=%i)" % \
+               (self.latency, self.jitter, self.loss, self.duplicate, self.reorder, self.bandwidth)
+
+def both(**kwargs):
+    """The same conditions both ways."""
+    return Conditions(**kwargs), Conditions(**kwargs)
+
+def steady(up, down = None):
+    if down is None:
+        down = up
+    return [(0.0, up, down)]
+
+SCENARIOS = {
+    'loopback': steady(Conditions()),
+    'lan': steady(*both(latency = 0.001, jitter = 0.0005)),
+    'broadband': steady(*both(latency = 0.025, jitter = 0.004, loss = 0.005)),
+    'wifi': steady(*both(latency = 0.015, jitter = 0.015, loss = 0.02,
+                         duplicate = 0.01, reorder = 0.02)),
+    'mobile': steady(Conditions(latency = 0.06, jitter = 0.03, loss = 0.03, reorder = 0.05,
+                                bandwidth = 8000),
+                     Conditions(latency = 0.06, jitter = 0.03, loss = 0.03, reorder = 0.05,
+                                bandwidth = 32000)),
+    'lossy': steady(*both(latency = 0.03, jitter = 0.005, loss = 0.1)),
+    # Less downstream than the server's budget for each client
+    'congested': steady(Conditions(latency = 0.04, jitter = 0.01),
+                        Conditions(latency = 0.04, jitter = 0.01, bandwidth = 12000, queue = 0.5)),
+    # Fine, then nothing gets through for a second and a half, then fine again
+    'dropout': [(0.0,) + both(latency = 0.03, jitter = 0.005),
+                (8.0,) + both(latency = 0.03, loss = 1.0),
+                (9.5,) + both(latency = 0.03, jitter = 0.005)],
+    # Latency climbing and falling back, like a link someone started a
+    # download on
+    'bufferbloat': [(0.0,) + both(latency = 0.03),
+                    (5.0,) + both(latency = 0.15, jitter = 0.02),
+                    (10.0,) + both(latency = 0.4, jitter = 0.05),
+                    (15.0,) + both(latency = 0.03)],
+    }
+
+class Link(object):
+    """One direction of one client's connection."""
+    def __init__(self, name, conditions, deliver, metrics, random, callLater = None):
+        self.conditions = conditions
+        self.deliver = deliver
+        self.random = random
+        self.callLater = callLater or reactor.callLater
+        # When the bandwidth cap has finished sending what's queued, and
+        # when the last datagram that wasn't reordered gets there
+        self.busyUntil = 0.0
+        self.lastArrival = 0.0
+        self._packets = metrics.counter('netem.%s.packets' % name)
+        self._bytes = metrics.counter('netem.%s.bytes' % name)
+        self._lost = metrics.counter('netem.%s.lost' % name)
+        self._overflowed = metrics.counter('netem.%s.overflowed' % name)
+        self._duplicated = metrics.counter('netem.%s.duplicated' % name)
+        self._reordered = metrics.counter('netem.%s.reordered' % name)
+        self._delay = metrics.histogram('netem.%s.delay' % name)
+
+    def send(self, data, now = None):
+        if now is None:
+            now = time.time()
+        c = self.conditions
+        self._packets.value += 1
+        self._bytes.value += len(data)
+        if c.loss and self.random.random() < c.loss:
+            self._lost.value += 1
+            return
+        departure = now
+        if c.bandwidth:
+            start = max(now, self.busyUntil)
+            if start - now > c.queue:
+                self._overflowed.value += 1
+                return
+            self.busyUntil = start + len(data) / float(c.bandwidth)
+            departure = self.busyUntil
+        copies = 1
+        if c.duplicate and self.random.random() < c.duplicate:
+            self._duplicated.value += 1
+            copies = 2
+        for i in range(copies):
+            arrival = departure + c.latency
+            if c.jitter:
+                arrival += max(-c.latency, self.random.gauss(0.0, c.jitter))
+            if c.reorder and self.random.random() < c.reorder:
+                self._reordered.value += 1
+                arrival = max(arrival, self.lastArrival) + c.reorderDelay
+            else:
+                arrival = max(arrival, self.lastArrival)
+                self.lastArrival = arrival
+            self._delay.add(arrival - now)
+            self.callLater(arrival - now, self.deliver, data)
+
+class Upstream(DatagramProtocol):
+    """The proxy's socket to the server for one client."""
+    def __init__(self, proxy, address):
+        self.proxy = proxy
+        self.address = address
+        self.up = Link('up', proxy.up, self.write, proxy.metrics, proxy.random)
+        self.down = Link('down', proxy.down, self.writeBack, proxy.metrics, proxy.random)
+
+    def startProtocol(self):
+        self.transport.connect(*self.proxy.server)
+
+    def datagramReceived(self, data, address):
+        self.down.send(data)
+
+    def connectionRefused(self):
+        pass
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writeBack(self, data):
+        self.proxy.transport.write(data, self.address)
+
+class Proxy(DatagramProtocol):
+    def __init__(self, port, server = ("127.0.0.1", 10001), metrics = None, seed = None):
+        self.port = port
+        self.server = server
+        self.metrics = metrics or Metrics()
+        self.random = random.Random(seed)
+        self.up = Conditions()
+        self.down = Conditions()
+        # Client address -> Upstream
+        self.routes = {}
+        self.scenario = None
+        self.calls = []
+        self.reactor = reactor
+        self.reactor.listenUDP(port, self, interface = "127.0.0.1")
+
+    def datagramReceived(self, data, address):
+        route = self.routes.get(address)
+        if route is None:
+            route = self.routes[address] = Upstream(self, address)
+            self.reactor.listenUDP(0, route, interface = "127.0.0.1")
+        route.up.send(data)
+
+    def setConditions(self, up, down):
+        self.up = up
+        self.down = down
+        for route in self.routes.values():
+            route.up.conditions = up
+            route.down.conditions = down
+
+    def play(self, scenario):
+        """Runs through a script of (time, up, down) from now on."""
+        for call in self.calls:
+            if call.active():
+                call.cancel()
+        self.calls = []
+        self.scenario = scenario
+        for at, up, down in scenario:
+            if at <= 0:
+                self.setConditions(up, down)
+            else:
+                self.calls.append(self.reactor.callLater(at, self.setConditions, up, down))
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--listen", type="int", default=10002)
+    parser.add_option("--server", default="127.0.0.1:10001")
+    parser.add_option("--scenario", default="broadband")
+    parser.add_option("--seed", type="int", default=None)
+    options, args = parser.parse_args()
+    host, port = options.server.split(":")
+    proxy = Proxy(options.listen, (host, int(port)), seed = options.seed)
+    proxy.play(SCENARIOS[options.scenario])
+    print "Forwarding %i to %s as '%s'" % (options.listen, options.server, options.scenario)
+    for at, up, down in SCENARIOS[options.scenario]:
+        print "    %5.1fs up %r" % (at, up)
+        print "           down %r" % (down,)
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
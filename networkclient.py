@@ -1,9 +1,9 @@
 from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import reactor
-from twisted.spread import banana
 from collections import deque
-from encode import timer
-import zlib
+from metrics import Metrics, clock
+from reliable import ReliableChannel
+import protocol
 import time
 
 class ping(object):
@@ -12,8 +12,21 @@ class ping(object):
         self.time = time
 
 class NetworkClient(DatagramProtocol):
-    def __init__(self, host = "127.0.0.1", port = 10001):
+    def __init__(self, host = "127.0.0.1", port = 10001, metrics = None, format = None):
         self._messages = deque()
+        # Messages the server sent reliably, each one only turns up once
+        self.reliableMessages = []
+        self.codec = protocol.Codec(format, 1)
+        # Handed out by the server when we connect
+        self.session = 0
+        self.metrics = metrics or Metrics()
+        self.reliable = ReliableChannel(self.codec, self.metrics)
+        self._decodeTime = self.metrics.histogram('net.decode')
+        self._encodeTime = self.metrics.histogram('net.encode')
+        self._sentPackets = self.metrics.counter('net.sent.packets')
+        self._sentBytes = self.metrics.counter('net.sent.bytes')
+        self._receivedPackets = self.metrics.counter('net.received.packets')
+        self._receivedBytes = self.metrics.counter('net.received.bytes')
         self.reactor = reactor
         self.serverIP = None
         self.port = port
@@ -21,6 +34,9 @@ class NetworkClient(DatagramProtocol):
         self.reactor.resolve(host).addCallback(self.gotIP)
         self._pingSendTime = time.time()
         self.roundTripTime = 0.0
+        # How much the round trip time varies from one ping to the next,
+        # smoothed the way RTP does it
+        self.jitter = 0.0
         self.serverOffset = 0.0
         self.lastPingNumber = 0
         self.pings = []
@@ -35,6 +51,9 @@ class NetworkClient(DatagramProtocol):
         self.serverIP = ip
         self.reactor.listenUDP(0, self)
 
+    def connect(self):
+        self.send(["c", 0])
+
     def ping(self):
         if self.serverIP != None:
             self.pingNumber += 1
@@ -45,17 +64,29 @@ class NetworkClient(DatagramProtocol):
         self.transport.connect(self.serverIP, self.port)
         
     def datagramReceived(self, data, (host, port)):
-        t = timer()
         self.debugReceivePacketLength = len(data)
-        t.start()
-        message = banana.decode(zlib.decompress(data))
-        #message = banana.decode(data)
-        #message = cerealizer.loads(zlib.decompress(data))
-        t.stop()
-        if type(message[0]) == str and message[0] == "p":
+        self._receivedPackets.value += 1
+        self._receivedBytes.value += len(data)
+        start = clock()
+        messages, data = self.reliable.unwrap(data)
+        self.reliableMessages.extend(messages)
+        if not data:
+            return
+        message = self.codec.decode(data)
+        self._decodeTime.add(clock() - start)
+        if type(message[0]) == str and message[0] == "c":
+            # 0 if the server has forgotten us
+            if message[1] != self.session:
+                # A new session starts counting packets from scratch
+                self.reliable = ReliableChannel(self.codec, self.metrics, self.reliable.resendTime)
+            self.session = message[1]
+        elif type(message[0]) == str and message[0] == "p":
             for ping in self.pings:
                 if ping.number == message[1]:
-                    self.roundTripTime = time.time() - ping.time;
+                    roundTripTime = time.time() - ping.time
+                    self.jitter += (abs(roundTripTime - self.roundTripTime) - self.jitter) / 16.0
+                    self.roundTripTime = roundTripTime
+                    self.reliable.resendTime = max(0.1, 1.5 * self.roundTripTime)
                     self.serverOffset = time.time() - (message[2] + self.roundTripTime/2)
                     self.pings = [p for p in self.pings if p.number <= ping.number]
         else:
@@ -67,14 +98,20 @@ class NetworkClient(DatagramProtocol):
         print "No Server"
 
     def send(self, obj):
-        data = zlib.compress(banana.encode(obj),1)
+        start = clock()
+        data = protocol.SESSION.pack(self.session) + self.reliable.wrap(self.codec.encode(obj), time.time())
+        self._encodeTime.add(clock() - start)
         self.transport.write(data)
         self.debugSendPacketLength = len(data)
+        self._sentPackets.value += 1
+        self._sentBytes.value += len(data)
 
     def update(self, elapsedTime):
         if self.serverIP != None:
             self.timeUntilNextPing -= elapsedTime
             if self.timeUntilNextPing <= 0.0:
+                if not self.session:
+                    self.connect()
                 self.ping()
                 self.timeUntilNextPing = self.timeBetweenPings
                 
@@ -83,6 +120,7 @@ class NetworkClient(DatagramProtocol):
 
     def clearMessages(self):
         self._messages.clear()
+        self.reliableMessages = []
 
 if __name__ == "__main__":
     client = NetworkClient()
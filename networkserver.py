@@ -1,19 +1,46 @@
 from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import reactor
-from twisted.spread import banana
-import time
-import zlib
+from metrics import Metrics, clock
+from snapshot import Baselines
+from reliable import ReliableChannel
+from inputs import InputBuffer
+from collections import deque
+import protocol, reliable
+import time, heapq, random, os
+
+def encode(data, metrics, codec):
+    start = clock()
+    toSend = codec.encode(data)
+    metrics.record('net.encode', clock() - start)
+    return toSend
 
 class Client():
-    def __init__(self, address, transport):
+    def __init__(self, address, transport, metrics = None, codec = None, session = 0):
         self.address = address
-        self.messages = []
+        self.session = session
+        self.metrics = metrics or Metrics()
+        self.codec = codec or protocol.Codec()
+        self.messages = deque()
         self.transport = transport
         self.lastMessageTime = time.time()
         self.timeout = 10.0
         self.ping = 0
         self.player = None
-        self.packetNumber = 0
+        # Last snapshot the client acknowledged, and the ones it might
+        self.packetNumber = -1
+        self.baselines = Baselines()
+        self.reliable = ReliableChannel(self.codec, self.metrics)
+        # Sequenced input, one taken off each physics tick
+        self.inputs = InputBuffer(self.metrics)
+        # Made once, named after the address it connected from even if it
+        # moves, and removed when it's disconnected
+        metrics = self.metrics
+        self._sentPackets = metrics.counter('net.sent.packets')
+        self._sentBytes = metrics.counter('net.sent.bytes')
+        self._receivedPackets = metrics.counter('net.received.packets')
+        self._receivedBytes = metrics.counter('net.received.bytes')
+        self._own = [metrics.counter('net.%s.%s' % (self, name))
+                     for name in ('sent.packets', 'sent.bytes', 'received.packets', 'received.bytes')]
 
     def __str__(self):
         return "%s:%i" % self.address
@@ -34,35 +61,88 @@ class Client():
     def timedOut(self):
         return (time.time() - self.lastMessageTime) > self.timeout
 
+    def expiryTime(self):
+        return self.lastMessageTime + self.timeout
+
     def push(self, data):
         if type(data) == list and len(data) > 0 and data[0] == "p":
             self.send(["p", data[1], time.time()])
             self.ping = data[2]
+            # Give a resend a round trip and a half to be acknowledged
+            self.reliable.resendTime = max(0.1, 1.5 * data[2] / 100.0)
             if self.player:
                 self.player.ping = data[2]
+        elif type(data) == list and len(data) > 0 and data[0] == "i":
+            self.acknowledge(data[3])
+            self.inputs.receive(data[1], data[2])
         else:
-            self.messages.insert(0,data)
+            if type(data) == list and len(data) > 2:
+                # Input with the last snapshot received tacked on the end
+                self.acknowledge(data[2])
+                data = data[:2]
+            self.messages.append(data)
             
         self.lastMessageTime = time.time()
 
+    def acknowledge(self, sequence):
+        self.baselines.acknowledge(sequence)
+        self.packetNumber = self.baselines.acknowledged
+
     def hasMoreMessages(self):
         return len(self.messages) != 0
 
     def pop(self):
-        return self.messages.pop()
+        return self.messages.popleft()
 
     def send(self, data):
-        toSend = zlib.compress(banana.encode(data),4)
-        #toSend = banana.encode(data)
-        #toSend = zlib.compress(cerealizer.dumps(data), 4)
+        self.sendEncoded(encode(data, self.metrics, self.codec))
+
+    def sendReliable(self, data):
+        """Goes out with the next packets until the client acknowledges one."""
+        self.reliable.send(data)
+
+    def sendEncoded(self, toSend):
+        # For packets that go to more than one client, see encode
+        toSend = self.reliable.wrap(toSend, time.time())
         self.transport.write(toSend, self.address)
         NetworkServer.debugSendPacketLength = len(toSend)
+        self.countSent(len(toSend))
+        return len(toSend)
+
+    def countSent(self, length):
+        self._sentPackets.value += 1
+        self._sentBytes.value += length
+        self._own[0].value += 1
+        self._own[1].value += length
+
+    def countReceived(self, length):
+        self._receivedPackets.value += 1
+        self._receivedBytes.value += length
+        self._own[2].value += 1
+        self._own[3].value += length
+
+    def removeMetrics(self):
+        for counter in self._own:
+            self.metrics.remove(counter.name)
     
 class NetworkServer(DatagramProtocol):
     debugSendPacketLength = 0
     
-    def __init__(self, connectedCallback, port = 10001, debug = False):
+    def __init__(self, connectedCallback, port = 10001, debug = False, metrics = None, format = None):
+        # Never changed in place, connecting and disconnecting swap in a new
+        # list so anyone looping over the old one carries on undisturbed
         self.clients = []
+        self.sessions = {}
+        self.sessionsByID = {}
+        # (expiry time, session) for every client, an entry that turns out to
+        # be stale when it comes up is pushed back with the client's new time
+        self.timeouts = []
+        # Session IDs are the only thing stopping one client talking for
+        # another, so they don't come from the game's (seeded) random
+        self.random = random.Random(os.urandom(16))
+        self.metrics = metrics or Metrics()
+        # One codec for every client, packets are shared between them
+        self.codec = protocol.Codec(format, 4)
         self.debug = debug
         self.reactor = reactor
         self.reactor.startRunning()
@@ -75,18 +155,89 @@ class NetworkServer(DatagramProtocol):
     def datagramReceived(self, data, address):
         if self.debug: print "Received Packet"
         self.debugReceivePacketLength = len(data)
-        # Allocate the received datagram to the correct client
-        client = Client(address, self.transport)
-        if client not in self.clients:
-            if self.debug: print "New Client"
-            self.clients.append(client)
-            self.connectedCallback(client)
+        if len(data) <= protocol.SESSION.size:
+            return
+        (session,) = protocol.SESSION.unpack_from(data)
+        client = self.sessions.get(address)
+        if client is None and session:
+            client = self.sessionsByID.get(session)
+            if client is not None:
+                # Same session from somewhere else, a NAT gave it a new port
+                if self.debug: print "Client moved", client, address
+                del self.sessions[client.address]
+                client.address = address
+                self.sessions[address] = client
+
+        start = clock()
+        data = data[protocol.SESSION.size:]
+        messages = []
+        if client is None:
+            data = reliable.payload(data)
         else:
-            if self.debug: print "Old Client"
-            client = self.clients[self.clients.index(client)]
+            messages, data = client.reliable.unwrap(data)
+        message = None
+        if data:
+            message = self.codec.decode(data)
+        self.metrics.record('net.decode', clock() - start)
+
+        if type(message) == list and len(message) > 0 and message[0] == "c":
+            if client is None:
+                if self.debug: print "New Client"
+                client = self.connect(address)
+            client.lastMessageTime = time.time()
+            client.send(["c", client.session])
+            return
+        if client is None:
+            # Hasn't connected, or was timed out. If it thinks it has a
+            # session tell it otherwise so it connects again.
+            if session:
+                self.transport.write(self.codec.encode(["c", 0]), address)
+            return
 
         if self.debug: print "Data", client.debug()
-        client.push(banana.decode(zlib.decompress(data)))
+        client.countReceived(self.debugReceivePacketLength)
+        for m in messages:
+            client.push(m)
+        if message is not None:
+            client.push(message)
+
+    def connect(self, address):
+        session = 0
+        while session == 0 or session in self.sessionsByID:
+            session = self.random.randint(1, 0xffffffff)
+        client = Client(address, self.transport, self.metrics, self.codec, session)
+        self.sessions[address] = client
+        self.sessionsByID[session] = client
+        self.clients = self.clients + [client]
+        heapq.heappush(self.timeouts, (client.expiryTime(), session))
+        self.connectedCallback(client)
+        return client
+
+    def disconnect(self, client):
+        if self.sessionsByID.get(client.session) is not client:
+            return
+        del self.sessionsByID[client.session]
+        del self.sessions[client.address]
+        self.clients = [c for c in self.clients if c is not client]
+
+    def expired(self, now = None):
+        """Disconnects and returns every client that has timed out."""
+        if now is None:
+            now = time.time()
+        expired = []
+        timeouts = self.timeouts
+        while timeouts and timeouts[0][0] <= now:
+            expiryTime, session = heapq.heappop(timeouts)
+            client = self.sessionsByID.get(session)
+            if client is None:
+                continue
+            if client.expiryTime() > now:
+                heapq.heappush(timeouts, (client.expiryTime(), session))
+                continue
+            self.disconnect(client)
+            client.removeMetrics()
+            expired.append(client)
+        return expired
 
     def update(self, time = 0):
         self.debugSendPacketLength = NetworkServer.debugSendPacketLength
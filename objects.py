@@ -1,5 +1,4 @@
 import ode, random, math, time
-import engine
 
 #TYPES
 STATIC = 0
@@ -46,23 +45,29 @@ class StaticObject(object):
     TERRAIN = 1
     PROJECTILE = 2
     PLAYER = 4
+
+    # Whether clients are only sent it once, reliably, see reliable.py
+    sendOnce = False
     
     def __init__(self, gameworld, name, size = (1.0, 1.0, 1.0), geomFunc = ode.GeomBox):
         self._size = size
-        self._geometry = geomFunc(gameworld.space, self._size)
+        self._space = self._spaceFor(gameworld)
+        self._geometry = geomFunc(self._space, self._size)
         self._geometry.location = "Torso"
         self._geometry.objectName = name
         self._geometry.object = self
         self._name = name
         self._nick = name
         self._world = gameworld.world
-        self._space = gameworld.space
         self._gameworld = gameworld
         self.type = STATIC
         self._geometry.setCategoryBits(self.TERRAIN)
         self._geometry.setCollideBits(self.PROJECTILE | self.PLAYER)
         self._gameID = Generator.nextID()
         
+    def _spaceFor(self, gameworld):
+        return gameworld.staticSpace
+
     def shouldSendToClients(self):
         return True
 
@@ -126,6 +131,9 @@ class DynamicObject(StaticObject):
         self._pointingDirection = (1.0,0.0,0.0)
         self.setDead(False)
 
+    def _spaceFor(self, gameworld):
+        return gameworld.space
+
     def getBody(self):
         return self._body
 
@@ -331,12 +339,13 @@ class SphereObject(DynamicObject):
         self.type = SPHERE
 
 class BulletObject(SphereObject):
+    # Clients are told about it once and simulate it themselves after that
+    sendOnce = True
+
     def __init__(self, gameworld, name, direction = None, velocity = [0.0,0.0], damage = 1.0, weight = 3.0):
         
         self.size = 0.000001#0.01#0.025
-        self.maxSpeed = velocity
         self.weight = weight
-        self.damage = damage
         self._gameworld = gameworld
         
         SphereObject.__init__(self, gameworld, name, self.size, geomFunc = ode.GeomSphere, weight = self.weight)
@@ -345,25 +354,50 @@ class BulletObject(SphereObject):
         if type(self.size) == float or type(self.size) == int:
             self._body.getMass().setSphereTotal(self.weight, self.size)
 
+        del self._motor
+        
+        self.type = BULLET
+        
+        self._geometry.setCategoryBits(self.PROJECTILE)
+        self._geometry.setCollideBits(self.TERRAIN | self.PLAYER)
+
+        self.needToTellClient = True
+        self.reinit(name, direction, velocity, damage)
+
+    def reinit(self, name, direction = None, velocity = [0.0,0.0], damage = 1.0):
+        # Puts a new or pooled bullet into the state of one that was just
+        # fired, a recycled bullet must be indistinguishable from a new one
+        self._name = name
+        self._nick = name
+        self._geometry.objectName = name
+        self._geometry.object = self
+        self._body.name = name
+        self._gameID = Generator.nextID()
+        self.maxSpeed = velocity
+        self.damage = damage
+
         speedVariation = (1-(random.random()-0.5)/5)
 
         if direction:
             self._body.setLinearVel((direction[0] * speedVariation * self.maxSpeed[0],
                                      direction[1] * speedVariation * self.maxSpeed[1],
                                      0))
+        else:
+            self._body.setLinearVel((0,0,0))
+        self._body.setAngularVel((0,0,0))
+        self._body.setQuaternion((1,0,0,0))
+        self._body.setForce((0,0,0))
+        self._body.setTorque((0,0,0))
+        DynamicObject.enable(self)
 
-        del self._motor
-        
         self.setDead(False)
-        self.type = BULLET
         self.hasSentToClients = False
         self.events = []
-        
-        self._geometry.setCategoryBits(self.PROJECTILE)
-        self._geometry.setCollideBits(self.TERRAIN | self.PLAYER)
-
         self.hasStepped = False
-        self.needToTellClient = True
+
+    def deactivate(self):
+        # Parked in the ObjectPool, no longer simulated or collided
+        DynamicObject.disable(self)
 
     def __del__(self):
         SphereObject.__del__(self)
@@ -396,9 +430,14 @@ class ShrapnelObject(BulletObject):
     
     def __init__(self, gameworld, name, direction = None, velocity = [0.0,0.0], damage = 2.0):
         BulletObject.__init__(self, gameworld, name, direction, velocity, damage, 1.0)
-        self.ricochetTime = self.ricochetTime
+        # Its own type, or the ObjectPool would hand it out as a bullet
+        self.type = SHRAPNEL
         self.needToTellClient = False
 
+    def reinit(self, name, direction = None, velocity = [0.0,0.0], damage = 2.0):
+        BulletObject.reinit(self, name, direction, velocity, damage)
+        self.ricochetTime = self.__class__.ricochetTime
+
     def hitObject(self, other, position):
         if other.type != STATIC or self.ricochetTime <= 0:
             BulletObject.hitObject(self, other, position)
@@ -414,7 +453,6 @@ class LaserObject(ShrapnelObject):
         BulletObject.__init__(self, gameworld, name, direction, velocity, damage, 1.0)
         self.type = LASER
         self.needToTellClient = True
-        self.richochetTime = self.ricochetTime
         self.hasWindResistance = False
         self._body.setGravityMode(False)
 
@@ -422,9 +460,12 @@ class GrenadeObject(BulletObject):
     def __init__(self, gameworld, name, direction = None, velocity = [0.0,0.0], damage = 2.0):
         self.ownerName = ""
         BulletObject.__init__(self, gameworld, name, direction, velocity, damage)
+        self.type = GRENADE
+
+    def reinit(self, name, direction = None, velocity = [0.0,0.0], damage = 2.0):
+        BulletObject.reinit(self, name, direction, velocity, damage)
         self.timeUntilArmed = 0.25
         self.timeUntilExploded = self.timeUntilArmed + 2.5
-        self.type = GRENADE
         self.explodePos = None
         self.exploded = False
         self.seed = random.randint(0,10000)
@@ -452,24 +493,10 @@ class GrenadeObject(BulletObject):
             self.explode()
 
     def explode(self):
-        random.seed(self.seed)
         if not self.explodePos:
             self.explodePos = self._body.getPosition()
-        for i in range(50):
-            direction = [random.random()-0.5, random.random()-0.5, 0]
-            length = math.sqrt(direction[0]*direction[0] + direction[1]*direction[1])
-            direction[0] /= length
-            direction[1] /= length
-            velocity = random.randint(10,25)
-            b = self._gameworld.addBullet(SHRAPNEL,
-                  self._name + "s" + str(i), \
-                  map((lambda a,b: a+b/5), self.explodePos, direction),
-                  direction,
-                  [velocity, velocity],
-                  7, #Damage
-                  self._geometry.object._name)
-            b.ownerName = self.ownerName
-            
+        # The shrapnel, see shrapnel.py
+        self._gameworld.grenadeExploded(self)
         self.exploded = True
 
     def frameEnded(self, time):
@@ -483,6 +510,10 @@ class GrenadeObject(BulletObject):
 
         
 class Person(SphereObject):
+    # Ogre's default vertical field of view and the widest window we expect
+    fieldOfView = math.pi/4
+    maxAspectRatio = 16/9.0
+
     def __init__(self, gameworld, name, camera = None):
         self._gameworld = gameworld
 
@@ -490,6 +521,10 @@ class Person(SphereObject):
         self.feetSize = 0.5 # Sphere
         torsoSize = (1.0, 0.5, 1.0) # Box
         headSize = (1.0 ,0.4 ,1.0 )# Box
+        self.torsoSize = torsoSize
+        self.headSize = headSize
+        self.torsoOffset = 0.8
+        self.headOffset = 1.0
         weight = 70
         self.weight = weight
         self._name = name   
@@ -515,7 +550,7 @@ class Person(SphereObject):
         self._torsoGeometry = ode.GeomBox(lengths=torsoSize)
         self._torsoGeometry.objectName = self._name
         ## Moving up only feetSize (not *2) so that it overlaps the feet
-        self._torsoGeometry.setPosition((0,0.8,0))
+        self._torsoGeometry.setPosition((0,self.torsoOffset,0))
 
         self._torsoTransform = ode.GeomTransform(gameworld.space)
         self._torsoTransform.setGeom(self._torsoGeometry)
@@ -526,7 +561,7 @@ class Person(SphereObject):
         # Head
         self._headGeometry = ode.GeomBox(lengths=headSize)
         self._headGeometry.objectName = self._name
-        self._headGeometry.setPosition((0,1.0,0))
+        self._headGeometry.setPosition((0,self.headOffset,0))
 
         self._headTransform = ode.GeomTransform(gameworld.space)
         self._headTransform.setGeom(self._headGeometry)
@@ -616,6 +651,16 @@ class Person(SphereObject):
         if position:
             self.torsoBody.setPosition(position)
 
+    def getHitboxes(self):
+        # 2D versions of the feet, torso and head geoms for swept hit tests,
+        # as (location, round, centreX, centreY, halfWidth, halfHeight). The
+        # torso body is kept upright in postStep so its boxes are axis aligned
+        x, y = self._body.getPosition()[0:2]
+        tx, ty = self.torsoBody.getPosition()[0:2]
+        return [("Legs", True, x, y, self.feetSize, self.feetSize),
+                ("Torso", False, tx, ty + self.torsoOffset, self.torsoSize[0]/2, self.torsoSize[1]/2),
+                ("Head", False, tx, ty + self.headOffset, self.headSize[0]/2, self.headSize[1]/2)]
+
     def __del__(self):
         self._torsoGeometry.disable()
         self._torsoTransform.disable()
@@ -783,7 +828,7 @@ class Person(SphereObject):
         self.setGun(self.gunName)
 
     def hitObject(self, other, position):
-        if other.type == BULLET:
+        if other.type == BULLET or other.type == SHRAPNEL:
             self.events += ['hit']
         
     def doDamage(self, damage):        
@@ -831,6 +876,15 @@ class Person(SphereObject):
                 self.reset()
                 self.setPosition(self.spawnPosition)
 
+    def getGeometries(self):
+        return [self._geometry, self._torsoTransform, self._headTransform]
+
+    def viewExtents(self):
+        """Half the width and height of what the camera sees at the player's
+        depth, the camera sits zoom units above the player."""
+        halfHeight = self.gun['zoom'] * math.tan(self.fieldOfView/2)
+        return halfHeight * self.maxAspectRatio, halfHeight
+
     def setGun(self, name):
         if not self.timeLeftUntilMustShoot:
             self.gun = self.guns[name]
@@ -856,6 +910,10 @@ class Person(SphereObject):
 
     def setAttributes(self, attributes):
         SphereObject.setAttributes(self,attributes)
+        self.setStatus(attributes)
+
+    def setStatus(self, attributes):
+        # Everything in the attributes but where it is and how it's moving
         self.health = attributes[5]
         self.setGun(self.gunNames[attributes[6]])
         self.gun['ammo'] = attributes[7]
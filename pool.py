@@ -0,0 +1,51 @@
+# Recycles projectiles instead of building and tearing down an ode.Body,
+# ode.Mass and geom (and on the client a RibbonTrail and scene nodes) for
+# every shot. Anything with reinit/deactivate can be pooled, see
+# objects.BulletObject.
+
+class ObjectPool(object):
+    def __init__(self, metrics, maxFreePerType = 256):
+        self.metrics = metrics
+        self.maxFreePerType = maxFreePerType
+        self._free = {}
+        self._hits = metrics.counter('pool.hits')
+        self._misses = metrics.counter('pool.misses')
+        self._discarded = metrics.counter('pool.discarded')
+
+    def acquire(self, type):
+        """A deactivated object of the given type, or None if there isn't one.
+        The caller is expected to reinit it."""
+        free = self._free.get(type)
+        if free:
+            self._hits.value += 1
+            object = free.pop()
+            self.metrics.gauge('pool.%s.free' % type).set(len(free))
+            return object
+        self._misses.value += 1
+        return None
+
+    def release(self, object):
+        """Takes the object back, returns False if it can't be pooled and
+        should be closed as normal."""
+        if not hasattr(object, 'reinit'):
+            return False
+        free = self._free.setdefault(object.type, [])
+        if len(free) >= self.maxFreePerType:
+            self._discarded.value += 1
+            return False
+        object.deactivate()
+        free.append(object)
+        self.metrics.gauge('pool.%s.free' % object.type).set(len(free))
+        return True
+
+    def hitRate(self):
+        total = self._hits.value + self._misses.value
+        if total == 0:
+            return 0.0
+        return float(self._hits.value) / total
+
+    def clear(self):
+        for free in self._free.values():
+            for object in free:
+                object.close()
+        self._free = {}
@@ -0,0 +1,115 @@
+# Client side prediction for the local player. Each physics tick the
+# client applies its own input straight away and remembers the state it
+# ended up in under that input's sequence number. Snapshots say which input
+# the server had got up to, and if the state the server worked out for it
+# is too far from the one predicted the client goes back to the server's
+# and replays the inputs the server hasn't seen yet. The jump that makes is
+# taken off gradually on screen rather than all at once.
+
+import math
+import ode
+from objects import SHOOT, RELOAD
+
+# Movement is predicted, shooting waits for the server so there's only
+# ever one of each bullet
+UNPREDICTED = SHOOT | RELOAD
+
+def predictable(presses):
+    return [presses[0], presses[1] & ~UNPREDICTED]
+
+class Prediction(object):
+    def __init__(self, metrics, size = 256, threshold = 0.05, smoothing = 0.1, maxSmoothed = 2.0):
+        self.size = size
+        # (sequence, presses, attributes after the tick)
+        self.ticks = [None] * size
+        # How far off a predicted position can be before it's corrected
+        self.threshold = threshold
+        # Seconds for most of a correction to be taken off the display
+        self.smoothing = smoothing
+        # Anything bigger than this is a respawn or a teleport, not worth
+        # sliding the player across to
+        self.maxSmoothed = maxSmoothed
+        self.correction = [0.0, 0.0, 0.0]
+        self._corrections = metrics.counter('prediction.corrections')
+        self._replayed = metrics.counter('prediction.replayed')
+        self._error = metrics.histogram('prediction.error')
+
+    def record(self, sequence, presses, attributes):
+        self.ticks[sequence % self.size] = (sequence, presses, attributes)
+
+    def predicted(self, sequence):
+        tick = self.ticks[sequence % self.size]
+        if tick is None or tick[0] != sequence:
+            return None
+        return tick[2]
+
+    def mispredicted(self, sequence, attributes):
+        """Whether the server's attributes after input sequence are far
+        enough from ours to replay. Also records how far off we were."""
+        predicted = self.predicted(sequence)
+        if predicted is None:
+            return True
+        a, b = predicted[0], attributes[0]
+        error = math.sqrt((a[0] - b[0])**2 + (a[1] - b[1])**2)
+        self._error.add(error)
+        return error > self.threshold
+
+    def pending(self, sequence, newest):
+        """Inputs after sequence up to newest, oldest first, as far back as
+        we still have them."""
+        result = []
+        for s in range(max(sequence + 1, newest - self.size + 1), newest + 1):
+            tick = self.ticks[s % self.size]
+            if tick is not None and tick[0] == s:
+                result.append((s, tick[1]))
+        return result
+
+    def corrected(self, before, after, replayed):
+        self._corrections.value += 1
+        self._replayed.value += replayed
+        for i in range(3):
+            self.correction[i] += before[i] - after[i]
+        if math.sqrt(sum([x*x for x in self.correction])) > self.maxSmoothed:
+            self.correction = [0.0, 0.0, 0.0]
+
+    def reconcile(self, player, world, staticSpace, engine, attributes, sequence, newest):
+        """Checks what the server made of our input up to sequence against
+        what we predicted, going back and replaying up to newest if we got
+        it wrong. player is stepped in world against staticSpace with
+        engine's collisions, everything else in engine held still."""
+        if sequence < 0:
+            # The server hasn't had any of our input yet
+            player.setAttributes(attributes)
+            return
+        if not self.mispredicted(sequence, attributes):
+            player.setStatus(attributes)
+            return
+        before = player.getBody().getPosition()
+        player.setAttributes(attributes)
+        pending = self.pending(sequence, newest)
+        held = []
+        for o in engine.objects:
+            if o is not player:
+                for body in [o.getBody(), getattr(o, 'torsoBody', None)]:
+                    if body is not None and body.isEnabled():
+                        body.disable()
+                        held.append(body)
+        for s, presses in pending:
+            player.inputPresses(presses)
+            player.preCollide()
+            for geometry in player.getGeometries():
+                ode.collide2(staticSpace, geometry, None, engine.collision_callback)
+            player.preStep()
+            world.quickStep(engine.stepSize)
+            player.postStep()
+            engine.contactgroup.empty()
+            self.record(s, presses, player.getAttributes())
+        for body in held:
+            body.enable()
+        if pending:
+            player.inputPresses(pending[-1][1])
+        self.corrected(before, player.getBody().getPosition(), len(pending))
+
+    def frameEnded(self, frameTime):
+        decay = math.exp(-frameTime / self.smoothing)
+        self.correction = [x * decay for x in self.correction]
@@ -0,0 +1,242 @@
+# Bullets, shrapnel and lasers without ODE bodies. Their positions and
+# velocities live in flat arrays that are integrated in one pass per step,
+# and each step's movement is tested as a swept segment against the static
+# index and every Person's hitboxes, so nothing can tunnel through a wall.
+# Hits go through the same hitObject/resolveHit path as the ODE collisions.
+
+import random
+from array import array
+from objects import Generator, BULLET, SHRAPNEL, LASER, PERSON, STATIC
+from spatial import segmentCircle, segmentBox
+
+# Per type: (mass, has wind resistance, has gravity, ricochet time, bounce)
+# matching BulletObject, ShrapnelObject and LaserObject. Every projectile's
+# contacts bounce fully, see Engine.collision_callback.
+PROPERTIES = {
+    BULLET: (3.0, True, True, 0.0, 1.0),
+    SHRAPNEL: (1.0, True, True, 0.15, 1.0),
+    LASER: (1.0, False, False, 3.0, 1.0),
+    }
+
+# Air resistance applied as -windResistance*|v|*v, as in DynamicObject.preStep
+windResistance = 0.05
+
+# How far off a surface a ricochet is put back, so it doesn't start inside it
+ricochetOffset = 0.001
+
+class Projectile(object):
+    """Stands in for a BulletObject in Engine.objects. The kinematic state is
+    owned by the ProjectileSystem, this is just the handle the rest of the
+    game (networking, scoring, reaping) talks to."""
+    sendOnce = True
+
+    def __init__(self, system, name, type, damage):
+        self._system = system
+        self._name = name
+        self._nick = name
+        self._gameID = Generator.nextID()
+        self.type = type
+        self.damage = damage
+        self.ownerName = ""
+        self.dead = False
+        self.ricochetTime = PROPERTIES[type][3]
+        self.hasSentToClients = False
+        self.needToTellClient = type != SHRAPNEL
+        self.index = -1
+
+    def setOwnerName(self, name):
+        self.ownerName = name
+
+    def setDead(self, dead = True):
+        self.dead = dead
+
+    def isDead(self):
+        return self.dead
+
+    def setPosition(self, position):
+        if position:
+            self._system.x[self.index] = position[0]
+            self._system.y[self.index] = position[1]
+
+    def getPosition(self):
+        return (self._system.x[self.index], self._system.y[self.index], 0.0)
+
+    def setLinearVel(self, vel):
+        self._system.vx[self.index] = vel[0]
+        self._system.vy[self.index] = vel[1]
+
+    def getLinearVel(self):
+        return (self._system.vx[self.index], self._system.vy[self.index], 0.0)
+
+    def hitObject(self, other, position):
+        if other.type != STATIC or self.ricochetTime <= 0:
+            self.setDead()
+
+    def preCollide(self):
+        pass
+
+    def preStep(self):
+        pass
+
+    def postStep(self):
+        pass
+
+    def frameEnded(self, time):
+        self.ricochetTime -= time
+
+    def close(self):
+        self._system.remove(self)
+
+    def getAttributes(self):
+        s = self._system
+        i = self.index
+        return [[0 if v == 0.0 else v for v in (s.x[i], s.y[i])],
+                [0 if v == 0.0 else v for v in (s.vx[i], s.vy[i])]]
+
+    def setAttributes(self, attributes):
+        self.setPosition(attributes[0])
+        self.setLinearVel(attributes[1])
+
+    def shouldSendToClients(self):
+        return not self.hasSentToClients and self.needToTellClient
+
+    def getEvents(self):
+        return []
+
+    def setEvents(self, events):
+        pass
+
+    def clearEvents(self):
+        self.hasSentToClients = True
+
+class ProjectileSystem(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.gravity = engine.world.getGravity()[1]
+        self.objects = []
+        self.x = array('d')
+        self.y = array('d')
+        self.vx = array('d')
+        self.vy = array('d')
+        # Drag per unit mass and gravity scale, so the inner loop is all sums
+        self.drag = array('d')
+        self.gravityScale = array('d')
+        self.bounce = array('d')
+
+    def __len__(self):
+        return len(self.objects)
+
+    def spawn(self, type, name, direction, velocity, damage):
+        mass, hasWindResistance, hasGravity, ricochetTime, bounce = PROPERTIES[type]
+        p = Projectile(self, name, type, damage)
+        p.index = len(self.objects)
+        self.objects.append(p)
+        self.x.append(0.0)
+        self.y.append(0.0)
+        # Same spread as BulletObject
+        speedVariation = (1-(random.random()-0.5)/5)
+        if direction:
+            self.vx.append(direction[0] * speedVariation * velocity[0])
+            self.vy.append(direction[1] * speedVariation * velocity[1])
+        else:
+            self.vx.append(0.0)
+            self.vy.append(0.0)
+        self.drag.append(windResistance / mass if hasWindResistance else 0.0)
+        self.gravityScale.append(1.0 if hasGravity else 0.0)
+        self.bounce.append(bounce)
+        return p
+
+    def remove(self, p):
+        # Swap the last projectile into the hole
+        i = p.index
+        if i < 0:
+            return
+        last = len(self.objects) - 1
+        if i != last:
+            moved = self.objects[last]
+            self.objects[i] = moved
+            moved.index = i
+            for a in (self.x, self.y, self.vx, self.vy, self.drag, self.gravityScale, self.bounce):
+                a[i] = a[last]
+        self.objects.pop()
+        for a in (self.x, self.y, self.vx, self.vy, self.drag, self.gravityScale, self.bounce):
+            a.pop()
+        p.index = -1
+
+    def gatherHitboxes(self, ownerName):
+        return self.engine.hitboxesSeenBy(ownerName)
+
+    def castHitboxes(self, x0, y0, dx, dy, hitboxes):
+        """Nearest hitbox along the segment as (t, person, location), or None."""
+        best = None
+        minX, maxX = min(x0, x0 + dx), max(x0, x0 + dx)
+        minY, maxY = min(y0, y0 + dy), max(y0, y0 + dy)
+        for person, boxes in hitboxes:
+            for location, round, cx, cy, hx, hy in boxes:
+                if cx + hx < minX or cx - hx > maxX or cy + hy < minY or cy - hy > maxY:
+                    continue
+                if round:
+                    t = segmentCircle(x0, y0, dx, dy, cx, cy, hx)
+                else:
+                    hit = segmentBox(x0, y0, dx, dy, cx, cy, hx, hy)
+                    t = hit and hit[0]
+                if t is not None and (best is None or t < best[0]):
+                    best = (t, person, location)
+        return best
+
+    def step(self, dt):
+        if not self.objects:
+            return
+        engine = self.engine
+        staticIndex = engine.staticIndex
+        # Everyone's hitboxes as each shooter saw them
+        hitboxes = {}
+        g = self.gravity * dt
+        x, y, vx, vy = self.x, self.y, self.vx, self.vy
+        drag, gravityScale = self.drag, self.gravityScale
+        objects = self.objects
+
+        for i in xrange(len(objects)):
+            p = objects[i]
+            if p.dead:
+                continue
+            u = vx[i]
+            v = vy[i]
+            k = drag[i] * dt
+            u -= k*abs(u)*u
+            v += gravityScale[i]*g - k*abs(v)*v
+            x0 = x[i]
+            y0 = y[i]
+            dx = u*dt
+            dy = v*dt
+
+            staticHit = staticIndex.segmentCast(x0, y0, x0 + dx, y0 + dy)
+            seen = hitboxes.get(p.ownerName)
+            if seen is None:
+                seen = hitboxes[p.ownerName] = self.gatherHitboxes(p.ownerName)
+            personHit = self.castHitboxes(x0, y0, dx, dy, seen)
+
+            if personHit and (staticHit is None or personHit[0] <= staticHit[0]):
+                t, person, location = personHit
+                point = (x0 + dx*t, y0 + dy*t, 0.0)
+                x[i], y[i] = point[0], point[1]
+                p.hitObject(person, point)
+                person.hitObject(p, point)
+                engine.resolveHit(p, person, location)
+            elif staticHit:
+                t, nx, ny, box = staticHit
+                point = (x0 + dx*t, y0 + dy*t, 0.0)
+                p.hitObject(box.object, point)
+                if not p.dead:
+                    # Ricochet, reflect off the surface
+                    vn = u*nx + v*ny
+                    if vn < 0.0:
+                        u -= (1.0 + self.bounce[i])*vn*nx
+                        v -= (1.0 + self.bounce[i])*vn*ny
+                    point = (point[0] + nx*ricochetOffset, point[1] + ny*ricochetOffset, 0.0)
+                x[i], y[i] = point[0], point[1]
+            else:
+                x[i] = x0 + dx
+                y[i] = y0 + dy
+            vx[i] = u
+            vy[i] = v
@@ -0,0 +1,538 @@
+# What goes over the wire. Packets used to be nested lists run through banana
+# and zlib, the binary format here packs the same lists with a fixed layout
+# per object type (the SCHEMAS below follow getAttributes/setAttributes in
+# objects.py) and quantizes positions, velocities and angles to fixed point.
+# Both formats decode to exactly the same lists, so everything above the
+# network layer doesn't know which one is in use.
+#
+# Decoding works out the format from the first byte, zlib always starts with
+# 0x78 and binary packets start with their kind, so during the migration
+# either end can be switched over on its own.
+
+import struct, zlib, math
+from twisted.spread import banana
+from objects import DYNAMIC, SPHERE, PERSON, BULLET, GRENADE, SHRAPNEL, LASER
+
+BANANA = 'banana'
+BINARY = 'binary'
+FORMATS = [BANANA, BINARY]
+default = BINARY
+
+ZLIB = '\x78'
+
+# Packet kinds
+PING = 1 # ["p", number, roundTripTime*100] from a client
+PONG = 2 # ["p", number, time] back from the server
+INPUT = 3 # [direction, presses, last snapshot received]
+SNAPSHOT = 4 # see snapshot.py
+CONNECT = 5 # ["c", session], 0 from a client that wants one
+RELIABLE = 6 # wraps the others, see reliable.py
+EVENT = 7 # ["e", name, events], sent reliably
+SPAWN = 8 # ["s", record], a full record for something only sent once, reliably
+INPUTS = 9 # ["i", sequence, [[direction, presses], ...], last snapshot received]
+EXPLOSION = 10 # ["x", grenade name, position, seed], sent reliably
+
+# Every datagram from a client starts with its session ID, 0 until the
+# server has handed it one
+SESSION = struct.Struct('<I')
+
+# Record flags
+FULL_RECORD_FLAG = 1
+CURRENT_PLAYER_FLAG = 2
+
+class Unencodable(ValueError):
+    """Something the binary format has no way to say, it goes as banana
+    instead."""
+
+LIMITS = {'B': (0, 0xff), 'h': (-0x8000, 0x7fff), 'H': (0, 0xffff),
+          'i': (-0x80000000, 0x7fffffff), 'I': (0, 0xffffffff)}
+
+def clamp(value, fmt):
+    low, high = LIMITS[fmt]
+    if value < low:
+        return low
+    if value > high:
+        return high
+    return value
+
+class Vector(object):
+    """Two fixed point numbers, 1/scale apart."""
+    def __init__(self, fmt, scale):
+        self.fmt = fmt * 2
+        self.count = 2
+        self.scale = float(scale)
+        self.type = fmt
+
+    def toWire(self, value):
+        s = self.scale
+        return (clamp(int(round(value[0]*s)), self.type),
+                clamp(int(round(value[1]*s)), self.type))
+
+    def fromWire(self, values):
+        return [values[0]/self.scale, values[1]/self.scale]
+
+class Rotation(object):
+    """A body's quaternion after to2d, [w, x, y]. Bodies only turn about z
+    and to2d has already dropped that, so all that's left to send is how far
+    round they are, w = cos(angle/2)."""
+    fmt = 'H'
+    count = 1
+
+    def toWire(self, value):
+        w = max(-1.0, min(1.0, value[0]))
+        return (int(round(math.acos(w) / math.pi * 0xffff)),)
+
+    def fromWire(self, values):
+        return [math.cos(values[0] * math.pi / 0xffff), 0.0, 0.0]
+
+class Direction(object):
+    """A unit vector in the plane as an angle."""
+    fmt = 'H'
+    count = 1
+
+    def toWire(self, value):
+        angle = math.atan2(value[1], value[0]) % (2*math.pi)
+        return (int(round(angle / (2*math.pi) * 0x10000)) & 0xffff,)
+
+    def fromWire(self, values):
+        angle = values[0] * 2*math.pi / 0x10000
+        return [math.cos(angle), math.sin(angle)]
+
+class Integer(object):
+    def __init__(self, fmt):
+        self.fmt = fmt
+        self.count = 1
+
+    def toWire(self, value):
+        return (clamp(int(value), self.fmt),)
+
+    def fromWire(self, values):
+        return values[0]
+
+class Duration(object):
+    """Seconds to the millisecond, up to a minute or so."""
+    fmt = 'H'
+    count = 1
+
+    def toWire(self, value):
+        return (clamp(int(round(value*1000)), 'H'),)
+
+    def fromWire(self, values):
+        return values[0] / 1000.0
+
+class Real(object):
+    fmt = 'f'
+    count = 1
+
+    def toWire(self, value):
+        return (value,)
+
+    def fromWire(self, values):
+        return values[0]
+
+POSITION = Vector('i', 1024)
+VELOCITY = Vector('h', 64)
+
+# DynamicObject: position, quaternion, angular velocity, linear velocity,
+# direction
+DYNAMIC_FIELDS = [POSITION, Rotation(), VELOCITY, VELOCITY, Direction()]
+# BulletObject: position, linear velocity
+BULLET_FIELDS = [POSITION, VELOCITY]
+
+SCHEMAS = {
+    DYNAMIC: DYNAMIC_FIELDS,
+    SPHERE: DYNAMIC_FIELDS,
+    # Person: health, gun, ammo, time until next shot, time until respawn,
+    # state bits, score, ping, instability
+    PERSON: DYNAMIC_FIELDS + [Integer('h'), Integer('B'), Integer('h'), Duration(), Duration(),
+                              Integer('B'), Integer('h'), Integer('H'), Real()],
+    BULLET: BULLET_FIELDS,
+    SHRAPNEL: BULLET_FIELDS,
+    LASER: BULLET_FIELDS,
+    # GrenadeObject: time until armed, time until exploded, seed
+    GRENADE: BULLET_FIELDS + [Duration(), Duration(), Integer('H')],
+    }
+
+class Schema(object):
+    def __init__(self, fields):
+        self.fields = fields
+        self.full = struct.Struct('<' + ''.join([f.fmt for f in fields]))
+
+    def pack(self, attributes, indices = None):
+        if indices is None:
+            if len(attributes) != len(self.fields):
+                raise Unencodable("Expected %i attributes, got %i" % (len(self.fields), len(attributes)))
+            values = []
+            for field, value in zip(self.fields, attributes):
+                values.extend(field.toWire(value))
+            return self.full.pack(*values)
+        values = []
+        fmt = '<'
+        for i, value in zip(indices, attributes):
+            field = self.fields[i]
+            fmt += field.fmt
+            values.extend(field.toWire(value))
+        return struct.pack(fmt, *values)
+
+    def unpack(self, data, offset, indices = None):
+        """(values, offset after them)"""
+        if indices is None:
+            fields = self.fields
+            raw = self.full.unpack_from(data, offset)
+            offset += self.full.size
+        else:
+            fields = [self.fields[i] for i in indices]
+            fmt = '<' + ''.join([f.fmt for f in fields])
+            raw = struct.unpack_from(fmt, data, offset)
+            offset += struct.calcsize(fmt)
+        values = []
+        i = 0
+        for field in fields:
+            values.append(field.fromWire(raw[i:i + field.count]))
+            i += field.count
+        return values, offset
+
+schemas = {}
+for objectType, fields in SCHEMAS.items():
+    schemas[objectType] = Schema(fields)
+
+def schemaFor(type):
+    schema = schemas.get(type)
+    if schema is None:
+        raise Unencodable("No schema for type %s" % type)
+    return schema
+
+class NameTable(object):
+    """Small integer IDs for object names. The server hands them out and
+    takes them back once a name has been gone from the world for longer than
+    any client can still be using a baseline it was in, see keep. Clients
+    learn them from the full records that introduce an object and forget
+    them when told it was removed."""
+    def __init__(self, maxAge = 64):
+        self.maxAge = maxAge
+        self.ids = {}
+        self.names = {}
+        self.types = {}
+        self.lastUsed = {}
+        self.free = []
+        self.next = 0
+        self.sequence = 0
+
+    def idFor(self, name, type = None):
+        if type is not None:
+            self.types[name] = type
+        id = self.ids.get(name)
+        if id is None:
+            if self.free:
+                id = self.free.pop()
+            elif self.next > 0xffff:
+                raise Unencodable("Out of object IDs")
+            else:
+                id = self.next
+                self.next += 1
+            self.ids[name] = id
+            self.names[id] = name
+        self.lastUsed[name] = self.sequence
+        return id
+
+    def keep(self, names, sequence):
+        """The names still in the world at sequence. Objects that haven't
+        changed aren't in any records, this is what keeps their IDs."""
+        self.setSequence(sequence)
+        lastUsed = self.lastUsed
+        for name in names:
+            if name in lastUsed:
+                lastUsed[name] = sequence
+
+    def setSequence(self, sequence):
+        if sequence == self.sequence:
+            return
+        self.sequence = sequence
+        if sequence % 16 == 0:
+            for name, used in self.lastUsed.items():
+                if used < sequence - self.maxAge:
+                    self.forget(self.ids[name])
+
+    def learn(self, id, name):
+        old = self.names.get(id)
+        if old is not None and old != name:
+            self.ids.pop(old, None)
+        self.names[id] = name
+        self.ids[name] = id
+
+    def forget(self, id):
+        name = self.names.pop(id, None)
+        if name is not None:
+            del self.ids[name]
+            self.types.pop(name, None)
+            if name in self.lastUsed:
+                del self.lastUsed[name]
+                self.free.append(id)
+        return name
+
+CONNECT_FORMAT = struct.Struct('<BI')
+PING_FORMAT = struct.Struct('<BIi')
+PONG_FORMAT = struct.Struct('<BId')
+INPUT_FORMAT = struct.Struct('<BHIi')
+INPUTS_FORMAT = struct.Struct('<BIiB')
+PRESSES = struct.Struct('<HI')
+SNAPSHOT_FORMAT = struct.Struct('<BdfIiiH')
+# After the name, the position and the seed
+EXPLOSION_FORMAT = struct.Struct('<iiH')
+FULL_RECORD = struct.Struct('<BBHB')
+DELTA_RECORD = struct.Struct('<BBHH')
+COUNT = struct.Struct('<H')
+ID = struct.Struct('<H')
+BYTE = struct.Struct('<B')
+DIRECTION = Direction()
+
+def _stringsSize(strings):
+    size = 1
+    for s in strings:
+        size += 1 + len(s)
+    return size
+
+def recordSize(record):
+    """How many bytes a snapshot record takes in the binary format, without
+    packing it."""
+    if len(record) == 3:
+        # Deltas are [index, value, ...] and no field is bigger than a
+        # position, 8 bytes
+        return DELTA_RECORD.size + 4*len(record[1]) + _stringsSize(record[-1])
+    schema = schemas.get(record[3])
+    if schema is None:
+        # Would go as banana, guess
+        return FULL_RECORD.size + len(record[0]) + 16*len(record[1]) + _stringsSize(record[-1])
+    return FULL_RECORD.size + len(record[0]) + schema.full.size + _stringsSize(record[-1])
+
+# A snapshot with no records in it
+SNAPSHOT_SIZE = SNAPSHOT_FORMAT.size + COUNT.size
+
+# Where lastInput is in a binary snapshot's header
+LAST_INPUT = struct.Struct('<i')
+LAST_INPUT_OFFSET = struct.calcsize('<BdfIi')
+
+def setLastInput(data, lastInput):
+    """A binary snapshot with lastInput in its header instead, so clients
+    that get the same records can share the rest of it. None for anything
+    else, that has to be encoded again."""
+    if not data or ord(data[0]) != SNAPSHOT:
+        return None
+    return data[:LAST_INPUT_OFFSET] + LAST_INPUT.pack(lastInput) + \
+           data[LAST_INPUT_OFFSET + LAST_INPUT.size:]
+
+def snapshotHeader(data):
+    """(time, time until update, sequence, baseline, last input) of a binary
+    snapshot without decoding any of its records, None for anything else."""
+    if not data or ord(data[0]) != SNAPSHOT:
+        return None
+    return SNAPSHOT_FORMAT.unpack_from(data, 0)[1:6]
+
+def _length(s):
+    if len(s) > 0xff:
+        raise Unencodable("Too long for a byte length: %i" % len(s))
+    return BYTE.pack(len(s))
+
+def _packStrings(strings, parts):
+    parts.append(_length(strings))
+    for s in strings:
+        parts.append(_length(s))
+        parts.append(s)
+
+def _unpackStrings(data, offset):
+    count = ord(data[offset])
+    offset += 1
+    strings = []
+    for i in range(count):
+        length = ord(data[offset])
+        strings.append(data[offset + 1:offset + 1 + length])
+        offset += 1 + length
+    return strings, offset
+
+class Codec(object):
+    """Encodes in the format it was made with, decodes either. Keeps the
+    object ID table, so there is one per connection on the client and one
+    for all clients on the server."""
+    def __init__(self, format = None, level = 4):
+        self.format = format or default
+        if self.format not in FORMATS:
+            raise ValueError("Unknown wire format %s" % format)
+        self.level = level
+        self.table = NameTable()
+
+    def encode(self, data):
+        if self.format == BINARY:
+            try:
+                return self.encodeBinary(data)
+            except Unencodable:
+                # Something the schemas don't cover, banana can send anything
+                pass
+        return zlib.compress(banana.encode(data), self.level)
+
+    def decode(self, data):
+        if data[0] == ZLIB:
+            return banana.decode(zlib.decompress(data))
+        return self.decodeBinary(data)
+
+    def encodeBinary(self, data):
+        if data[0] == "c":
+            return CONNECT_FORMAT.pack(CONNECT, data[1])
+        if data[0] == "e":
+            parts = [BYTE.pack(EVENT), _length(data[1]), data[1]]
+            _packStrings(data[2], parts)
+            return ''.join(parts)
+        if data[0] == "x":
+            return ''.join([BYTE.pack(EXPLOSION), _length(data[1]), data[1],
+                            EXPLOSION_FORMAT.pack(*(POSITION.toWire(data[2]) + (data[3],)))])
+        if data[0] == "s":
+            parts = [BYTE.pack(SPAWN)]
+            self.packFullRecord(data[1], parts)
+            return ''.join(parts)
+        if data[0] == "i":
+            parts = [INPUTS_FORMAT.pack(INPUTS, data[1], data[3], len(data[2]))]
+            for direction, presses in data[2]:
+                parts.append(PRESSES.pack(DIRECTION.toWire(direction)[0], presses))
+            return ''.join(parts)
+        if data[0] == "p":
+            if type(data[2]) == float:
+                return PONG_FORMAT.pack(PONG, data[1], data[2])
+            return PING_FORMAT.pack(PING, data[1], data[2])
+        if len(data) == 7:
+            return self.encodeSnapshot(data)
+        ack = -1
+        if len(data) > 2:
+            ack = data[2]
+        return INPUT_FORMAT.pack(INPUT, DIRECTION.toWire(data[0])[0], data[1], ack)
+
+    def encodeSnapshot(self, data):
+        records, now, timeUntilUpdate, sequence, baseline, removed, lastInput = data
+        table = self.table
+        table.setSequence(sequence)
+        parts = [SNAPSHOT_FORMAT.pack(SNAPSHOT, now, timeUntilUpdate, sequence, baseline, lastInput, len(records))]
+        for record in records:
+            name = record[0]
+            if len(record) == 3:
+                # [name, [index, value, ...], events], the type was given
+                # when the object was sent in full
+                id = table.idFor(name)
+                delta = record[1]
+                indices = delta[0::2]
+                mask = 0
+                for i in indices:
+                    mask |= 1 << i
+                type = table.types[name]
+                parts.append(DELTA_RECORD.pack(0, type, id, mask))
+                # Fields go out in index order
+                order = sorted(range(len(indices)), key = indices.__getitem__)
+                parts.append(schemaFor(type).pack([delta[2*k + 1] for k in order],
+                                                [indices[k] for k in order]))
+                _packStrings(record[-1], parts)
+            else:
+                self.packFullRecord(record, parts)
+        parts.append(COUNT.pack(len(removed)))
+        for name in removed:
+            parts.append(ID.pack(table.idFor(name)))
+        return ''.join(parts)
+
+    def packFullRecord(self, record, parts):
+        # [name, attributes, isCurrentPlayer, type, events]
+        name = record[0]
+        type = record[3]
+        id = self.table.idFor(name, type)
+        flags = FULL_RECORD_FLAG
+        if record[2]:
+            flags |= CURRENT_PLAYER_FLAG
+        schema = schemaFor(type)
+        if len(name) > 0xff:
+            raise Unencodable("Name too long: %s" % name)
+        parts.append(FULL_RECORD.pack(flags, type, id, len(name)))
+        parts.append(name)
+        parts.append(schema.pack(record[1]))
+        _packStrings(record[-1], parts)
+
+    def unpackFullRecord(self, data, offset):
+        """(record, offset after it)"""
+        flags, type, id, length = FULL_RECORD.unpack_from(data, offset)
+        offset += FULL_RECORD.size
+        name = data[offset:offset + length]
+        offset += length
+        self.table.learn(id, name)
+        attributes, offset = schemas[type].unpack(data, offset)
+        events, offset = _unpackStrings(data, offset)
+        return [name, attributes, 1 if flags & CURRENT_PLAYER_FLAG else 0, type, events], offset
+
+    def decodeBinary(self, data):
+        kind = ord(data[0])
+        if kind == CONNECT:
+            kind, session = CONNECT_FORMAT.unpack(data)
+            return ["c", session]
+        if kind == PING:
+            kind, number, roundTripTime = PING_FORMAT.unpack(data)
+            return ["p", number, roundTripTime]
+        if kind == PONG:
+            kind, number, time = PONG_FORMAT.unpack(data)
+            return ["p", number, time]
+        if kind == INPUT:
+            kind, direction, presses, ack = INPUT_FORMAT.unpack(data)
+            x, y = DIRECTION.fromWire((direction,))
+            return [(x, y, 0), presses, ack]
+        if kind == SNAPSHOT:
+            return self.decodeSnapshot(data)
+        if kind == INPUTS:
+            kind, sequence, ack, count = INPUTS_FORMAT.unpack_from(data, 0)
+            inputs = []
+            offset = INPUTS_FORMAT.size
+            for i in range(count):
+                direction, presses = PRESSES.unpack_from(data, offset)
+                offset += PRESSES.size
+                x, y = DIRECTION.fromWire((direction,))
+                inputs.append([(x, y, 0), presses])
+            return ["i", sequence, inputs, ack]
+        if kind == EVENT:
+            length = ord(data[1])
+            events, offset = _unpackStrings(data, 2 + length)
+            return ["e", data[2:2 + length], events]
+        if kind == SPAWN:
+            record, offset = self.unpackFullRecord(data, 1)
+            return ["s", record]
+        if kind == EXPLOSION:
+            length = ord(data[1])
+            x, y, seed = EXPLOSION_FORMAT.unpack_from(data, 2 + length)
+            return ["x", data[2:2 + length], POSITION.fromWire((x, y)), seed]
+        raise ValueError("Unknown packet kind %i" % kind)
+
+    def decodeSnapshot(self, data):
+        table = self.table
+        kind, now, timeUntilUpdate, sequence, baseline, lastInput, count = SNAPSHOT_FORMAT.unpack_from(data, 0)
+        offset = SNAPSHOT_FORMAT.size
+        records = []
+        for r in range(count):
+            flags = ord(data[offset])
+            if flags & FULL_RECORD_FLAG:
+                record, offset = self.unpackFullRecord(data, offset)
+                records.append(record)
+            else:
+                flags, type, id, mask = DELTA_RECORD.unpack_from(data, offset)
+                offset += DELTA_RECORD.size
+                indices = [i for i in range(16) if mask & (1 << i)]
+                values, offset = schemas[type].unpack(data, offset, indices)
+                events, offset = _unpackStrings(data, offset)
+                name = table.names.get(id)
+                if name is None:
+                    # Never told about it, nothing to apply this to
+                    continue
+                delta = []
+                for i, value in zip(indices, values):
+                    delta.append(i)
+                    delta.append(value)
+                records.append([name, delta, events])
+        removed = []
+        (count,) = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        for r in range(count):
+            (id,) = ID.unpack_from(data, offset)
+            offset += ID.size
+            name = table.forget(id)
+            if name is not None:
+                removed.append(name)
+        return [records, now, timeUntilUpdate, sequence, baseline, removed, lastInput]
@@ -0,0 +1,190 @@
+# Compares the binary wire format in protocol.py against banana+zlib (the
+# baseline measured by encode.py) on realistic snapshot, input and ping
+# packets, and checks that everything survives the round trip to within the
+# quantization of its field, and that clients sent the same records share
+# one encoded snapshot.
+#
+# Usage: python protocolbench.py [--players 2,8,16,32] [--bullets 0,50,200]
+#                                [--repeat 200] [--seed 1]
+
+import random, math
+from optparse import OptionParser
+from twisted.spread import banana
+from zlib import compress, decompress
+from metrics import clock, Metrics
+from objects import PERSON, BULLET, GRENADE
+from snapshot import Snapshot, SharedPackets, FULL
+from bandwidth import Bandwidth
+import protocol
+
+def randomPerson(name, current):
+    angle = random.uniform(0, 2*math.pi)
+    return [name,
+            [[random.uniform(-70, 80), random.uniform(-45, 100)],
+             [random.uniform(-1, 1), 0, 0],
+             [random.uniform(-5, 5), random.uniform(-5, 5)],
+             [random.uniform(-20, 20), random.uniform(-20, 20)],
+             [math.cos(angle), math.sin(angle)],
+             random.randint(0, 100),
+             random.randint(0, 8),
+             random.randint(0, 100),
+             random.uniform(0, 2),
+             0,
+             random.randint(0, 31),
+             random.randint(-10, 50),
+             random.randint(0, 300),
+             random.uniform(0, 0.1)],
+            current,
+            PERSON,
+            random.choice([[], [], ['shoot'], ['hit']])]
+
+def randomBullet(name):
+    type = random.choice([BULLET, BULLET, BULLET, GRENADE])
+    attributes = [[random.uniform(-70, 80), random.uniform(-45, 100)],
+                  [random.uniform(-120, 120), random.uniform(-120, 120)]]
+    if type == GRENADE:
+        attributes += [random.uniform(0, 0.25), random.uniform(0, 2.75), random.randint(0, 10000)]
+    return [name, attributes, 0, type, []]
+
+def fullSnapshot(numPlayers, numBullets, sequence):
+    records = [randomPerson("p%i" % i, i == 0) for i in range(numPlayers)]
+    records += [randomBullet("p%ib%i" % (i % max(numPlayers, 1), i)) for i in range(numBullets)]
+    return [records, 1234567890.5, 0.004, sequence, -1, [], sequence*10]
+
+def deltaSnapshot(full, sequence):
+    # What a typical delta looks like, players moving, everything else idle
+    records = []
+    for record in full[0]:
+        if record[3] == PERSON:
+            records.append([record[0],
+                            [0, [record[1][0][0] + 0.1, record[1][0][1]],
+                             3, [record[1][3][0] + 0.5, record[1][3][1]]],
+                            record[4]])
+    return [records, 1234567890.6, 0.004, sequence, sequence - 1, [], sequence*10]
+
+def inputPacket(redundancy = 24):
+    # See inputs.py, consecutive inputs are usually close to the same
+    angle = random.uniform(0, 2*math.pi)
+    presses = random.randint(0, 1 << 18)
+    inputs = []
+    for i in range(redundancy):
+        angle += random.uniform(-0.05, 0.05)
+        inputs.append([(math.cos(angle), math.sin(angle), 0), presses])
+    return ["i", random.randint(0, 100000), inputs, random.randint(0, 5000)]
+
+def time(f, repeat):
+    start = clock()
+    for i in xrange(repeat):
+        result = f()
+    return (clock() - start) / repeat, result
+
+def worstError(a, b):
+    """Largest difference between two decoded messages, None if they don't
+    have the same shape."""
+    if type(a) in (list, tuple):
+        if type(b) not in (list, tuple) or len(a) != len(b):
+            return None
+        worst = 0.0
+        for x, y in zip(a, b):
+            error = worstError(x, y)
+            if error is None:
+                return None
+            worst = max(worst, error)
+        return worst
+    if type(a) == str or type(b) == str:
+        if a == b:
+            return 0.0
+        return None
+    return abs(a - b)
+
+def compare(label, message, repeat, introduce = None):
+    print label
+    reference = banana.decode(banana.encode(message))
+    # Same variants as encode.py
+    for name, level in (("banana", None), ("banana zip1", 1), ("banana zip4", 4)):
+        if level is None:
+            encodeTime, data = time(lambda: banana.encode(message), repeat)
+            decodeTime, decoded = time(lambda: banana.decode(data), repeat)
+        else:
+            encodeTime, data = time(lambda: compress(banana.encode(message), level), repeat)
+            decodeTime, decoded = time(lambda: banana.decode(decompress(data)), repeat)
+        print "    %-12s %6i bytes  enc %8.1fus  dec %8.1fus" % (name, len(data), encodeTime*1e6, decodeTime*1e6)
+
+    # Fresh codecs each time so the name table starts out the same
+    sender = protocol.Codec(protocol.BINARY)
+    receiver = protocol.Codec(protocol.BINARY)
+    if introduce:
+        # A delta only makes sense to someone who was sent the objects
+        receiver.decode(sender.encode(introduce))
+    encodeTime, data = time(lambda: sender.encode(message), repeat)
+    decodeTime, decoded = time(lambda: receiver.decode(data), repeat)
+    print "    %-12s %6i bytes  enc %8.1fus  dec %8.1fus" % ("binary", len(data), encodeTime*1e6, decodeTime*1e6)
+    if data[0] == protocol.ZLIB:
+        print "    !! binary fell back to banana"
+    error = worstError(reference, decoded)
+    if error is None:
+        print "    !! round trip changed the shape of the message"
+    else:
+        print "    round trip worst error %.5f" % error
+
+def sharing(numPlayers):
+    """Two clients built their own views of the same records and a third
+    sees fewer. Two more are over their byte rate, so their snapshots are
+    cut down the same way. Over two updates the second and the fifth should
+    never need a packet of their own."""
+    print "sharing, %i players" % numPlayers
+    codec = protocol.Codec(protocol.BINARY)
+    receiver = protocol.Codec(protocol.BINARY)
+    metrics = Metrics()
+    bandwidth = [None, None, None,
+                 Bandwidth(metrics, "d", 300, 3000), Bandwidth(metrics, "e", 300, 3000)]
+    baselines = [(FULL, None)] * 5
+    for sequence in (1, 2):
+        world = Snapshot()
+        for record in fullSnapshot(numPlayers, 0, sequence)[0]:
+            world.add(record[0], (record[1], record[3]))
+        # Like the interest filter, each client gets its own Snapshot
+        views = [Snapshot(list(world.names), dict(world.objects)) for i in range(5)]
+        views[2] = Snapshot(world.names[1:], dict(world.objects))
+        packets = SharedPackets(codec.encode, 1234567890.5, 0.004, sequence)
+        decoded = []
+        own = []
+        for i in range(5):
+            baseline, baselineSnapshot = baselines[i]
+            view = views[i]
+            if bandwidth[i] is not None:
+                view, events = bandwidth[i].schedule(view, {}, baselineSnapshot, "p0", sequence * 0.1)
+            view = packets.view(view)
+            encoded = packets.encoded
+            packet = packets.packet(view, baseline, baselineSnapshot, None, {}, 100 + i)
+            if packets.encoded > encoded:
+                own.append(i)
+            decoded.append(receiver.decode(packet))
+            baselines[i] = (sequence, view)
+        print "    update %i: %i encoded for 5 clients" % (sequence, packets.encoded)
+        if 1 in own or 4 in own:
+            print "    !! clients sent the same records should have shared a packet"
+        if [d[6] for d in decoded] != range(100, 105) or decoded[0][:6] != decoded[1][:6] or \
+           decoded[3][:6] != decoded[4][:6]:
+            print "    !! shared packets differ by more than lastInput"
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--players", default="2,8,16,32")
+    parser.add_option("--bullets", default="0,50,200")
+    parser.add_option("--repeat", type="int", default=200)
+    parser.add_option("--seed", type="int", default=1)
+    options, args = parser.parse_args()
+    random.seed(options.seed)
+
+    compare("ping", ["p", 12, 7], options.repeat)
+    compare("input", inputPacket(), options.repeat)
+    for numPlayers in [int(x) for x in options.players.split(",")]:
+        for numBullets in [int(x) for x in options.bullets.split(",")]:
+            full = fullSnapshot(numPlayers, numBullets, 10)
+            compare("full snapshot, %i players, %i projectiles" % (numPlayers, numBullets), full, options.repeat)
+        compare("delta snapshot, %i players" % numPlayers, deltaSnapshot(full, 11), options.repeat, full)
+        sharing(numPlayers)
+
+if __name__ == "__main__":
+    main()
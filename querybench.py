@@ -0,0 +1,178 @@
+# Times the WorldQuery against scanning everything, on dm_arena's statics
+# and a crowd of things scattered over the level, and checks both give the
+# same answers.
+#
+#   raycast    nearest static hit, walking the grid vs the old search of
+#              every cell in the segment's bounding box vs every box
+#   sight      whether anything's in the way at all
+#   overlap    everything inside a circle
+#   nearest    the k nearest
+#
+# Usage: python querybench.py [--entities 32,128,512] [--queries 2000]
+#                             [--seed 1]
+
+import os, random, math
+from optparse import OptionParser
+from metrics import clock, Metrics
+from registry import ObjectRegistry
+from worldquery import WorldQuery
+from objects import Generator, PERSON, GRENADE
+import level
+
+class Body(object):
+    def __init__(self, position):
+        self.position = position
+
+    def getPosition(self):
+        return self.position
+
+class Thing(object):
+    """Just enough of an object for the query to index."""
+    def __init__(self, name, type, position):
+        self._name = name
+        self._gameID = Generator.nextID()
+        self.type = type
+        self._body = Body(position)
+
+    def isDead(self):
+        return False
+
+    def getBody(self):
+        return self._body
+
+def segments(count, length, bounds):
+    minX, maxX, minY, maxY = bounds
+    result = []
+    for i in range(count):
+        x = random.uniform(minX, maxX)
+        y = random.uniform(minY, maxY)
+        angle = random.uniform(0, 2*math.pi)
+        result.append((x, y, x + length*math.cos(angle), y + length*math.sin(angle)))
+    return result
+
+def time(f, items):
+    start = clock()
+    results = [f(*item) for item in items]
+    return (clock() - start) / max(len(items), 1), results
+
+def bruteCast(boxes):
+    def cast(x0, y0, x1, y1):
+        best = None
+        for box in boxes:
+            hit = box.segmentCast(x0, y0, x1 - x0, y1 - y0)
+            if hit is not None and (best is None or hit[0] < best[0]):
+                best = (hit[0], hit[1], hit[2], box)
+        return best
+    return cast
+
+def boundsCast(index):
+    # What StaticIndex.segmentCast did before it walked the grid
+    def cast(x0, y0, x1, y1):
+        best = None
+        for i in index.candidates(min(x0, x1), max(x0, x1), min(y0, y1), max(y0, y1)):
+            box = index.boxes[i]
+            hit = box.segmentCast(x0, y0, x1 - x0, y1 - y0)
+            if hit is not None and (best is None or hit[0] < best[0]):
+                best = (hit[0], hit[1], hit[2], box)
+        return best
+    return cast
+
+def sameHits(a, b):
+    for p, q in zip(a, b):
+        if (p is None) != (q is None) or (p is not None and abs(p[0] - q[0]) > 1e-9):
+            return False
+    return True
+
+def report(label, fast, slow, same, name = "brute"):
+    print "    %-26s %8.2fus  %s %8.2fus  %5.1fx%s" % \
+          (label, fast*1e6, name, slow*1e6, slow / max(fast, 1e-12),
+           ["  !! answers differ", ""][same])
+
+def rays(index, bounds, count):
+    brute = bruteCast(index.boxes)
+    old = boundsCast(index)
+    print "statics, %i boxes" % len(index.boxes)
+    for length in (0.1, 5.0, 25.0, 100.0):
+        items = segments(count, length, bounds)
+        fast, hits = time(index.segmentCast, items)
+        slow, expected = time(brute, items)
+        report("raycast %gm" % length, fast, slow, sameHits(hits, expected))
+        slower, before = time(old, items)
+        report("", fast, slower, sameHits(hits, before), "bounds")
+        fast, blocked = time(index.segmentBlocked, items)
+        report("sight %gm" % length, fast, slow,
+               blocked == [hit is not None for hit in expected])
+
+def entities(index, bounds, numEntities, count):
+    minX, maxX, minY, maxY = bounds
+    objects = ObjectRegistry()
+    for i in range(numEntities):
+        position = (random.uniform(minX, maxX), random.uniform(minY, maxY), 0.0)
+        objects.add(Thing("e%i" % i, [PERSON, GRENADE][i % 4 == 0], position))
+    query = WorldQuery(index, objects, Metrics())
+    everything = list(objects)
+
+    print "%i entities" % numEntities
+    start = clock()
+    for i in range(100):
+        query.invalidate()
+        query._hash(PERSON)
+    print "    %-26s %8.2fus" % ("rebuild people", (clock() - start) / 100 * 1e6)
+
+    def bruteOverlap(x, y, radius, type):
+        found = []
+        for o in everything:
+            if o.type != type:
+                continue
+            position = o.getBody().getPosition()
+            if (position[0] - x)**2 + (position[1] - y)**2 <= radius*radius:
+                found.append(o)
+        return found
+
+    def bruteNearest(x, y, k, type):
+        found = []
+        for o in everything:
+            if o.type != type:
+                continue
+            position = o.getBody().getPosition()
+            found.append((math.sqrt((position[0] - x)**2 + (position[1] - y)**2), o))
+        found.sort()
+        return found[:k]
+
+    for radius in (4.0, 12.0, 25.0):
+        items = [(random.uniform(minX, maxX), random.uniform(minY, maxY), radius, PERSON)
+                 for i in range(count)]
+        fast, found = time(query.overlapCircle, items)
+        slow, expected = time(bruteOverlap, items)
+        same = [sorted([o._gameID for o in f]) for f in found] == \
+               [sorted([o._gameID for o in e]) for e in expected]
+        report("overlap %gm" % radius, fast, slow, same)
+
+    for k in (1, 5):
+        items = [(random.uniform(minX, maxX), random.uniform(minY, maxY), k, PERSON)
+                 for i in range(count)]
+        fast, found = time(query.nearest, items)
+        slow, expected = time(bruteNearest, items)
+        same = [[o for d, o in f] for f in found] == [[o for d, o in e] for e in expected]
+        report("nearest %i" % k, fast, slow, same)
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--entities", default="32,128,512")
+    parser.add_option("--queries", type="int", default=2000)
+    parser.add_option("--seed", type="int", default=1)
+    options, args = parser.parse_args()
+
+    # The level is loaded relative to the working directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    random.seed(options.seed)
+    arena = level.load('dm_arena.lvl')
+    index = arena.staticIndex([None] * len(arena.boxes))
+    bounds = arena.bounds
+
+    rays(index, bounds, options.queries)
+    for numEntities in [int(n) for n in options.entities.split(",")]:
+        entities(index, bounds, numEntities, options.queries)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# The registry keeps every live game object indexed by name and by game ID so
+# lookups and removals don't need to scan the whole world. Iteration order is
+# the order objects were added in, removed objects just leave a hole that gets
+# squeezed out once enough of them build up.
+
+class ObjectRegistry(object):
+    # Don't bother compacting until there are at least this many holes
+    minHolesBeforeCompact = 64
+
+    def __init__(self):
+        self._slots = []
+        self._slotOf = {}
+        self._byName = {}
+        self._byID = {}
+        self._byType = {}
+        # The type each object was added as, it's what it's filed under even
+        # if its type changes later
+        self._typeOf = {}
+        # ofType's answer for each type, until one of that type comes or goes
+        self._ordered = {}
+        self._holes = 0
+
+    def add(self, object):
+        if object._gameID in self._byID:
+            return object
+        self._slotOf[object._gameID] = len(self._slots)
+        self._slots.append(object)
+        self._byName[object._name] = object
+        self._byID[object._gameID] = object
+        self._byType.setdefault(object.type, {})[object._gameID] = object
+        self._typeOf[object._gameID] = object.type
+        self._ordered.pop(object.type, None)
+        return object
+
+    def remove(self, object):
+        slot = self._slotOf.pop(object._gameID, None)
+        if slot is None:
+            return
+        self._slots[slot] = None
+        self._holes += 1
+        del self._byID[object._gameID]
+        type = self._typeOf.pop(object._gameID)
+        del self._byType[type][object._gameID]
+        self._ordered.pop(type, None)
+        if self._byName.get(object._name) is object:
+            del self._byName[object._name]
+
+        if self._holes > self.minHolesBeforeCompact and self._holes * 2 > len(self._slots):
+            self.compact()
+
+    def compact(self):
+        # Build a fresh list rather than squashing in place, anyone still
+        # iterating over the old one carries on with a consistent view
+        if self._holes == 0:
+            return
+        self._slots = [o for o in self._slots if o is not None]
+        self._slotOf = {}
+        for i, o in enumerate(self._slots):
+            self._slotOf[o._gameID] = i
+        self._holes = 0
+
+    def get(self, name, default = None):
+        return self._byName.get(name, default)
+
+    def getByID(self, gameID, default = None):
+        return self._byID.get(gameID, default)
+
+    def ofType(self, type):
+        ordered = self._ordered.get(type)
+        if ordered is None:
+            # Game IDs only ever go up, so this is the order they were made in
+            objects = self._byType.get(type, {}).items()
+            objects.sort()
+            ordered = self._ordered[type] = [o for gameID, o in objects]
+        return list(ordered)
+
+    def clear(self):
+        self.__init__()
+
+    def __contains__(self, object):
+        return self._byID.get(object._gameID) is object
+
+    def __len__(self):
+        return len(self._slots) - self._holes
+
+    def __iter__(self):
+        # Objects added while iterating (bullets fired in preStep, shrapnel
+        # from explosions in postStep) are visited too, just like the old list
+        slots = self._slots
+        i = 0
+        while i < len(slots):
+            o = slots[i]
+            i += 1
+            if o is not None:
+                yield o
+
+    def __iadd__(self, objects):
+        for o in objects:
+            self.add(o)
+        return self
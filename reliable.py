@@ -0,0 +1,148 @@
+# A little reliability on top of UDP. Every datagram gets a sequence number
+# and carries the newest sequence number received from the other end, plus
+# a bit for each of the 32 before that, so both ends find out which of their
+# packets arrived without sending anything extra. Messages that have to get
+# there (events, projectiles that are only sent once) ride along in front of
+# whatever else is being sent and keep being resent until a packet that had
+# them in is acknowledged.
+#
+#   kind (protocol.RELIABLE), sequence, ack, ack bits, number of messages
+#   then for each message: id, length, the message as encoded by the codec
+#   then the unreliable payload as encoded by the codec
+
+import struct
+import protocol
+
+HEADER = struct.Struct('<BHHIB')
+MESSAGE = struct.Struct('<HH')
+
+def newer(a, b):
+    """Whether sequence number a comes after b, allowing for wrapping."""
+    return a != b and ((a - b) & 0xffff) < 0x8000
+
+def payload(data):
+    """The payload of a datagram without doing anything about what's in the
+    header, for datagrams from someone without a channel."""
+    if not data or ord(data[0]) != protocol.RELIABLE:
+        return data
+    kind, sequence, ack, ackBits, count = HEADER.unpack_from(data, 0)
+    offset = HEADER.size
+    for i in range(count):
+        id, length = MESSAGE.unpack_from(data, offset)
+        offset += MESSAGE.size + length
+    return data[offset:]
+
+class ReliableChannel(object):
+    # Most bytes of reliable messages in one packet, the rest is left for
+    # the snapshot
+    maxBytes = 256
+    # Unacknowledged messages kept before the oldest are given up on
+    maxPending = 1024
+
+    def __init__(self, codec, metrics, resendTime = 0.25):
+        self.codec = codec
+        self.metrics = metrics
+        self.resendTime = resendTime
+        self.sequence = 0
+        # Newest packet received from the other end, and which of the 32
+        # before it also arrived
+        self.remoteSequence = None
+        self.receivedBits = 0
+        self.nextID = 0
+        # [id, data, last sent] in the order they were sent
+        self.pending = []
+        # Packet sequence number -> ids of the messages in it
+        self.inFlight = {}
+        # Ids received recently, so resends aren't delivered twice
+        self.seen = {}
+        self.seenOrder = []
+        self._sent = metrics.counter('net.reliable.sent')
+        self._resent = metrics.counter('net.reliable.resent')
+        self._dropped = metrics.counter('net.reliable.dropped')
+
+    def send(self, message):
+        id = self.nextID
+        self.nextID = (self.nextID + 1) & 0xffff
+        self.pending.append([id, self.codec.encode(message), None])
+        if len(self.pending) > self.maxPending:
+            del self.pending[0]
+            self._dropped.value += 1
+
+    def wrap(self, data, now):
+        """data with the header and whatever messages are due in front."""
+        self.sequence = (self.sequence + 1) & 0xffff
+        parts = []
+        ids = []
+        size = 0
+        for message in self.pending:
+            id, encoded, lastSent = message
+            if lastSent is not None and now - lastSent < self.resendTime:
+                continue
+            if size + MESSAGE.size + len(encoded) > self.maxBytes or len(ids) == 0xff:
+                break
+            if lastSent is None:
+                self._sent.value += 1
+            else:
+                self._resent.value += 1
+            message[2] = now
+            parts.append(MESSAGE.pack(id, len(encoded)))
+            parts.append(encoded)
+            ids.append(id)
+            size += MESSAGE.size + len(encoded)
+        if ids:
+            self.inFlight[self.sequence] = ids
+        # Anything not acknowledged by now never will be, its messages have
+        # been resent since
+        self.inFlight.pop((self.sequence - 64) & 0xffff, None)
+        ack = self.remoteSequence
+        if ack is None:
+            ack = 0
+        return HEADER.pack(protocol.RELIABLE, self.sequence, ack, self.receivedBits, len(ids)) + \
+               ''.join(parts) + data
+
+    def unwrap(self, data):
+        """(reliable messages not seen before, payload)"""
+        if not data or ord(data[0]) != protocol.RELIABLE:
+            return [], data
+        kind, sequence, ack, ackBits, count = HEADER.unpack_from(data, 0)
+        offset = HEADER.size
+
+        self._received(sequence)
+        self._acknowledged(ack)
+        for i in range(32):
+            if ackBits & (1 << i):
+                self._acknowledged((ack - 1 - i) & 0xffff)
+
+        messages = []
+        for i in range(count):
+            id, length = MESSAGE.unpack_from(data, offset)
+            offset += MESSAGE.size
+            if id not in self.seen:
+                self.seen[id] = True
+                self.seenOrder.append(id)
+                if len(self.seenOrder) > 4*self.maxPending:
+                    del self.seen[self.seenOrder.pop(0)]
+                messages.append(self.codec.decode(data[offset:offset + length]))
+            offset += length
+        return messages, data[offset:]
+
+    def _received(self, sequence):
+        if self.remoteSequence is None:
+            self.remoteSequence = sequence
+        elif newer(sequence, self.remoteSequence):
+            shift = (sequence - self.remoteSequence) & 0xffff
+            if shift > 32:
+                self.receivedBits = 0
+            else:
+                self.receivedBits = ((self.receivedBits << shift) | (1 << (shift - 1))) & 0xffffffff
+            self.remoteSequence = sequence
+        else:
+            age = (self.remoteSequence - sequence) & 0xffff
+            if 0 < age <= 32:
+                self.receivedBits |= 1 << (age - 1)
+
+    def _acknowledged(self, sequence):
+        ids = self.inFlight.pop(sequence, None)
+        if ids:
+            delivered = dict.fromkeys(ids)
+            self.pending = [m for m in self.pending if m[0] not in delivered]
@@ -0,0 +1,90 @@
+# Where everyone's hitboxes were over the last second or so, so the server
+# can test a shot against what the shooter was looking at when they fired
+# rather than where everyone is by the time it hears about it. Each Person
+# gets a slot, and each slot a ring of physics ticks holding the centres of
+# its hitboxes (the sizes don't change, they come from getHitboxes). Every
+# tick overwrites the oldest entry, so the memory used only depends on how
+# many people there are.
+
+import math
+from array import array
+
+# Person.getHitboxes: legs, torso, head
+BOXES = 3
+FLOATS = BOXES * 2
+
+class HitboxHistory(object):
+    def __init__(self, stepSize, seconds = 1.0, capacity = 16):
+        self.stepSize = stepSize
+        self.length = int(math.ceil(seconds / stepSize)) + 1
+        self.tick = -1
+        self.slots = {}
+        self.free = []
+        self.capacity = 0
+        # [slot][tick][box centre x, y, ...]
+        self.centres = array('d')
+        # The tick each entry was recorded on, anything else is stale
+        self.recorded = array('l')
+        self._grow(capacity)
+
+    def _grow(self, capacity):
+        extra = capacity - self.capacity
+        self.centres.extend(array('d', [0.0]) * (extra * self.length * FLOATS))
+        self.recorded.extend(array('l', [-1]) * (extra * self.length))
+        self.free.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    def slotFor(self, name):
+        slot = self.slots.get(name)
+        if slot is None:
+            if not self.free:
+                self._grow(self.capacity * 2)
+            slot = self.slots[name] = self.free.pop()
+        return slot
+
+    def forget(self, name):
+        slot = self.slots.pop(name, None)
+        if slot is not None:
+            self.free.append(slot)
+            start = slot * self.length
+            for i in range(start, start + self.length):
+                self.recorded[i] = -1
+
+    def record(self, persons):
+        """Remembers where everyone's hitboxes are this tick."""
+        self.tick += 1
+        index = self.tick % self.length
+        centres = self.centres
+        for person in persons:
+            i = self.slotFor(person._name) * self.length + index
+            self.recorded[i] = self.tick
+            b = i * FLOATS
+            for location, round, cx, cy, hx, hy in person.getHitboxes():
+                centres[b] = cx
+                centres[b + 1] = cy
+                b += 2
+
+    def ticksFor(self, seconds):
+        return int(round(seconds / self.stepSize))
+
+    def hitboxes(self, person, ticksAgo):
+        """person's hitboxes ticksAgo ticks ago, or as far back as we have.
+        Same form as Person.getHitboxes."""
+        current = person.getHitboxes()
+        slot = self.slots.get(person._name)
+        if slot is None or ticksAgo <= 0:
+            return current
+        ticksAgo = min(ticksAgo, self.length - 1, self.tick)
+        tick = self.tick - ticksAgo
+        i = slot * self.length + tick % self.length
+        if self.recorded[i] != tick:
+            # Wasn't around then, use the oldest we have
+            while tick < self.tick and self.recorded[i] != tick:
+                tick += 1
+                i = slot * self.length + tick % self.length
+            if self.recorded[i] != tick:
+                return current
+        b = i * FLOATS
+        c = self.centres
+        return [(box[0], box[1], c[b + 2*k], c[b + 2*k + 1], box[4], box[5])
+                for k, box in enumerate(current)]
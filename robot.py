@@ -4,10 +4,13 @@ from engine import Engine
 import objects
 from objects import *
 import networkclient
+from snapshot import SnapshotReceiver
+from inputs import InputHistory
 import gamenet
-from encode import timer
 
 class Bot(Engine):
+    PHASES = ['input'] + Engine.PHASES
+
     def __init__(self, autoConnect = False):
         Engine.__init__(self)
 
@@ -30,11 +33,14 @@ class Bot(Engine):
         self.timeBetweenChatUpdates = 0.5
         self.timeUntilNextChatUpdate = 0.0            
             
-        self.network = networkclient.NetworkClient(ip, int(port))
+        self.network = networkclient.NetworkClient(ip, int(port), self.metrics)
         self.timeBetweenNetworkUpdates = 0.02
         self.timeUntilNextNetworkUpdate = 0.0
         self.serverRoundTripTime = 0.0
         self.lastServerUpdate = time.time()
+        self.snapshots = SnapshotReceiver()
+        self.inputs = InputHistory()
+        self.presses = None
         self.player = None
     
     def sendText(self):
@@ -74,7 +80,7 @@ class Bot(Engine):
 
     def displayScores(self):
         text = ""
-        players = [object for object in self.objects if object.type == objects.PERSON]
+        players = self.objects.ofType(objects.PERSON)
         for player in players:
             text += " %s, %2i, %4i; " % \
                     (player._name, player.score, player.ping)
@@ -94,71 +100,81 @@ class Bot(Engine):
         #self.displayVitals()
         print '\r',
     
+    def createFromServer(self, serverObject):
+        """Creates what a full snapshot record describes."""
+        newObject = None
+        if serverObject[2] == True:
+            newObject = Person(self, serverObject[Engine.NET_OBJECTS_NAME])
+            self.chat.setNickName(serverObject[Engine.NET_OBJECTS_NAME])
+            newObject.enable()
+            self.player = newObject
+        else:
+            if serverObject[Engine.NET_OBJECTS_TYPE] == objects.PERSON:
+                newObject = Person(self, serverObject[Engine.NET_OBJECTS_NAME])
+            elif serverObject[Engine.NET_OBJECTS_TYPE] == objects.BULLET:
+                newObject = BulletObject(self, serverObject[Engine.NET_OBJECTS_NAME])
+            elif serverObject[Engine.NET_OBJECTS_TYPE] == objects.GRENADE:
+                newObject = GrenadeObject(self, serverObject[Engine.NET_OBJECTS_NAME])
+            elif serverObject[Engine.NET_OBJECTS_TYPE] == objects.SHRAPNEL:
+                newObject = ShrapnelObject(self, serverObject[Engine.NET_OBJECTS_NAME])
+            elif serverObject[Engine.NET_OBJECTS_TYPE] == objects.LASER:
+                newObject = LaserObject(self, serverObject[Engine.NET_OBJECTS_NAME])
+            else:
+                print "Unknown object to create", serverObject[Engine.NET_OBJECTS_TYPE], objects.PERSON
+
+        if newObject:
+            newObject.existsOnServer = True        
+            newObject.setAttributes(serverObject[Engine.NET_OBJECTS_ATTRIBUTES])
+            newObject.setEvents(serverObject[Engine.NET_OBJECTS_EVENTS])
+            self.objects.add(newObject)
+        return newObject
+
+    def inputPhase(self):
+        if self.player != None and self.presses != None:
+            self.inputs.add(self.presses)
+
     def frameEnded(self, frameTime):
-        t = timer()
+        chatTimer = self.metrics.timer('client.chat')
+        networkTimer = self.metrics.timer('client.network')
 
         self.updateGUI(frameTime)
         
         Engine.frameEnded(self, frameTime)
 
-        t.start()
+        chatTimer.start()
         self.updateChat(frameTime)
-        t.stop()
-        t.debugChatTime = t.time()
+        self.debugChatTime = chatTimer.stop()
         
         self.timeUntilNextNetworkUpdate -= frameTime
-        t.start()
+        networkTimer.start()
 
         if self.timeUntilNextNetworkUpdate <= 0.0:
             self.timeUntilNextNetworkUpdate = self.timeBetweenNetworkUpdates
 
-            u = timer()
-            u.start()
             self.network.update(frameTime)
-            u.stop()
 
             for message in self.network._messages:
                 if message[1] > self.lastServerUpdate:
+                    records = self.snapshots.apply(message[Engine.NET_OBJECTS],
+                                                   message[Engine.NET_SEQUENCE],
+                                                   message[Engine.NET_BASELINE],
+                                                   message[Engine.NET_REMOVED])
+                    if records is None:
+                        continue
                     self.timeUntilNextEngineUpdate = message[Engine.NET_TIME_UNTIL_UPDATE]
                     self.lastServerUpdate = message[Engine.NET_TIME]
 
                     for object in self.objects:
                         object.existsOnServer = False
 
-                    for serverObject in message[Engine.NET_OBJECTS]:
-                        hasObject = False
-                        for object in self.objects:
-                            if serverObject[Engine.NET_OBJECTS_NAME] == object._name:
-                                hasObject = True
-                                object.existsOnServer = True
-                                object.setAttributes(serverObject[Engine.NET_OBJECTS_ATTRIBUTES])
-                                object.setEvents(serverObject[Engine.NET_OBJECTS_EVENTS])
-                        if not hasObject:
-                            newObject = None
-                            if serverObject[2] == True:
-                                newObject = Person(self, serverObject[Engine.NET_OBJECTS_NAME])
-                                self.chat.setNickName(serverObject[Engine.NET_OBJECTS_NAME])
-                                newObject.enable()
-                                self.player = newObject
-                            else:
-                                if serverObject[Engine.NET_OBJECTS_TYPE] == objects.PERSON:
-                                    newObject = Person(self, serverObject[Engine.NET_OBJECTS_NAME])
-                                elif serverObject[Engine.NET_OBJECTS_TYPE] == objects.BULLET:
-                                    newObject = BulletObject(self, serverObject[Engine.NET_OBJECTS_NAME])
-                                elif serverObject[Engine.NET_OBJECTS_TYPE] == objects.GRENADE:
-                                    newObject = GrenadeObject(self, serverObject[Engine.NET_OBJECTS_NAME])
-                                elif serverObject[Engine.NET_OBJECTS_TYPE] == objects.SHRAPNEL:
-                                    newObject = ShrapnelObject(self, serverObject[Engine.NET_OBJECTS_NAME])
-                                elif serverObject[Engine.NET_OBJECTS_TYPE] == objects.LASER:
-                                    newObject = LaserObject(self, serverObject[Engine.NET_OBJECTS_NAME])
-                                else:
-                                    print "Unknown object to create", serverObject[Engine.NET_OBJECTS_TYPE], objects.PERSON
-
-                            if newObject:
-                                newObject.existsOnServer = True        
-                                newObject.setAttributes(serverObject[Engine.NET_OBJECTS_ATTRIBUTES])
-                                newObject.setEvents(serverObject[Engine.NET_OBJECTS_EVENTS])
-                                self.objects += [newObject]
+                    for serverObject in records:
+                        object = self.objects.get(serverObject[Engine.NET_OBJECTS_NAME])
+                        if object:
+                            object.existsOnServer = True
+                            object.setAttributes(serverObject[Engine.NET_OBJECTS_ATTRIBUTES])
+                            object.setEvents(serverObject[Engine.NET_OBJECTS_EVENTS])
+                        else:
+                            self.createFromServer(serverObject)
 
                     for object in self.objects:
                         if not object.existsOnServer and object.type == objects.PERSON:
@@ -166,13 +182,25 @@ class Bot(Engine):
                             object.close()
                             del object
                         
+            # Reliable messages are only ever delivered once
+            for message in self.network.reliableMessages:
+                if message[0] == "s":
+                    if not self.objects.get(message[1][Engine.NET_OBJECTS_NAME]):
+                        self.createFromServer(message[1])
+                elif message[0] == "e":
+                    object = self.objects.get(message[1])
+                    if object:
+                        object.setEvents(message[2])
+
             self.network.clearMessages()
             
         if self.player != None:
-            self.network.send(self.player.input())
+            # Used for every physics tick until the next frame
+            self.presses = self.player.input()
+            if self.inputs.sequence >= 0:
+                self.network.send(self.inputs.message(self.snapshots.sequence))
 
-        t.stop()
-        self.debugNetworkTime = t.time()
+        self.debugNetworkTime = networkTimer.stop()
         return True # Keep running
     
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+# Runs the engine's subsystems each at its own rate. Physics steps at
+# 150Hz, but nothing else has to: gameplay timers, bots, snapshots, chat and
+# metrics each register a Task with how often they want to run, where in the
+# frame and how long a run should take.
+#
+# When a subsystem can't keep up it degrades rather than dragging everything
+# else down with it:
+#
+#   coalesce   one run covers all the time since the last one, however many
+#              intervals that was (timers just count down further)
+#   skip       a run that went over budget gives up the runs that the
+#              overrun ate into, for work that's only worth doing fresh
+#              (snapshots)
+#   defer      if the frame is already over the scheduler's frameBudget,
+#              deferrable tasks wait for the next frame, up to maxDeferrals
+#              frames in a row
+#
+# Every task's run time goes in the histogram scheduler.<name>, and how
+# often it was skipped, deferred, over budget or covering more than one
+# interval in counters under it.
+
+from metrics import clock
+
+COALESCE = 'coalesce'
+SKIP = 'skip'
+
+class Task(object):
+    def __init__(self, name, function, rate, priority, budget, overrun, deferrable, metrics):
+        self.name = name
+        # Called with the seconds since it last ran
+        self.function = function
+        # 0 to run every frame
+        self.interval = 0.0
+        if rate:
+            self.interval = 1.0 / rate
+        self.priority = priority
+        self.budget = budget
+        self.overrun = overrun
+        self.deferrable = deferrable
+        self.timeUntilNext = 0.0
+        self.elapsed = 0.0
+        self.deferrals = 0
+        self._time = metrics.histogram('scheduler.' + name)
+        self._skipped = metrics.counter('scheduler.%s.skipped' % name)
+        self._deferred = metrics.counter('scheduler.%s.deferred' % name)
+        self._overBudget = metrics.counter('scheduler.%s.overBudget' % name)
+        self._coalesced = metrics.counter('scheduler.%s.coalesced' % name)
+
+class Scheduler(object):
+    # Deferrable tasks wait while a frame has taken longer than this, 0 for
+    # never
+    frameBudget = 0.0
+    maxDeferrals = 4
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.tasks = []
+
+    def add(self, name, function, rate = 0.0, priority = 50, budget = 0.0,
+            overrun = COALESCE, deferrable = False):
+        """Lower priorities run first in a frame, tasks with the same
+        priority in the order they were added."""
+        task = Task(name, function, rate, priority, budget, overrun, deferrable, self.metrics)
+        self.tasks.append(task)
+        # Stable, so it's still added order within a priority
+        self.tasks.sort(key = lambda t: t.priority)
+        return task
+
+    def get(self, name):
+        for task in self.tasks:
+            if task.name == name:
+                return task
+        return None
+
+    def remove(self, name):
+        self.tasks = [t for t in self.tasks if t.name != name]
+
+    def update(self, frameTime):
+        start = clock()
+        for task in self.tasks:
+            task.elapsed += frameTime
+            task.timeUntilNext -= frameTime
+            if task.timeUntilNext > 0.0:
+                continue
+            if task.deferrable and self.frameBudget and task.deferrals < self.maxDeferrals and \
+               clock() - start > self.frameBudget:
+                task.deferrals += 1
+                task._deferred.value += 1
+                continue
+            task.deferrals = 0
+            # How many of its intervals this run covers
+            due = 1
+            if task.interval:
+                due = int(-task.timeUntilNext / task.interval) + 1
+                task.timeUntilNext += due * task.interval
+            if due > 1:
+                if task.overrun == SKIP:
+                    task._skipped.value += due - 1
+                else:
+                    task._coalesced.value += 1
+            elapsed = task.elapsed
+            task.elapsed = 0.0
+            taken = clock()
+            task.function(elapsed)
+            taken = clock() - taken
+            task._time.add(taken)
+            if task.budget and taken > task.budget:
+                task._overBudget.value += 1
+                if task.overrun == SKIP and task.interval:
+                    # Give up the runs the overrun ate into
+                    skipped = int(taken / task.interval)
+                    if skipped:
+                        task._skipped.value += skipped
+                        task.timeUntilNext += skipped * task.interval
+
+    def timeUntilNext(self):
+        """Until the next task with a rate is due, None if there aren't any."""
+        times = [t.timeUntilNext for t in self.tasks if t.interval]
+        if not times:
+            return None
+        return max(0.0, min(times))
@@ -1,25 +1,83 @@
 from engine import Engine
 import networkserver
 import os
-import time, encode
+import sys, time
 import gamenet
-from objects import Person, StaticObject, DynamicObject, SphereObject
+from snapshot import Snapshot, SharedPackets, FULL
+from interest import Interest, InterestIndex
+from bandwidth import Bandwidth
+from rewind import HitboxHistory
+from bots import Bots
+from scheduler import SKIP
+from objects import Person, StaticObject, DynamicObject, SphereObject, PERSON
 
 class Server(Engine):
-    def __init__(self):
+    analyticProjectiles = True
+    # Grenades do their damage with rays, clients are sent where each one
+    # went off and its seed and draw the shrapnel themselves
+    physicalShrapnel = False
+    # Each client's input is applied one command per physics tick, and
+    # everyone's hitboxes are remembered after it for lag compensation
+    PHASES = ['input'] + Engine.PHASES + ['history']
+    # Test shots against where the shooter saw everyone, their round trip
+    # plus the interpolation delay ago (see interpolation.py)
+    lagCompensation = True
+    interpolationDelay = 0.1
+    # Only send clients what's on their screen, plus interestMargin either
+    # side. People off screen are only updated every farUpdateInterval
+    # snapshots.
+    interestManagement = True
+    interestMargin = 10.0
+    farUpdateInterval = 5
+    # Keep snapshots inside one datagram and under a byte rate per client
+    bandwidthManagement = True
+    maxBytesPerSecond = 24000
+    # People played by the server, and how many times a second they think.
+    # Their thinking is spread over botRate calls a second.
+    numBots = 1
+    botThinkRate = 10.0
+    botRate = 50.0
+    # Building and sending snapshots shouldn't take longer than this, if it
+    # does the next ones are dropped rather than sent late
+    networkBudget = 0.02
+    # Seconds between checks for chat messages
+    timeBetweenChatUpdates = 0.5
+    # Nobody's watching the physics closely on a server, it can give up some
+    # accuracy to keep up
+    adaptiveIterations = True
+
+    def __init__(self, port = 10001):
         Engine.__init__(self)
-        port = 10001
-        self.network = networkserver.NetworkServer(self.clientConnected, port)
+        self.network = networkserver.NetworkServer(self.clientConnected, port, metrics = self.metrics)
         self.timeBetweenNetworkUpdates = 1.0/15.0
-        self.timeUntilNextNetworkUpdate = 0.0
         self.clientNumber = 0
+        self.snapshotNumber = 0
+        self.behind = [0.0, 0.0]
+        self.lastBehindWarning = 0.0
+        self.hitboxHistory = HitboxHistory(self.stepSize)
+        self.bots = Bots(self, self.botThinkRate)
+        # ["x", name, position, seed] for every grenade that's gone off since
+        # the last network update
+        self.explosions = []
+        self._fullSnapshots = self.metrics.counter('net.snapshots.full')
+        self._deltaSnapshots = self.metrics.counter('net.snapshots.delta')
+        self._encodedSnapshots = self.metrics.counter('net.snapshots.encoded')
 	self.debugNetworkTime = 0.0
 	ip = "cradle.dyndns.org"
 	self.serverChat = gamenet.NetCode("cradle", "cradle.dyndns.org", "AV-admin", "enter", "-".join([ip, str(port)]))
 	self.serverChat.registerMessageListener(self.messageListenerConsole)
 	self.serverChat.setNickName("server")
-	self.timeBetweenChatUpdates = 0.5
-	self.timeUntilNextChatUpdate = 0.0
+        # Snapshots go out first, before the frame's physics, as they always
+        # have. Bots, chat and metrics can wait a frame if it's running long.
+        self.scheduler.frameBudget = self.stepSize
+        self.scheduler.add('network', lambda elapsed: self.networkUpdate(),
+                           1.0 / self.timeBetweenNetworkUpdates, priority = 0,
+                           budget = self.networkBudget, overrun = SKIP)
+        self.scheduler.add('bots', lambda elapsed: self.bots.update(elapsed, 1.0 / self.botRate),
+                           self.botRate, priority = 5, budget = 0.002, deferrable = True)
+        self.scheduler.add('chat', lambda elapsed: self.serverChat.update(),
+                           1.0 / self.timeBetweenChatUpdates, priority = 80,
+                           budget = 0.005, deferrable = True)
         print "Server started"
 
     def engineMessageListener(self, message):
@@ -31,62 +89,173 @@ class Server(Engine):
     def clientConnected(self, client):
         self.clientNumber += 1
         client.player = self.createPerson("p%i" % self.clientNumber)
+        # Staggered so everyone's far updates don't land on the same snapshot
+        client.interest = Interest(self.farUpdateInterval)
+        client.interest.updates = self.clientNumber
+        client.bandwidth = Bandwidth(self.metrics, client.player._name,
+                                     maxBytesPerSecond = self.maxBytesPerSecond)
         client.player.setPosition(self.spawnLocation())
-        self.objects += [client.player]
+        self.objects.add(client.player)
         self.serverChat.sendMessage(client.player._name+ " connected")
 
     def _createWorld(self):
         Engine._createWorld(self)
-        bot = Person(self, "b1")
-        bot.setPosition(self.spawnLocation())
-        self.objects += [bot]
+        for i in range(self.numBots):
+            bot = Person(self, "b%i" % (i + 1))
+            bot.setPosition(self.spawnLocation())
+            self.objects.add(bot)
+            self.bots.add(bot)
+
+    def grenadeExploded(self, grenade):
+        Engine.grenadeExploded(self, grenade)
+        position = grenade.explodePos
+        self.explosions.append(["x", grenade._name, [position[0], position[1]], grenade.seed])
+
+    def historyPhase(self):
+        self.hitboxHistory.record(self.objects.ofType(PERSON))
+
+    def hitboxesSeenBy(self, name):
+        shooter = self.objects.get(name)
+        if not self.lagCompensation or shooter is None or not shooter.ping:
+            return Engine.hitboxesSeenBy(self, name)
+        # Person.ping is the round trip in hundredths of a second
+        ticks = self.hitboxHistory.ticksFor(shooter.ping / 100.0 + self.interpolationDelay)
+        result = []
+        for person in self.objects.ofType(PERSON):
+            if person is shooter:
+                result.append((person, person.getHitboxes()))
+            else:
+                result.append((person, self.hitboxHistory.hitboxes(person, ticks)))
+        return result
+
+    def inputPhase(self):
+        for client in self.network.clients:
+            presses = client.inputs.next()
+            if presses is not None:
+                client.player.inputPresses(presses)
+
+    def splitReliable(self, view, events, once = None):
+        """The reliable messages for what's in view, and the rest of view."""
+        if once is None:
+            once = view.once
+        messages = []
+        names = []
+        objects = {}
+        for name in view.names:
+            attributes, type = view.objects[name]
+            if name in once:
+                messages.append(["s", [name, attributes, 0, type, events.get(name, [])]])
+                continue
+            if name in events:
+                messages.append(["e", name, events[name]])
+            names.append(name)
+            objects[name] = view.objects[name]
+        return messages, Snapshot(names, objects)
 
     def networkUpdate(self):
         self.network.update()
-        while self.timeUntilNextNetworkUpdate <= 0.0:
-            self.timeUntilNextNetworkUpdate += self.timeBetweenNetworkUpdates
 
-        for client in self.network.clients:
-            if client.timedOut():
-                self.serverChat.sendMessage(client.player._name + " timed out, disconnecting")
-                client.player.close()
-                self.objects.remove(client.player)
-                self.network.clients.remove(client)
+        for client in self.network.expired():
+            self.serverChat.sendMessage(client.player._name + " timed out, disconnecting")
+            self.hitboxHistory.forget(client.player._name)
+            client.bandwidth.removeMetrics()
+            client.player.close()
+            self.objects.remove(client.player)
 
-        timer = encode.timer()
+        timer = self.metrics.timer('server.network')
         timer.start()
 
+        for message in self.explosions:
+            for client in self.network.clients:
+                client.sendReliable(message)
+        self.explosions = []
+
+        # Each client gets what changed since the last snapshot it
+        # acknowledged. Clients that acknowledged the same one and are sent
+        # the same things get the same packet, which is only built once,
+        # unless it's the one that tells them who they are.
+        self.snapshotNumber += 1
+        snapshot, events = Snapshot.fromObjects(self.objects)
+        # Everything still in the world keeps its ID, changed or not
+        self.network.codec.table.keep(snapshot.names, self.snapshotNumber)
+        index = None
+        if self.interestManagement:
+            index = InterestIndex(snapshot)
+        now = time.time()
+        codec = self.network.codec
+        packets = SharedPackets(lambda data: networkserver.encode(data, self.metrics, codec),
+                                now, self.timeUntilNextEngineUpdate, self.snapshotNumber)
+        unfiltered = None
         for client in self.network.clients:                
-            client.send([[[o._name,
-                           o.getAttributes(),
-                           1 if o._name == client.player._name else 0,
-                           o.type,
-                           o.getEvents()] for o in self.objects if o.shouldSendToClients()],
-                        time.time(), self.timeUntilNextEngineUpdate])
-            #parameter above is whether or not the player is the current player
+            view = snapshot
+            if index is not None:
+                view = client.interest.filter(index, client.player, self.interestMargin)
+                self.metrics.record('net.interest.objects', len(view.names))
+            # Events and things that are only sent once go on the reliable
+            # channel instead
+            if view is snapshot:
+                if unfiltered is None:
+                    unfiltered = self.splitReliable(snapshot, events)
+                messages, view = unfiltered
+            else:
+                messages, view = self.splitReliable(view, events, snapshot.once)
+            for message in messages:
+                client.sendReliable(message)
+            baseline, baselineSnapshot = client.baselines.baseline()
+            playerName = client.player._name
+            viewEvents = {}
+            # Cut down to the client's byte rate before looking for a packet
+            # to share, clients share one if what's left is the same
+            if self.bandwidthManagement:
+                view, viewEvents = client.bandwidth.schedule(view, viewEvents, baselineSnapshot, playerName, now)
+            view = packets.view(view)
+            if baselineSnapshot is not None and playerName in baselineSnapshot.objects:
+                playerName = None
+            lastInput = client.inputs.applied
+            if lastInput is None:
+                lastInput = -1
+            packet = packets.packet(view, baseline, baselineSnapshot, playerName, viewEvents, lastInput)
+            client.baselines.add(self.snapshotNumber, view)
+            size = client.sendEncoded(packet)
+            if self.bandwidthManagement:
+                client.bandwidth.sent(size, now)
+            if baseline == FULL:
+                self._fullSnapshots.value += 1
+            else:
+                self._deltaSnapshots.value += 1
                             
+            # Unsequenced input from older clients
             while client.hasMoreMessages():
                 client.player.inputPresses(client.pop())
 
-        timer.stop()
-        self.debugNetworkTime = timer.time()
+        self._encodedSnapshots.value += packets.encoded
+        self.debugNetworkTime = timer.stop()
 
         for o in self.objects:
             o.clearEvents()
 
     def frameEnded(self, frameTime):
-        self.timeUntilNextNetworkUpdate -= frameTime
-        if self.timeUntilNextNetworkUpdate <= 0.0:
-            self.networkUpdate()
-        
         Engine.frameEnded(self, frameTime)
 
         self.sleep()
         return self.network.reactor.running
 
+    def fellBehind(self, dropped, dilated):
+        # It keeps happening while the server's overloaded, so say how much
+        # once a second
+        self.behind[0] += dropped
+        self.behind[1] += dilated
+        now = time.time()
+        if now - self.lastBehindWarning >= 1.0:
+            print "Server fell behind: %.0fms dropped, %.0fms dilated, %i solver iterations" % \
+                  (self.behind[0]*1000, self.behind[1]*1000, self.currentIterations)
+            self.behind = [0.0, 0.0]
+            self.lastBehindWarning = now
+
     def sleep(self):
-        time.sleep(min(self.timeUntilNextNetworkUpdate,
-                       self.timeUntilNextEngineUpdate))
+        # Still behind after a stall with time carried over, don't wait
+        time.sleep(max(0.0, min(self.scheduler.timeUntilNext(),
+                                self.timeUntilNextEngineUpdate)))
 
 
 if __name__ == "__main__":
@@ -97,6 +266,9 @@ if __name__ == "__main__":
     except ImportError:
         print "No Psyco Support"
     engine = Server()
+    if len(sys.argv) > 1:
+        # python server.py metrics.txt, appends a metrics report every 10s
+        engine.metrics.dumpTo(sys.argv[1], 10.0)
     import cProfile
     cProfile.run('engine.go()', 'server-profile.txt')
     os._exit(0)
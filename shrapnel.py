@@ -0,0 +1,97 @@
+# What a grenade does when it goes off. It always did it by firing 50 bits
+# of shrapnel as projectiles that fly, ricochet and hit things one at a
+# time. That's fire(), and front ends still do it to draw the shrapnel.
+#
+# resolve() works the damage out in one go instead. The same 50 directions,
+# from the grenade's seed, are cast as rays from where it went off against
+# the statics and everyone's hitboxes, and every Person in the way is
+# damaged straight away. Each ray goes as far as the shrapnel would fly in
+# reachTime under air resistance. Ricochets and gravity are left out.
+#
+# Either way the directions come from the seed, so a client told the seed
+# and where the grenade went off draws the same shrapnel the server used.
+
+import math, random
+from objects import SHRAPNEL, PERSON
+from projectiles import PROPERTIES, windResistance
+from metrics import clock
+
+class Shrapnel(object):
+    count = 50
+    damage = 7
+    reachTime = 0.5
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._resolve = engine.metrics.histogram('shrapnel.resolve')
+        self._rays = engine.metrics.counter('shrapnel.rays')
+        self._hits = engine.metrics.counter('shrapnel.hits')
+
+    def directions(self, seed):
+        """((dx, dy), speed) for each bit, the same as fire() gives them.
+        addBullet uses up one more random number per bit on the speed."""
+        r = random.Random(seed)
+        result = []
+        for i in range(self.count):
+            dx = r.random() - 0.5
+            dy = r.random() - 0.5
+            length = math.sqrt(dx*dx + dy*dy)
+            velocity = r.randint(10, 25)
+            variation = 1 - (r.random() - 0.5)/5
+            result.append(((dx/length, dy/length), velocity * variation))
+        return result
+
+    def fire(self, name, ownerName, origin, seed):
+        random.seed(seed)
+        for i in range(self.count):
+            direction = [random.random()-0.5, random.random()-0.5, 0]
+            length = math.sqrt(direction[0]*direction[0] + direction[1]*direction[1])
+            direction[0] /= length
+            direction[1] /= length
+            velocity = random.randint(10,25)
+            self.engine.addBullet(SHRAPNEL,
+                                  name + "s" + str(i),
+                                  map((lambda a,b: a+b/5), origin, direction),
+                                  direction,
+                                  [velocity, velocity],
+                                  self.damage,
+                                  ownerName)
+
+    def reach(self, speed):
+        # Slowing down as dv/dt = -k*v*v covers log(1 + k*v*t)/k in t
+        k = windResistance / PROPERTIES[SHRAPNEL][0]
+        return math.log(1 + k*speed*self.reachTime) / k
+
+    def resolve(self, ownerName, origin, seed):
+        start = clock()
+        engine = self.engine
+        x, y = origin[0], origin[1]
+        segments = []
+        furthest = 0.0
+        for (dx, dy), speed in self.directions(seed):
+            reach = self.reach(speed)
+            furthest = max(furthest, reach)
+            # Starts a fifth of a metre out, as fire() puts them
+            x0, y0 = x + dx/5, y + dy/5
+            segments.append((x0, y0, x0 + dx*reach, y0 + dy*reach))
+        self._rays.value += len(segments)
+
+        # Only the people close enough to be hit, where the thrower saw them
+        near = {}
+        for person in engine.query.overlapCircle(x, y, furthest + 2.0, PERSON):
+            near[person] = True
+        hitboxes = []
+        if near:
+            hitboxes = [(person, boxes) for person, boxes in engine.hitboxesSeenBy(ownerName)
+                        if person in near]
+
+        if hitboxes:
+            cast = engine.projectiles.castHitboxes
+            for (x0, y0, x1, y1), wall in zip(segments, engine.query.raycasts(segments)):
+                hit = cast(x0, y0, x1 - x0, y1 - y0, hitboxes)
+                if hit is None or (wall is not None and wall[0] < hit[0]):
+                    continue
+                t, person, location = hit
+                self._hits.value += 1
+                engine.damage(person, self.damage, ownerName)
+        self._resolve.add(clock() - start)
@@ -0,0 +1,213 @@
+# Snapshots of the world as sent to clients. The server keeps the last few
+# snapshots it sent each client, and once the client acknowledges one of them
+# only the attributes that changed since then are sent. If the client hasn't
+# acknowledged anything recent enough it gets everything again.
+#
+# A snapshot message is
+#   [records, time, timeUntilNextEngineUpdate, sequence, baseline, removed,
+#    lastInput]
+# where baseline is -1 for a full snapshot, removed lists the names that were
+# in the baseline but aren't any more, lastInput is the sequence number of
+# the last of the client's inputs applied (see inputs.py) and each record is
+# either
+#   [name, attributes, isCurrentPlayer, type, events]   for objects new to the
+#                                                        client, or
+#   [name, [index, value, index, value, ...], events]    for the attributes
+#                                                        that changed
+#
+# The server sends events and the objects that are only sent once (see
+# Snapshot.once) on the reliable channel instead, so it leaves events empty.
+
+import protocol
+
+FULL = -1
+
+class Snapshot(object):
+    """What the client was told about every object, in the order it was told."""
+    def __init__(self, names = None, objects = None):
+        self.names = names or []
+        self.objects = objects or {}
+        # Names of the objects that are only sent once, reliably
+        self.once = {}
+
+    def add(self, name, record):
+        if name not in self.objects:
+            self.names.append(name)
+        self.objects[name] = record
+
+    def fromObjects(objects):
+        snapshot = Snapshot()
+        events = {}
+        for o in objects:
+            if o.shouldSendToClients():
+                snapshot.add(o._name, (o.getAttributes(), o.type))
+                if o.sendOnce:
+                    snapshot.once[o._name] = True
+                e = o.getEvents()
+                if e:
+                    events[o._name] = e
+        return snapshot, events
+
+    fromObjects = staticmethod(fromObjects)
+
+def changes(old, new):
+    if len(old) != len(new):
+        return None
+    result = []
+    for i in range(len(new)):
+        if old[i] != new[i]:
+            result.append(i)
+            result.append(new[i])
+    return result
+
+def encode(snapshot, events, baseline, playerName):
+    """The records and removed names to send one client, baseline is the
+    Snapshot it last acknowledged or None."""
+    records = []
+    for name in snapshot.names:
+        attributes, type = snapshot.objects[name]
+        old = baseline and baseline.objects.get(name)
+        if old is not None and old[1] == type:
+            delta = changes(old[0], attributes)
+            if delta is not None:
+                if delta or name in events:
+                    records.append([name, delta, events.get(name, [])])
+                continue
+        records.append([name,
+                        attributes,
+                        1 if name == playerName else 0,
+                        type,
+                        events.get(name, [])])
+    removed = []
+    if baseline:
+        removed = [name for name in baseline.names if name not in snapshot.objects]
+    return records, removed
+
+class Baselines(object):
+    """The snapshots sent to one client that it may still acknowledge."""
+    def __init__(self, size = 32):
+        self.size = size
+        self.sent = {}
+        self.acknowledged = FULL
+
+    def add(self, sequence, snapshot):
+        self.sent[sequence] = snapshot
+        old = sequence - self.size
+        if old in self.sent:
+            del self.sent[old]
+
+    def acknowledge(self, sequence):
+        if sequence > self.acknowledged and sequence in self.sent:
+            self.acknowledged = sequence
+            for s in self.sent.keys():
+                if s < sequence:
+                    del self.sent[s]
+
+    def baseline(self):
+        """(sequence, snapshot) to delta against, (FULL, None) if the last
+        acknowledged snapshot has dropped out of the ring."""
+        snapshot = self.sent.get(self.acknowledged)
+        if snapshot is None:
+            return FULL, None
+        return self.acknowledged, snapshot
+
+class SharedPackets(object):
+    """The snapshot packets built in one network update. Clients that see
+    the same records and acknowledged the same baseline get the same packet,
+    built once, with only the lastInput in its header their own. encode
+    turns a snapshot message into a packet."""
+    def __init__(self, encode, now, timeUntilUpdate, sequence):
+        self.encode = encode
+        self.now = now
+        self.timeUntilUpdate = timeUntilUpdate
+        self.sequence = sequence
+        self.views = {}
+        self.packets = {}
+        self.encoded = 0
+
+    def view(self, view):
+        """The first view this update with the same records as view. Records
+        are only ever replaced, never changed, so they're compared by
+        identity. Clients keep the returned one as their baseline, so equal
+        baselines are the same Snapshot too."""
+        key = tuple([(name, id(view.objects[name])) for name in view.names])
+        return self.views.setdefault(key, view)
+
+    def packet(self, view, baseline, baselineSnapshot, playerName, events, lastInput):
+        """view and baselineSnapshot have to have come from self.view."""
+        key = (baseline, id(baselineSnapshot), id(view), playerName, tuple(sorted(events)))
+        shared = self.packets.get(key)
+        if shared is None:
+            records, removed = encode(view, events, baselineSnapshot, playerName)
+            data = [records, self.now, self.timeUntilUpdate, self.sequence, baseline, removed, lastInput]
+            packet = self.encode(data)
+            self.packets[key] = (data, packet)
+            self.encoded += 1
+            return packet
+        data, packet = shared
+        if data[6] == lastInput:
+            return packet
+        patched = protocol.setLastInput(packet, lastInput)
+        if patched is None:
+            patched = self.encode(data[:6] + [lastInput])
+            self.encoded += 1
+        return patched
+
+class SnapshotReceiver(object):
+    """Rebuilds full snapshots on the client from deltas. Keeps as many
+    snapshots as the server can delta against."""
+    def __init__(self, size = 32):
+        self.size = size
+        self.received = {}
+        self.sequence = FULL
+
+    def apply(self, records, sequence, baseline, removed):
+        """Returns every object as a full record, or None if the message can't
+        be used (it's older than what we have or its baseline is gone)."""
+        if sequence <= self.sequence:
+            return None
+        if baseline == FULL:
+            names = []
+            objects = {}
+        else:
+            base = self.received.get(baseline)
+            if base is None:
+                return None
+            objects = dict(base.objects)
+            names = base.names
+            if removed:
+                for name in removed:
+                    objects.pop(name, None)
+                names = [name for name in names if name in objects]
+            else:
+                names = list(names)
+
+        events = {}
+        for record in records:
+            name = record[0]
+            if len(record) == 3:
+                old = objects.get(name)
+                if old is None:
+                    continue
+                attributes = list(old[0])
+                delta = record[1]
+                for i in range(0, len(delta), 2):
+                    attributes[delta[i]] = delta[i + 1]
+                objects[name] = (attributes, old[1], old[2])
+            else:
+                if name not in objects:
+                    names.append(name)
+                objects[name] = (record[1], record[2], record[3])
+            events[name] = record[-1]
+
+        self.received[sequence] = Snapshot(names, objects)
+        self.sequence = sequence
+        for s in self.received.keys():
+            if s <= sequence - self.size or s < baseline:
+                del self.received[s]
+
+        return [[name,
+                 objects[name][0],
+                 objects[name][1],
+                 objects[name][2],
+                 events.get(name, [])] for name in names]
@@ -0,0 +1,299 @@
+# Spatial helpers that work in the 2D plane the game is played in (z is
+# always 0 for anything that moves). Segments are given as a start point and
+# a delta so that t in [0, 1] covers the whole segment.
+
+import math
+
+def segmentCircle(x0, y0, dx, dy, cx, cy, r):
+    """Returns the t at which the segment enters the circle, or None."""
+    fx = x0 - cx
+    fy = y0 - cy
+    c = fx*fx + fy*fy - r*r
+    if c <= 0.0:
+        return 0.0 # Starts inside
+    a = dx*dx + dy*dy
+    if a == 0.0:
+        return None
+    b = 2*(fx*dx + fy*dy)
+    discriminant = b*b - 4*a*c
+    if discriminant < 0.0:
+        return None
+    t = (-b - math.sqrt(discriminant)) / (2.0*a)
+    if 0.0 <= t <= 1.0:
+        return t
+    return None
+
+def segmentBox(x0, y0, dx, dy, cx, cy, hx, hy):
+    """Slab test against an axis aligned box. Returns (t, nx, ny) where n is
+    the normal of the face that was hit, or None."""
+    tMin = 0.0
+    tMax = 1.0
+    nx = ny = 0.0
+    for origin, delta, low, high, axis in ((x0, dx, cx - hx, cx + hx, 0),
+                                           (y0, dy, cy - hy, cy + hy, 1)):
+        if delta == 0.0:
+            if origin < low or origin > high:
+                return None
+            continue
+        t1 = (low - origin) / float(delta)
+        t2 = (high - origin) / float(delta)
+        normal = -1.0
+        if t1 > t2:
+            t1, t2 = t2, t1
+            normal = 1.0
+        if t1 > tMin:
+            tMin = t1
+            if axis == 0:
+                nx, ny = normal, 0.0
+            else:
+                nx, ny = 0.0, normal
+        if t2 < tMax:
+            tMax = t2
+        if tMin > tMax:
+            return None
+    if nx == 0.0 and ny == 0.0:
+        # Started inside, push back out against the direction of travel
+        length = math.sqrt(dx*dx + dy*dy) or 1.0
+        nx, ny = -dx/length, -dy/length
+    return (tMin, nx, ny)
+
+def quaternionToAngle(q):
+    # ODE quaternions are (w, x, y, z), everything here rotates about z
+    return 2*math.atan2(q[3], q[0])
+
+class StaticBox(object):
+    def __init__(self, cx, cy, hx, hy, angle, object = None):
+        self.cx = cx
+        self.cy = cy
+        self.hx = hx
+        self.hy = hy
+        self.angle = angle
+        self.cos = math.cos(angle)
+        self.sin = math.sin(angle)
+        self.object = object
+        # Half extents of the axis aligned box around the rotated one
+        self.ex = abs(self.cos)*hx + abs(self.sin)*hy
+        self.ey = abs(self.sin)*hx + abs(self.cos)*hy
+
+    def aabb(self):
+        return (self.cx - self.ex, self.cx + self.ex, self.cy - self.ey, self.cy + self.ey)
+
+    def segmentCast(self, x0, y0, dx, dy):
+        if self.angle == 0.0:
+            return segmentBox(x0, y0, dx, dy, self.cx, self.cy, self.hx, self.hy)
+        # Into the box's frame, test, and rotate the normal back out
+        c, s = self.cos, self.sin
+        rx, ry = x0 - self.cx, y0 - self.cy
+        hit = segmentBox(c*rx + s*ry, -s*rx + c*ry, c*dx + s*dy, -s*dx + c*dy,
+                         0.0, 0.0, self.hx, self.hy)
+        if hit is None:
+            return None
+        t, nx, ny = hit
+        return (t, c*nx - s*ny, s*nx + c*ny)
+
+class StaticIndex(object):
+    """A uniform grid over the level's boxes. The statics never move so this
+    is built once when the level is loaded, or compiled with the level and
+    passed in as cells (see level.readCells)."""
+    def __init__(self, boxes, cellSize = 4.0, cells = None):
+        self.boxes = boxes
+        self.cellSize = cellSize
+        if cells is not None:
+            self.cells = cells
+            return
+        self.cells = {}
+        for i, box in enumerate(boxes):
+            minX, maxX, minY, maxY = box.aabb()
+            for cell in self._cellsFor(minX, maxX, minY, maxY):
+                self.cells.setdefault(cell, []).append(i)
+
+    def fromStatics(statics, cellSize = 4.0):
+        boxes = []
+        for static in statics:
+            position = static._geometry.getPosition()
+            size = static._size
+            boxes.append(StaticBox(position[0], position[1], size[0]/2.0, size[1]/2.0,
+                                   quaternionToAngle(static._geometry.getQuaternion()),
+                                   static))
+        return StaticIndex(boxes, cellSize)
+
+    fromStatics = staticmethod(fromStatics)
+
+    def _cellsFor(self, minX, maxX, minY, maxY):
+        size = self.cellSize
+        for ix in range(int(math.floor(minX/size)), int(math.floor(maxX/size)) + 1):
+            for iy in range(int(math.floor(minY/size)), int(math.floor(maxY/size)) + 1):
+                yield (ix, iy)
+
+    def candidates(self, minX, maxX, minY, maxY):
+        found = {}
+        cells = self.cells
+        for cell in self._cellsFor(minX, maxX, minY, maxY):
+            for i in cells.get(cell, ()):
+                found[i] = True
+        return found.keys()
+
+    def segmentCast(self, x0, y0, x1, y1):
+        """Nearest box hit by the segment as (t, nx, ny, box), or None."""
+        return self._walk(x0, y0, x1, y1, False)
+
+    def segmentBlocked(self, x0, y0, x1, y1):
+        """Whether any box is in the way. Stops at the first one it finds
+        rather than looking for the nearest."""
+        return self._walk(x0, y0, x1, y1, True) is not None
+
+    def _walk(self, x0, y0, x1, y1, first):
+        # Visits the cells the segment passes through in order, so it can
+        # stop as soon as a hit is nearer than the next cell. Boxes are in
+        # every cell they overlap, so they're only tested the first time.
+        dx = x1 - x0
+        dy = y1 - y0
+        size = self.cellSize
+        cells = self.cells
+        boxes = self.boxes
+        ix = int(math.floor(x0/size))
+        iy = int(math.floor(y0/size))
+        # The t the segment crosses into the next column and row at, and the
+        # t it takes to cross a whole cell
+        if dx > 0.0:
+            stepX, nextX, deltaX = 1, ((ix + 1)*size - x0) / dx, size / dx
+        elif dx < 0.0:
+            stepX, nextX, deltaX = -1, (ix*size - x0) / dx, -size / dx
+        else:
+            stepX, nextX, deltaX = 0, 2.0, 0.0
+        if dy > 0.0:
+            stepY, nextY, deltaY = 1, ((iy + 1)*size - y0) / dy, size / dy
+        elif dy < 0.0:
+            stepY, nextY, deltaY = -1, (iy*size - y0) / dy, -size / dy
+        else:
+            stepY, nextY, deltaY = 0, 2.0, 0.0
+        tested = {}
+        best = None
+        while True:
+            for i in cells.get((ix, iy), ()):
+                if i in tested:
+                    continue
+                tested[i] = True
+                box = boxes[i]
+                hit = box.segmentCast(x0, y0, dx, dy)
+                if hit is not None and (best is None or hit[0] < best[0]):
+                    best = (hit[0], hit[1], hit[2], box)
+                    if first:
+                        return best
+            if nextX < nextY:
+                t = nextX
+                ix += stepX
+                nextX += deltaX
+            else:
+                t = nextY
+                iy += stepY
+                nextY += deltaY
+            if t > 1.0 or (best is not None and best[0] <= t):
+                return best
+
+class SpatialHash(object):
+    """Things that move, bucketed into square cells. Cheap enough to rebuild
+    every network update and then query once per client."""
+    def __init__(self, cellSize = 16.0):
+        self.cellSize = cellSize
+        self.clear()
+
+    def clear(self):
+        self.cells = {}
+        # The occupied cells are all inside these
+        self.bounds = None
+
+    def insert(self, item, x, y):
+        cell = (int(math.floor(x/self.cellSize)), int(math.floor(y/self.cellSize)))
+        self.cells.setdefault(cell, []).append((x, y, item))
+        if self.bounds is None:
+            self.bounds = [cell[0], cell[0], cell[1], cell[1]]
+        else:
+            bounds = self.bounds
+            if cell[0] < bounds[0]: bounds[0] = cell[0]
+            if cell[0] > bounds[1]: bounds[1] = cell[0]
+            if cell[1] < bounds[2]: bounds[2] = cell[1]
+            if cell[1] > bounds[3]: bounds[3] = cell[1]
+
+    def query(self, minX, maxX, minY, maxY):
+        """Every item inserted inside the rectangle."""
+        found = []
+        size = self.cellSize
+        cells = self.cells
+        for ix in range(int(math.floor(minX/size)), int(math.floor(maxX/size)) + 1):
+            for iy in range(int(math.floor(minY/size)), int(math.floor(maxY/size)) + 1):
+                for x, y, item in cells.get((ix, iy), ()):
+                    if minX <= x <= maxX and minY <= y <= maxY:
+                        found.append(item)
+        return found
+
+    def within(self, x, y, radius):
+        """(distance squared, item) for every item inside the circle."""
+        found = []
+        size = self.cellSize
+        cells = self.cells
+        r2 = radius*radius
+        for ix in range(int(math.floor((x - radius)/size)), int(math.floor((x + radius)/size)) + 1):
+            for iy in range(int(math.floor((y - radius)/size)), int(math.floor((y + radius)/size)) + 1):
+                for px, py, item in cells.get((ix, iy), ()):
+                    d = (px - x)*(px - x) + (py - y)*(py - y)
+                    if d <= r2:
+                        found.append((d, item))
+        return found
+
+    def nearest(self, x, y, k = 1, maxDistance = None, exclude = None):
+        """Up to k (distance squared, item) pairs, nearest first. Searches
+        rings of cells outwards until nothing further out could be closer."""
+        if not self.cells:
+            return []
+        size = self.cellSize
+        cells = self.cells
+        cx = int(math.floor(x/size))
+        cy = int(math.floor(y/size))
+        # No point looking past the furthest occupied cell, or at the parts
+        # of a ring outside the occupied ones
+        minX, maxX, minY, maxY = self.bounds
+        rings = max(cx - minX, maxX - cx, cy - minY, maxY - cy)
+        limit = None
+        if maxDistance is not None:
+            limit = maxDistance*maxDistance
+            rings = min(rings, int(maxDistance/size) + 1)
+        found = []
+        ring = 0
+        while ring <= rings:
+            if ring == 0:
+                ringCells = [(cx, cy)]
+            elif 8*ring > len(cells):
+                # Sparse enough that it's quicker to go through every
+                # occupied cell left than to walk the rest of the rings
+                ringCells = [(ix, iy) for ix, iy in cells.keys()
+                             if max(abs(ix - cx), abs(iy - cy)) >= ring]
+                rings = ring
+            else:
+                ringCells = []
+                left, right = max(cx - ring, minX), min(cx + ring, maxX)
+                bottom, top = max(cy - ring + 1, minY), min(cy + ring - 1, maxY)
+                if cy - ring >= minY:
+                    ringCells += [(ix, cy - ring) for ix in range(left, right + 1)]
+                if cy + ring <= maxY:
+                    ringCells += [(ix, cy + ring) for ix in range(left, right + 1)]
+                if cx - ring >= minX:
+                    ringCells += [(cx - ring, iy) for iy in range(bottom, top + 1)]
+                if cx + ring <= maxX:
+                    ringCells += [(cx + ring, iy) for iy in range(bottom, top + 1)]
+            for cell in ringCells:
+                for px, py, item in cells.get(cell, ()):
+                    if item is exclude:
+                        continue
+                    d = (px - x)*(px - x) + (py - y)*(py - y)
+                    if limit is None or d <= limit:
+                        found.append((d, item))
+            # Everything in a further ring is at least this far away
+            if len(found) >= k:
+                found.sort()
+                reach = ring*size
+                if found[k - 1][0] <= reach*reach:
+                    break
+            ring += 1
+        found.sort()
+        return found[:k]
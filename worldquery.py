@@ -0,0 +1,102 @@
+# Spatial questions about the world, for anything that would otherwise scan
+# Engine.objects or Engine.statics: line of sight, whether a spawn point is
+# clear, what's inside a blast, who's nearest.
+#
+# Rays go against the statics through the engine's StaticIndex, which is
+# built once with the level since statics never move. Things that do move
+# are put in a SpatialHash per type, rebuilt at most once a physics tick and
+# only when something asks about that type. Bullets, shrapnel and lasers
+# aren't indexed, there are too many of them and nothing asks where they
+# are.
+
+from spatial import SpatialHash
+from objects import DYNAMIC, SPHERE, PERSON, GRENADE
+
+class WorldQuery(object):
+    types = (PERSON, GRENADE, DYNAMIC, SPHERE)
+    cellSize = 8.0
+
+    def __init__(self, staticIndex, objects, metrics):
+        self.staticIndex = staticIndex
+        self.objects = objects
+        self.hashes = {}
+        # Which tick each type's hash was built on
+        self.built = {}
+        self.tick = 0
+        self._rays = metrics.counter('query.rays')
+        self._overlaps = metrics.counter('query.overlaps')
+        self._nearest = metrics.counter('query.nearest')
+        self._rebuilds = metrics.counter('query.rebuilds')
+
+    def invalidate(self):
+        """Everything might have moved."""
+        self.tick += 1
+
+    def _hash(self, type):
+        hash = self.hashes.get(type)
+        if hash is None:
+            hash = self.hashes[type] = SpatialHash(self.cellSize)
+        elif self.built.get(type) == self.tick:
+            return hash
+        hash.clear()
+        for o in self.objects.ofType(type):
+            # The dead aren't anywhere until they respawn
+            if not o.isDead():
+                position = o.getBody().getPosition()
+                hash.insert(o, position[0], position[1])
+        self.built[type] = self.tick
+        self._rebuilds.value += 1
+        return hash
+
+    def _typesOf(self, type):
+        if type is None:
+            return self.types
+        return (type,)
+
+    def raycast(self, x0, y0, x1, y1):
+        """The nearest static hit as (t, nx, ny, static), or None."""
+        self._rays.value += 1
+        hit = self.staticIndex.segmentCast(x0, y0, x1, y1)
+        if hit is None:
+            return None
+        return (hit[0], hit[1], hit[2], hit[3].object)
+
+    def raycasts(self, segments):
+        """raycast for each (x0, y0, x1, y1) in segments, in order."""
+        cast = self.staticIndex.segmentCast
+        results = []
+        for x0, y0, x1, y1 in segments:
+            hit = cast(x0, y0, x1, y1)
+            if hit is not None:
+                hit = (hit[0], hit[1], hit[2], hit[3].object)
+            results.append(hit)
+        self._rays.value += len(segments)
+        return results
+
+    def lineOfSight(self, x0, y0, x1, y1):
+        self._rays.value += 1
+        return not self.staticIndex.segmentBlocked(x0, y0, x1, y1)
+
+    def linesOfSight(self, segments):
+        """lineOfSight for each (x0, y0, x1, y1) in segments, in order."""
+        blocked = self.staticIndex.segmentBlocked
+        self._rays.value += len(segments)
+        return [not blocked(x0, y0, x1, y1) for x0, y0, x1, y1 in segments]
+
+    def overlapCircle(self, x, y, radius, type = None):
+        """Every live object of type, or of any indexed type, whose centre is
+        inside the circle."""
+        self._overlaps.value += 1
+        found = []
+        for t in self._typesOf(type):
+            found += [o for d, o in self._hash(t).within(x, y, radius)]
+        return found
+
+    def nearest(self, x, y, k = 1, type = None, maxDistance = None, exclude = None):
+        """Up to k live objects as (distance, object), nearest first."""
+        self._nearest.value += 1
+        found = []
+        for t in self._typesOf(type):
+            found += self._hash(t).nearest(x, y, k, maxDistance, exclude)
+        found.sort()
+        return [(d ** 0.5, o) for d, o in found[:k]]